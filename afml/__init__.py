@@ -1 +1,6 @@
-from .afml import AFML
+# Imported lazily, so that step scripts and the command line start fast
+def __getattr__(name):
+    if name == 'AFML':
+        from .afml import AFML
+        return AFML
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,27 +1,35 @@
 """
     Automation Framework for Machine Learning
 """
+import glob
+import hashlib
+import json
 import os
 import pickle
-from argparse import ArgumentParser
-from typing import List
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Union
 
-import yaml
 from termcolor import cprint
 
 from .base import BaseObject
 from .context import RunContext
 from .dataset import Dataset
 from .executor import Executor, get_executor
-from .matrix import Matrix, MatrixInstance
+from .matrix import AdaptiveMatrix, Matrix, MatrixError, MatrixInstance, MatrixSlice
 from .model import Model
+from .plan import JobUnit, Plan, PlanError, SearchUnit, StepUnit
+from .resources import Resources
 from .runnable import RunnableObject
+from .scheduler import Scheduler, Task
+from .session import Session
 from .utils.format import ParamsFormatter
 
 
 class DatasetNotFoundError(LookupError): ...
 class ModelNotFoundError(LookupError): ...
 class JobNotFoundError(LookupError): ...
+class JobDependencyError(ValueError): ...
 
 class Step(RunnableObject):
     index = 0
@@ -44,9 +52,10 @@ class Step(RunnableObject):
         params: dict = None,
         dataset: Dataset = None,
         model: Model = None,
-        conditions: dict = None
+        conditions: dict = None,
+        resources: dict = None
     ):
-        super().__init__(name, params, dataset, model, conditions)
+        super().__init__(name, params, dataset, model, conditions, resources)
         self.index = Step.index
         Step.index += 1
         self.executor = executor
@@ -63,19 +72,20 @@ class Step(RunnableObject):
             params=definition.get('params') or {},
             dataset=definition.get('dataset'),
             model=definition.get('model'),
-            conditions=definition.get('if') or {}
+            conditions=definition.get('if') or {},
+            resources=definition.get('resources')
         )
 
-    def run(
+    def plan(
         self,
         project: 'Project',
         job: 'Job',
+        matrix: dict,
         dataset: Dataset = None,
         model: Model = None,
         formatter=ParamsFormatter()
-    ):
-        cprint(f"---- {self.display_name} [{self.executor}] ----", 'blue')
-
+    ) -> StepUnit:
+        '''Format everything the step needs to run'''
         formatter.update({'step': self})
 
         step_dataset = self.get_dataset(project, formatter)
@@ -92,16 +102,32 @@ class Step(RunnableObject):
         })
         formatter.update(self.params)
 
-        if not self.can_execute(formatter):
-            cprint("Skipping step", 'yellow')
-            return False
+        # Steps without their own resources use the ones of their job
+        resources = self.get_resources(formatter)
+        if resources is None:
+            resources = job.get_resources(formatter)
+
+        return StepUnit(
+            job, self, matrix, self.executor,
+            self.executor.format_vars(formatter),
+            RunContext(project, job, self, dataset, model, formatter),
+            self.get_conditions(formatter),
+            resources
+        )
 
-        ctx = RunContext(project, job, self, dataset, model, formatter)
-        process = self.executor.start(ctx, formatter)
-        for stderr in process:
-            cprint(stderr, 'yellow', end='')
-        if process.exit_code != 0:
-            cprint("ERROR: Step execution failed!", 'red')
+    def run(
+        self,
+        project: 'Project',
+        job: 'Job',
+        dataset: Dataset = None,
+        model: Model = None,
+        formatter=ParamsFormatter(),
+        session: Session = None,
+        job_record: int = None
+    ):
+        return self.plan(
+            project, job, formatter.variables.get('matrix'), dataset, model, formatter
+        ).run(session, job_record)
 
 class Job(RunnableObject):
     index = 0
@@ -124,13 +150,17 @@ class Job(RunnableObject):
         dataset: Dataset = None,
         model: Model = None,
         conditions: dict = None,
-        matrix: Matrix = None
+        matrix: Matrix = None,
+        needs: List[str] = None,
+        resources: dict = None
     ):
-        super().__init__(name, params, dataset, model, conditions)
+        super().__init__(name, params, dataset, model, conditions, resources)
         self.index = Job.index
         Job.index += 1
         self.steps = steps
         self.matrix = matrix or Matrix()
+        # Jobs without explicit needs depend on the previous job of the project
+        self.needs = needs
 
     @property
     def display_name(self):
@@ -142,6 +172,10 @@ class Job(RunnableObject):
             #raise Error
             return None
 
+        needs = definition.get('needs')
+        if isinstance(needs, (str, int)):
+            needs = [needs]
+
         return Job(
             steps=[Step.parse(step) for step in definition['steps']],
             name=definition.get('name'),
@@ -149,20 +183,52 @@ class Job(RunnableObject):
             dataset=definition.get('dataset'),
             model=definition.get('model'),
             conditions=definition.get('if') or {},
-            matrix = Matrix(**(definition.get('matrix') or {})),
+            matrix = Matrix.parse(definition.get('matrix')),
+            needs=[str(need) for need in needs] if needs is not None else None,
+            resources=definition.get('resources'),
         )
 
     def get_step(self, step_name):
         pass
 
-    def run(self, project, project_matrix=MatrixInstance()):
-        cprint(f"==== {self.display_name} ====", 'green')
+    def get_matrix(self, session: Session = None, index: int = 0, count: int = 1) -> Union[Matrix, MatrixSlice]:
+        '''
+        Get the job matrix combinations to run within the index-th of count project matrix instances.
+        Shards split the combinations of both matrices together. Adaptive matrices are never sharded
+        '''
+        if session is None or session.shard is None or isinstance(self.matrix, AdaptiveMatrix):
+            return self.matrix
+        shard, shards = session.shard
+        length = len(self.matrix)
+        start = max(shard * count * length // shards - index * length, 0)
+        stop = min((shard + 1) * count * length // shards - index * length, length)
+        return MatrixSlice(self.matrix, start, max(start, stop))
+
+    def run(self, project, project_matrix=MatrixInstance(), session: Session = None):
+        matrix = self.get_matrix(session)
+        if isinstance(matrix, AdaptiveMatrix):
+            # The search chooses the next combinations from the metrics reported by the steps
+            session = session or Session()
+            job_matrices = matrix.search(lambda job_matrix: session.get_metrics(
+                self, project_matrix.merge(job_matrix)
+            ).get(matrix.metric))
+        else:
+            job_matrices = matrix
 
-        for job_matrix in self.matrix:
-            if len(job_matrix) > 0:
-                cprint(f" {str(job_matrix):-<100}", 'magenta', 'on_white')
-            matrix = project_matrix.merge(job_matrix)
+        for job_matrix in job_matrices:
+            failed = self.run_matrix(project, project_matrix, job_matrix, session)
+            if failed:
+                return True
 
+        if isinstance(matrix, AdaptiveMatrix) and matrix.best is not None:
+            cprint(f"Best combination: {matrix.best[0]}, {matrix.metric}={matrix.best[1]:g}", 'green')
+        return False
+
+    def plan_matrix(self, project, project_matrix, job_matrix, id: int = 0, needs: List[int] = None) -> JobUnit:
+        '''Format the job and its steps for a matrix instance, failing on the first mistake found'''
+        matrix = project_matrix.merge(job_matrix)
+        location = self.display_name
+        try:
             formatter = ParamsFormatter(matrix=matrix)
             formatter.update(project.params)
             formatter.update({'job': self})
@@ -176,21 +242,91 @@ class Job(RunnableObject):
             })
             formatter.update(self.params)
 
-            if not self.can_execute(formatter):
-                cprint("Skipping job", 'yellow')
-                return False
-
+            unit = JobUnit(
+                id, self, project_matrix, job_matrix,
+                {key: formatter.variables[key] for key in (*project.params, *self.params)},
+                dataset, model, self.get_conditions(formatter), needs=needs
+            )
             for step in self.steps:
-                failed = step.run(
-                    project, self, dataset, model, formatter.copy()
-                )
-                if failed:
-                    return True
-                print()
+                location = f"{self.display_name}, {step.display_name}"
+                unit.steps.append(step.plan(project, self, matrix, dataset, model, formatter.copy()))
+        except Exception as e:
+            raise PlanError(
+                f"{location}{f' {matrix}' if len(matrix) > 0 else ''}: "
+                f"{e.args[0] if len(e.args) == 1 else e}"
+            ) from e
+        return unit
+
+    def run_matrix(self, project, project_matrix, job_matrix, session: Session = None):
+        return self.plan_matrix(project, project_matrix, job_matrix).run(session)
+
+class ProjectInclude:
+    """
+    File included by a project, defining more datasets, models and jobs.
+    Its jobs are only parsed once one of them is needed, the project only keeps their names until then
+    """
 
-        return False
+    def __init__(self, file):
+        self.file = str(file)
+        self.stat = ProjectInclude.get_stat(self.file)
+        definition = ProjectInclude.read(self.file)
+        self.datasets: List[Dataset] = [Dataset.parse(dataset) for dataset in definition.get('datasets', [])]
+        self.models: List[Model] = [Model.parse(model) for model in definition.get('models', [])]
+        # Jobs and steps are numbered in the order of the files, as if they were all parsed at once,
+        # so unnamed ones get the same names whenever and in whatever order the files are parsed
+        jobs = [job for job in definition.get('jobs', []) if 'steps' in job]
+        self.job_index = Job.index
+        self.step_index = Step.index
+        Job.index += len(jobs)
+        Step.index += sum(len(job['steps']) for job in jobs)
+        # Names the jobs are looked up by: their name or 'Job <N>', and their index
+        self.job_names: List[str] = [
+            key
+            for index, job in enumerate(jobs, self.job_index)
+            for key in (
+                str(job['name']) if job.get('name') is not None else f"Job {index+1}",
+                str(index)
+            )
+        ]
+        self.jobs: Optional[List[Job]] = None
+        # Definitions read to index the file, kept until its jobs are parsed but never cached
+        self._job_definitions: Optional[List[dict]] = definition.get('jobs', [])
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_job_definitions'] = None
+        return state
+
+    @staticmethod
+    def get_stat(file) -> List[int]:
+        stat = os.stat(file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def read(file) -> dict:
+        with open(file, 'r', encoding='utf-8') as include_file:
+            return Project.parse_yaml(include_file.read()) or {}
+
+    @property
+    def loaded(self) -> bool:
+        return self.jobs is not None
+
+    def load(self) -> List[Job]:
+        definitions = self._job_definitions
+        if definitions is None:
+            definitions = ProjectInclude.read(self.file).get('jobs', [])
+        self._job_definitions = None
+        job_index, step_index = Job.index, Step.index
+        Job.index, Step.index = self.job_index, self.step_index
+        try:
+            self.jobs = [Job.parse(job) for job in definitions]
+        finally:
+            Job.index, Step.index = job_index, step_index
+        return self.jobs
 
 class Project(BaseObject):
+    CACHE_VERSION = 1
+
     def __repr__(self):
         return f"Project({', '.join(f'{k}={repr(v)}' for k, v in self.params.items())})"
 
@@ -200,18 +336,108 @@ class Project(BaseObject):
         models: List[Model] = None,
         jobs: List[Job] = None,
         matrix: Matrix = None,
-        params: dict = None
+        params: dict = None,
+        includes: List[ProjectInclude] = None,
+        include_patterns: List[str] = None
     ):
         super().__init__(params=params)
-        self.datasets: List[Dataset] = datasets or []
-        self.models: List[Model] = models or []
-        self.jobs: List[Job] = jobs or []
+        self.includes: List[ProjectInclude] = includes or []
+        # Patterns of the included files, to find the files added since the project was cached
+        self.include_patterns: List[str] = include_patterns or []
+        self.datasets: List[Dataset] = (datasets or []) + [
+            dataset for include in self.includes for dataset in include.datasets
+        ]
+        self.models: List[Model] = (models or []) + [
+            model for include in self.includes for model in include.models
+        ]
+        self._jobs: List[Job] = jobs or []
         self.matrix: Matrix = matrix or Matrix()
+        if isinstance(self.matrix, AdaptiveMatrix):
+            raise MatrixError("Adaptive strategies are only supported in job matrices")
+
+        # Registries by name. Definitions repeating a name are shadowed by the first one, as in a scan
+        self._datasets_by_name: Dict[str, Dataset] = {}
+        for dataset in self.datasets:
+            self._datasets_by_name.setdefault(dataset.name, dataset)
+        self._models_by_name: Dict[str, Model] = {}
+        for model in self.models:
+            self._models_by_name.setdefault(model.name, model)
+        self._includes_by_job: Dict[str, ProjectInclude] = {}
+        for include in self.includes:
+            for job_name in include.job_names:
+                self._includes_by_job.setdefault(job_name, include)
+        self._jobs_by_name: Dict[str, Job] = {}
+        # Jobs without explicit needs depend on the previous one of the same file
+        self._previous: Dict[Job, Optional[Job]] = {}
+        self._dependencies: Dict[Job, List[Job]] = {}
+        self._add_jobs(self._jobs)
+
+    @property
+    def jobs(self) -> List[Job]:
+        '''Jobs of the project file, followed by the ones parsed from the included files'''
+        return self._jobs + [job for include in self.includes if include.loaded for job in include.jobs]
+
+    def _add_jobs(self, jobs: List[Job]):
+        for previous, job in zip([None, *jobs], jobs):
+            self._previous[job] = previous
+            for key in (job.name, job.display_name, str(job.index)):
+                if key is not None:
+                    self._jobs_by_name.setdefault(str(key), job)
+        # Needed jobs of other included files are parsed when they are looked up
+        for job in jobs:
+            self._dependencies[job] = self._get_needed_jobs(job)
+        self._check_cycles()
+
+    def _load_include(self, include: ProjectInclude):
+        if not include.loaded:
+            self._add_jobs(include.load())
+
+    def load_includes(self):
+        '''Parse the jobs of all the included files'''
+        for include in self.includes:
+            self._load_include(include)
+
+    @staticmethod
+    def parse_yaml(content: str):
+        import yaml
+        # The C parser is several times faster, if PyYAML was built with it
+        return yaml.load(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    @staticmethod
+    def get_include_files(patterns: List[str], folder='.') -> List[str]:
+        '''Files matched by the include patterns, relative to the folder of the project file'''
+        files = []
+        for pattern in patterns:
+            path = os.path.join(folder, pattern)
+            matches = sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+            if not matches or not all(os.path.isfile(match) for match in matches):
+                raise FileNotFoundError(f"Included file not found: {pattern}")
+            files.extend(os.path.normpath(match) for match in matches)
+        return list(dict.fromkeys(files))
+
+    def includes_changed(self, folder='.') -> bool:
+        '''Check if the included files were modified, added or removed since the project was loaded'''
+        try:
+            files = Project.get_include_files(self.include_patterns, folder)
+            return files != [include.file for include in self.includes] or any(
+                include.stat != ProjectInclude.get_stat(include.file) for include in self.includes
+            )
+        except OSError:
+            return True
 
     @staticmethod
     def load(file):
         with open(file, 'r', encoding='utf-8') as project_file:
-            definition = yaml.safe_load(project_file)
+            return Project.loads(project_file.read(), os.path.dirname(file))
+
+    @staticmethod
+    def loads(content: str, folder='.'):
+        definition = Project.parse_yaml(content)
+
+        include_patterns = definition.get('include') or []
+        if isinstance(include_patterns, str):
+            include_patterns = [include_patterns]
+        include_patterns = [str(pattern) for pattern in include_patterns]
 
         return Project(
             datasets=[
@@ -226,43 +452,199 @@ class Project(BaseObject):
                 Job.parse(job)
                 for job in definition.get('jobs', [])
             ],
-            matrix=Matrix(**definition.get('matrix', {})),
+            matrix=Matrix.parse(definition.get('matrix')),
             params=definition.get('params', {}),
+            includes=[ProjectInclude(file) for file in Project.get_include_files(include_patterns, folder)],
+            include_patterns=include_patterns,
         )
 
+    @staticmethod
+    def load_cached(file, cache_folder='.afml'):
+        '''
+        Load a project, reusing the one compiled by the last invocation if the file didn't change.
+        The file is only hashed when its size or modification time differ from the cached ones
+        '''
+        cache_file = Path(cache_folder) / 'project.pickle'
+        key_file = Path(cache_folder) / 'project.json'
+        stat = os.stat(file)
+        key = {
+            'version': Project._get_cache_version(),
+            'file': os.path.abspath(file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+        }
+
+        try:
+            with open(key_file, 'r', encoding='utf-8') as serialized_key:
+                cached_key = json.load(serialized_key)
+        except (OSError, ValueError):
+            cached_key = {}
+        cached_hash = cached_key.pop('hash', None)
+
+        content = None
+        if key == cached_key:
+            file_hash = cached_hash
+        else:
+            with open(file, 'rb') as project_file:
+                content = project_file.read()
+            file_hash = hashlib.sha256(content).hexdigest()
+
+        project = None
+        if file_hash == cached_hash and key['version'] == cached_key.get('version'):
+            try:
+                with open(cache_file, 'rb') as serialized_file:
+                    project = pickle.load(serialized_file)
+            except Exception:
+                project = None
+
+        if project is not None and project.includes_changed(os.path.dirname(file)):
+            project = None
+
+        if project is None:
+            if content is None:
+                with open(file, 'rb') as project_file:
+                    content = project_file.read()
+            project = Project.loads(content.decode('utf-8'), os.path.dirname(file))
+            Project._write_atomic(cache_file, pickle.dumps(project))
+
+        if key != cached_key or file_hash != cached_hash:
+            Project._write_atomic(
+                key_file,
+                json.dumps({**key, 'hash': file_hash}).encode('utf-8')
+            )
+
+        return project
+
+    @staticmethod
+    def _get_cache_version() -> str:
+        '''Version of the cached projects, which changes with the framework code'''
+        digest = hashlib.sha256()
+        for path in sorted(Path(__file__).parent.rglob('*.py')):
+            digest.update(f'{path.name}:{path.stat().st_mtime_ns}\n'.encode('utf-8'))
+        return f'{Project.CACHE_VERSION}-{digest.hexdigest()[:16]}'
+
+    @staticmethod
+    def _write_atomic(file: Path, data: bytes):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=file.parent, delete=False) as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_file.name, file)
+
     def get_dataset(self, dataset_name):
         if not dataset_name:
             raise ValueError("No dataset name provided")
 
-        for dataset in self.datasets:
-            if dataset_name == dataset.name:
-                return dataset
-
-        raise DatasetNotFoundError(dataset_name)
+        dataset = self._datasets_by_name.get(dataset_name)
+        if dataset is None:
+            raise DatasetNotFoundError(dataset_name)
+        return dataset
 
     def get_model(self, model_name):
         if not model_name:
             raise ValueError("No model name provided")
 
-        for model in self.models:
-            if model_name == model.name:
-                return model
-
-        raise ModelNotFoundError(model_name)
+        model = self._models_by_name.get(model_name)
+        if model is None:
+            raise ModelNotFoundError(model_name)
+        return model
 
     def get_job(self, job_name):
         if not job_name:
             raise ValueError("No job name provided")
 
-        for job in self.jobs:
-            if (
-                job_name == job.name
-                or job_name == job.display_name
-                or job_name == str(job.index)
-            ):
-                return job
-
-        raise JobNotFoundError(job_name)
+        job_name = str(job_name)
+        job = self._jobs_by_name.get(job_name)
+        if job is None and job_name in self._includes_by_job:
+            self._load_include(self._includes_by_job[job_name])
+            job = self._jobs_by_name.get(job_name)
+        if job is None:
+            raise JobNotFoundError(job_name)
+        return job
+
+    def _get_needed_jobs(self, job):
+        if job.needs is None:
+            previous = self._previous.get(job)
+            return [previous] if previous is not None else []
+
+        try:
+            return [self.get_job(job_name) for job_name in job.needs]
+        except JobNotFoundError as e:
+            raise JobNotFoundError(
+                f"'{e.args[0]}', needed by '{job.display_name}'"
+            ) from None
+
+    def _check_cycles(self):
+        visited = set()
+        # Jobs of an included file being parsed don't have their dependencies yet, they are checked after
+        for job in list(self._dependencies):
+            if job in visited:
+                continue
+
+            # Depth-first search, keeping the path to the current job
+            path = [job]
+            pending = [iter(self._dependencies[job])]
+            visited.add(job)
+            while pending:
+                dependency = next(pending[-1], None)
+                if dependency is None:
+                    path.pop()
+                    pending.pop()
+                elif dependency in path:
+                    cycle = path[path.index(dependency):] + [dependency]
+                    raise JobDependencyError(
+                        "Dependency cycle between jobs: "
+                        + ' -> '.join(job.display_name for job in cycle)
+                    )
+                elif dependency not in visited:
+                    visited.add(dependency)
+                    path.append(dependency)
+                    pending.append(iter(self._dependencies.get(dependency, [])))
+
+    def get_required_jobs(self, job_names: List[str] = None) -> List[Job]:
+        '''Get the jobs to run, including the ones they explicitly need'''
+        if not job_names:
+            self.load_includes()
+            return list(self.jobs)
+
+        required = set()
+        pending = [self.get_job(job_name) for job_name in job_names]
+        while pending:
+            job = pending.pop()
+            if job in required:
+                continue
+            required.add(job)
+            if job.needs is not None:
+                pending.extend(self._dependencies[job])
+
+        return [job for job in self.jobs if job in required]
+
+    def get_dependency_graph(self, jobs: List[Job]) -> Dict[Job, List[Job]]:
+        '''
+        Get the dependencies between the given jobs, sorted in execution order.
+        Dependencies on jobs that are not given are replaced by their own ones
+        '''
+        def get_dependencies(job):
+            dependencies = []
+            for dependency in self._dependencies[job]:
+                if dependency in jobs:
+                    dependencies.append(dependency)
+                else:
+                    dependencies.extend(get_dependencies(dependency))
+            return dependencies
+
+        graph = {job: list(dict.fromkeys(get_dependencies(job))) for job in jobs}
+
+        # Topological sort keeping the project order between independent jobs
+        sorted_graph = {}
+        while len(sorted_graph) < len(graph):
+            job = next(
+                job for job, dependencies in graph.items()
+                if job not in sorted_graph
+                and all(dependency in sorted_graph for dependency in dependencies)
+            )
+            sorted_graph[job] = graph[job]
+
+        return sorted_graph
 
 class AFML:
     """
@@ -270,64 +652,163 @@ class AFML:
     """
 
     def __init__(self, project_file):
-        self.project = Project.load(project_file)
-
         os.makedirs(".afml", exist_ok=True)
-        with open(".afml/project.pickle", 'wb') as serialized_file:
-            pickle.dump(self.project, serialized_file)
-
-    def run(self):
-        for matrix in self.project.matrix:
-            if len(matrix) > 0:
-                cprint(f" {str(matrix):-<100}", 'white', 'on_magenta')
-            for job in self.project.jobs:
-                failed = job.run(self.project, matrix)
+        self.project_file = project_file
+        self.project = Project.load_cached(project_file)
+
+    def plan(self, job_names: List[str] = None, session: Session = None) -> Plan:
+        '''Format every step of the jobs to run, for every matrix instance'''
+        session = session or Session()
+        jobs = self.project.get_required_jobs(job_names)
+        graph = self.project.get_dependency_graph(jobs)
+
+        # Searches need the results of all their combinations, so only the first shard runs them
+        searches = session.shard is None or session.shard[0] == 0
+        for job in graph:
+            if isinstance(job.matrix, AdaptiveMatrix) and not searches:
+                cprint(f"{job.display_name} uses an adaptive matrix, which only runs in the first shard", 'yellow')
+
+        # Units need all the units of the jobs they need within the same project matrix
+        units = []
+        project_count = len(self.project.matrix)
+        for project_index, project_matrix in enumerate(self.project.matrix):
+            job_units: Dict[Job, List[int]] = {}
+            for job, dependencies in graph.items():
+                needs = [unit for dependency in dependencies for unit in job_units[dependency]]
+                if isinstance(job.matrix, AdaptiveMatrix):
+                    job_plan = [SearchUnit(len(units), job, self.project, project_matrix, needs)] if searches else []
+                else:
+                    job_plan = [
+                        job.plan_matrix(self.project, project_matrix, job_matrix, len(units) + index, needs)
+                        for index, job_matrix in enumerate(
+                            job.get_matrix(session, project_index, project_count)
+                        )
+                    ]
+                job_units[job] = [unit.id for unit in job_plan]
+                units.extend(job_plan)
+
+        return Plan(units, Plan.hash_project(self.project_file))
+
+    def run(self, job_names: List[str] = None, workers: Optional[int] = 1, session: Session = None):
+        # Everything is formatted before running, so mistakes are found before the first step
+        session = session or Session()
+        return self.run_plan(self.plan(job_names, session), workers, session)
+
+    def run_plan(self, plan: Plan, workers: Optional[int] = 1, session: Session = None):
+        session = session or Session()
+
+        # Each job is a task after the ones it needs within the same project matrix.
+        # When running in parallel, every job matrix instance is a task on its own.
+        # Adaptive matrices run sequentially, as their combinations depend on the previous ones.
+        # Without a number of workers, as many instances as fit the resources pool run in parallel
+        if workers is None:
+            workers = 1
+            if session.resources is not None and any(unit.resources for unit in plan.jobs):
+                workers = max(1, int(session.resources.cpus))
+        scheduler = Scheduler(workers, session.resources)
+        groups: List[List[JobUnit]] = []
+        for unit in plan.jobs:
+            if (
+                scheduler.workers == 1 and groups
+                and not isinstance(unit, SearchUnit) and not isinstance(groups[-1][0], SearchUnit)
+                and groups[-1][0].job is unit.job and groups[-1][0].project_matrix == unit.project_matrix
+            ):
+                groups[-1].append(unit)
+            else:
+                groups.append([unit])
+
+        tasks = []
+        unit_tasks: Dict[int, Task] = {}
+        for index, group in enumerate(groups):
+            # Sequential runs only print the project matrix before its first job
+            header = (
+                scheduler.workers > 1 or index == 0
+                or group[0].project_matrix != groups[index-1][0].project_matrix
+            )
+            # The scheduler takes the resources of the instances before starting them
+            for unit in group:
+                for step in unit.steps:
+                    step.reserved = session.resources is not None
+            task = Task(
+                self._run_units_task(group, session, header),
+                name=f"{group[0].job.display_name} "
+                     f"{group[0].matrix if len(group) == 1 else group[0].project_matrix}",
+                needs=list(dict.fromkeys(unit_tasks[need] for unit in group for need in unit.needs)),
+                resources=Resources.largest([unit.resources for unit in group])
+            )
+            unit_tasks.update((unit.id, task) for unit in group)
+            tasks.append(task)
+
+        return scheduler.run(tasks)
+
+    def _run_units_task(self, units: List[JobUnit], session, header):
+        def run_units():
+            project_matrix = units[0].project_matrix
+            if header and len(project_matrix) > 0:
+                cprint(f" {str(project_matrix):-<100}", 'white', 'on_magenta')
+            cprint(f"==== {units[0].job.display_name} ====", 'green')
+            for unit in units:
+                failed = unit.run(session)
                 if failed:
+                    print()
                     return True
-                print()
-
-        return False
-
-    def run_job(self, job_name):
-        job = self.project.get_job(job_name)
-
-        for matrix in self.project.matrix:
-            if len(matrix) > 0:
-                cprint(f" {str(matrix):-<100}", 'white', 'on_magenta')
-
-            failed = job.run(self.project, matrix)
-            if failed:
-                return True
             print()
-
-        return False
-
-def main():
-    parser = ArgumentParser("AFML")
-    parser.add_argument(
-        '-p',
-        '--project',
-        dest='project_file',
-        help="Project file",
-        default="project.yml",
-    )
-    subparsers = parser.add_subparsers(dest='command')
-    run_parser = subparsers.add_parser('run', help="Run project jobs")
-    run_parser.add_argument(
-        '-j', '--job',
-        dest='job_name',  action='append',
-        help="Job to execute"
-    )
-
-    args, _ = parser.parse_known_args()
-    app = AFML(args.project_file)
-
-    if args.command == 'run':
-        if not args.job_name:
-            app.run()
-        else:
-            for job_name in args.job_name:
-                app.run_job(job_name)
+            return False
+        return run_units
+
+    def run_job(self, job_name, workers: int = 1, session: Session = None):
+        return self.run([job_name], workers, session)
+
+    def get_datasets(self, dataset_names: List[str] = None) -> List[Dataset]:
+        '''Get project datasets by name, or dataset folders not defined in the project'''
+        if not dataset_names:
+            return list(self.project.datasets)
+
+        datasets = []
+        for dataset_name in dataset_names:
+            try:
+                datasets.append(self.project.get_dataset(dataset_name))
+            except DatasetNotFoundError:
+                if not os.path.isdir(dataset_name):
+                    raise
+                datasets.append(Dataset(dataset_name))
+        return datasets
+
+    def index_datasets(self, dataset_names: List[str] = None, hashes=True, workers: int = None):
+        for dataset in self.get_datasets(dataset_names):
+            manifest = dataset.manifest()
+            changed, hashed = manifest.update(hashes, workers)
+            cprint(f"{dataset.name} ({dataset.folder})", 'green')
+            print(f"  files: {len(manifest.files)} ({manifest.size} bytes)")
+            print(f"  changed: {changed}, hashed: {hashed}")
+            if hashes:
+                print(f"  fingerprint: {manifest.fingerprint()}")
+
+    def pack_datasets(
+        self,
+        dataset_names: List[str] = None,
+        output: str = None,
+        shard_size='256M',
+        arrays=False,
+        workers: int = None
+    ):
+        '''Pack datasets into shards, next to their folders unless an output folder is given'''
+        from .pack import PackedDataset
+
+        for dataset in self.get_datasets(dataset_names):
+            if dataset.packed is not None:
+                cprint(f"{dataset.name} ({dataset.folder}) is already packed", 'yellow')
+                continue
+
+            packed = PackedDataset.pack(
+                dataset.folder,
+                output or dataset.folder.with_name(f'{dataset.folder.name}.packed'),
+                shard_size, arrays, workers
+            )
+            cprint(f"{dataset.name} ({dataset.folder}) -> {packed.folder}", 'green')
+            print(f"  files: {len(packed)}, shards: {len(packed.shards)}")
+
+from .cli import main
 
 if __name__ == '__main__':
     main()
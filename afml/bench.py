@@ -0,0 +1,371 @@
+"""
+    Benchmarks of the framework itself, run with 'afml bench' or 'python -m afml.bench'.
+    Results are written as JSON, and can be compared with the results of another version
+"""
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+
+def generate_project(folder, jobs=100, steps=10, matrix=3):
+    '''Write a synthetic project file with the given number of jobs and steps per job'''
+    lines = [
+        'params:',
+        '  base: 1',
+        "  name: 'bench-{base}'",
+        'jobs:'
+    ]
+    for job in range(jobs):
+        lines += [
+            f'  - name: job-{job}',
+            '    matrix:',
+            f'      run: [{", ".join(str(run) for run in range(matrix))}]',
+            '    params:',
+            f"      folder: 'out/{{name}}/{job}/{{matrix.run}}'",
+            '    steps:',
+        ]
+        for step in range(steps):
+            lines += [
+                f'      - name: step-{step}',
+                '        shell: "true"',
+                '        params:',
+                f"          index: {step}",
+                "          output: '{folder}/{index}'",
+            ]
+
+    project_file = Path(folder) / 'project.yml'
+    project_file.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return project_file
+
+def summarize(times: List[float], number: int = 1) -> dict:
+    '''Statistics of measured times in seconds, each one of 'number' operations'''
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'max': max(times),
+        'repeat': len(times),
+        'number': number,
+        'per_op': statistics.median(times) / number,
+    }
+
+def time_function(func: Callable, repeat=5, number=1, setup: Callable = None) -> dict:
+    '''Time 'number' calls of a function in this process, 'repeat' times'''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append(time.perf_counter() - start)
+    return summarize(times, number)
+
+def get_env() -> dict:
+    '''Environment of the benchmarked processes, which import this version of afml'''
+    return {
+        **os.environ,
+        'PYTHONPATH': os.pathsep.join(filter(None, (
+            str(Path(__file__).resolve().parent.parent),
+            os.environ.get('PYTHONPATH')
+        )))
+    }
+
+def time_command(command, repeat=5, cwd=None) -> dict:
+    '''Time a command in a new process, returning the statistics of the wall time in seconds'''
+    env = get_env()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            command, cwd=cwd, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+@contextlib.contextmanager
+def workspace():
+    '''Temporary project folder, used as the working directory'''
+    folder = tempfile.mkdtemp(prefix='afml-bench-')
+    cwd = os.getcwd()
+    try:
+        os.makedirs(os.path.join(folder, '.afml'))
+        os.chdir(folder)
+        yield Path(folder)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_startup(repeat=5, jobs=200) -> dict:
+    '''Time the command line startup, and the project loading with a cold and a warm cache'''
+    results = {
+        'python': time_command([sys.executable, '-c', 'pass'], repeat),
+        'import_afml': time_command([sys.executable, '-c', 'import afml'], repeat),
+        'import_run_ctx': time_command(
+            [sys.executable, '-c', 'from afml.context import run_ctx'], repeat
+        ),
+        'help': time_command([sys.executable, '-m', 'afml', '--help'], repeat),
+    }
+
+    folder = tempfile.mkdtemp(prefix='afml-bench-')
+    try:
+        generate_project(folder, jobs=jobs)
+        load = [sys.executable, '-c', "from afml.afml import AFML; AFML('project.yml')"]
+
+        cold_times = []
+        for _ in range(repeat):
+            shutil.rmtree(Path(folder) / '.afml', ignore_errors=True)
+            cold_times.append(time_command(load, 1, folder)['median'])
+        results['load_cold'] = summarize(cold_times)
+        results['load_warm'] = time_command(load, repeat, folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return results
+
+def bench_load(repeat=5, jobs=2000, steps=5) -> dict:
+    '''Time the parsing of a large project, and its loading from the project cache'''
+    from .afml import Project
+
+    with workspace() as folder:
+        project_file = generate_project(folder, jobs=jobs, steps=steps)
+        content = project_file.read_text(encoding='utf-8')
+        Project.load_cached(project_file)
+        return {
+            'jobs': jobs,
+            'steps': jobs * steps,
+            'loads': time_function(lambda: Project.loads(content), repeat),
+            'load_cached': time_function(lambda: Project.load_cached(project_file), repeat),
+        }
+
+def bench_matrix(repeat=5, size=10, depth=5, lookups=1000) -> dict:
+    '''Time the iteration, counting and random access of deep matrices, with and without rules'''
+    from .matrix import Matrix
+
+    entries = {f'axis{axis}': list(range(size)) for axis in range(depth)}
+    ruled = Matrix(
+        include=[{'axis0': size, 'extra': True}],
+        exclude=[{'axis0': 0}, {'axis1': 1, 'axis2': 2}],
+        **entries
+    )
+    results = {'instances': len(Matrix(**entries))}
+    for name, matrix in (('plain', Matrix(**entries)), ('rules', ruled)):
+        indices = random.Random(0).sample(range(len(matrix)), min(lookups, len(matrix)))
+        results[name] = {
+            'iterate': time_function(lambda: sum(1 for _ in matrix), repeat),
+            'len': time_function(lambda: len(matrix), repeat),
+            'getitem': time_function(lambda: [matrix[index] for index in indices], repeat),
+            'shard': time_function(lambda: sum(1 for _ in matrix.shard(3, 7)), repeat),
+        }
+    return results
+
+def _bench_params(count=20) -> dict:
+    params = {'base': 1, 'name': 'bench-{base}'}
+    for index in range(count):
+        params[f'value{index}'] = index
+        params[f'path{index}'] = f'out/{{name}}/{{value{index}}}/{index}'
+        params[f'list{index}'] = ['{name}', f'{{value{index}}}', index]
+    return params
+
+def bench_format(repeat=5, number=1000) -> dict:
+    '''Time ParamsFormatter updates with project and job params, and the formatting of step params'''
+    from .matrix import MatrixInstance
+    from .utils.format import ParamsFormatter
+
+    with workspace():
+        matrix = MatrixInstance(run=1)
+        project_params = _bench_params()
+        job_params = {'folder': 'out/{name}/{matrix.run}', 'epochs': '{value3}'}
+        step_params = {'output': '{folder}/{epochs}', 'nested': {'file': '{output}/model.pt'}}
+        formatter = ParamsFormatter(matrix=matrix)
+        formatter.update(project_params)
+        job_formatter = formatter.copy()
+        job_formatter.update(job_params)
+
+        def update():
+            ParamsFormatter(matrix=matrix).update(project_params)
+
+        return {
+            'update': time_function(update, repeat, number),
+            'copy_update': time_function(lambda: formatter.copy().update(job_params), repeat, number),
+            'format': time_function(lambda: job_formatter.format(step_params), repeat, number),
+        }
+
+def bench_context(repeat=5, number=1000) -> dict:
+    '''Time the creation of step contexts, their serialization and the lazy access to params'''
+    from .context import RunContext
+    from .dataset import Dataset
+    from .matrix import MatrixInstance
+    from .model import Model
+    from .utils.format import ParamsFormatter
+
+    with workspace():
+        project = SimpleNamespace(index=0, params=_bench_params())
+        job = SimpleNamespace(index=0, params={'folder': 'out/{name}/{matrix.run}'})
+        step = SimpleNamespace(index=0, params={'output': '{folder}/model.pt'})
+        dataset = Dataset('data', 'bench', {'split': 0.8})
+        model = Model('model.py:build', 'bench', {'size': '{value1}'})
+        # Formatted with the params of the project and job, as when running a step
+        formatter = ParamsFormatter(matrix=MatrixInstance(run=1))
+        formatter.update(project.params)
+        formatter.update(job.params)
+
+        create = lambda: RunContext(project, job, step, dataset, model, formatter)
+        ctx = create()
+        data = ctx.to_bytes()
+        return {
+            'bytes': len(data),
+            'create': time_function(create, repeat, number),
+            'dump': time_function(ctx.to_bytes, repeat, number),
+            'load_params': time_function(
+                lambda: RunContext.from_bytes(data).params, repeat, number
+            ),
+        }
+
+def bench_executor(repeat=3, number=10) -> dict:
+    '''Time the overhead of running no-op steps with each executor'''
+    from .context import RunContext
+    from .executor import get_executor
+    from .utils.format import ParamsFormatter
+
+    modes = {
+        'shell': {'shell': 'true'},
+        'python': {'python': 'noop.py'},
+        'python_worker': {'mode': 'python-worker', 'script': 'noop.py'},
+    }
+    pythonpath = os.environ.get('PYTHONPATH')
+    os.environ['PYTHONPATH'] = get_env()['PYTHONPATH']
+    try:
+        with workspace() as folder:
+            (folder / 'noop.py').write_text(
+                'from afml.context import run_ctx\nrun_ctx.params\n', encoding='utf-8'
+            )
+            project = SimpleNamespace(index=0, params={})
+            job = SimpleNamespace(index=0, params={})
+            step = SimpleNamespace(index=0, params={})
+            formatter = ParamsFormatter()
+
+            results = {}
+            for name, definition in modes.items():
+                executor = get_executor(definition)
+
+                def run_step():
+                    process = executor.start(
+                        RunContext(project, job, step, formatter=formatter), executor.format_vars(formatter)
+                    )
+                    for _ in process:
+                        pass
+                    if process.exit_code != 0:
+                        raise RuntimeError(f"The no-op step failed with the {name} executor")
+
+                # The first step starts the warm worker
+                run_step()
+                results[name] = time_function(run_step, repeat, number)
+            return results
+    finally:
+        if pythonpath is None:
+            os.environ.pop('PYTHONPATH', None)
+        else:
+            os.environ['PYTHONPATH'] = pythonpath
+
+BENCHMARKS: Dict[str, Callable[..., dict]] = {
+    'startup': bench_startup,
+    'load': bench_load,
+    'matrix': bench_matrix,
+    'format': bench_format,
+    'context': bench_context,
+    'executor': bench_executor,
+}
+
+def get_version() -> str:
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+        return version('afml')
+    except PackageNotFoundError:
+        return 'unknown'
+
+def run_benchmarks(names: List[str] = None, repeat=5) -> dict:
+    unknown = [name for name in names or [] if name not in BENCHMARKS]
+    if unknown:
+        raise LookupError(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    return {
+        'afml': get_version(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'benchmarks': {
+            name: BENCHMARKS[name](repeat=repeat)
+            for name in (names or BENCHMARKS)
+        }
+    }
+
+def compare(results: dict, baseline: dict, path: str = '') -> Dict[str, float]:
+    '''Ratios between the median times of the results and a baseline, by measure path'''
+    ratios = {}
+    for key, value in results.items():
+        other = baseline.get(key) if isinstance(baseline, dict) else None
+        if not isinstance(value, dict) or not isinstance(other, dict):
+            continue
+        if 'median' in value and 'median' in other and other['median'] > 0:
+            ratios[f'{path}{key}'] = value['per_op'] / other.get('per_op', other['median'])
+        else:
+            ratios.update(compare(value, other, f'{path}{key}.'))
+    return ratios
+
+def add_arguments(parser: ArgumentParser):
+    parser.add_argument(
+        'benchmarks', nargs='*',
+        help=f"Benchmarks to run: {', '.join(BENCHMARKS)}. All by default"
+    )
+    parser.add_argument(
+        '--repeat',
+        dest='repeat', type=int, default=5,
+        help="Number of times each measure is repeated"
+    )
+    parser.add_argument(
+        '-o', '--output',
+        dest='output_file',
+        help="Write the results to a JSON file instead of the standard output"
+    )
+    parser.add_argument(
+        '--compare',
+        dest='baseline_file',
+        help="JSON results of another version, printing the time ratio of each measure"
+    )
+
+def run(args):
+    results = run_benchmarks(args.benchmarks, args.repeat)
+
+    output = json.dumps(results, indent=2)
+    if args.output_file:
+        Path(args.output_file).write_text(output + '\n', encoding='utf-8')
+    elif not args.baseline_file:
+        print(output)
+
+    if args.baseline_file:
+        baseline = json.loads(Path(args.baseline_file).read_text(encoding='utf-8'))
+        print(f"Compared with afml {baseline.get('afml')} ({baseline.get('time')}), lower is faster:")
+        for measure, ratio in compare(results['benchmarks'], baseline.get('benchmarks', {})).items():
+            print(f"  {measure}: {ratio:.2f}x")
+
+def main(argv=None, prog='afml.bench'):
+    parser = ArgumentParser(prog)
+    add_arguments(parser)
+    run(parser.parse_args(argv))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from .context import RunContext
+from .dataset import Dataset
+from .executor import Executor
+from .model import Model
+from .utils.utils import Utils
+
+
+class LRUStore:
+    """
+    Folder of files bounded in size, evicting the least recently used ones
+    """
+
+    def __init__(self, folder, budget='1G'):
+        self.folder = Path(folder)
+        self.budget = Utils.parse_size(budget)
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        return self.folder / key[:2] / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        # The modification time keeps track of the last use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_file.name, path)
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the store fits its budget'''
+        with self._lock:
+            entries = []
+            for path in self.folder.glob('*/*'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            size = sum(entry[1] for entry in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self.budget:
+                    break
+                path.unlink(missing_ok=True)
+                size -= entry_size
+
+class StepCache(LRUStore):
+    """
+    Results of successful steps, keyed by everything that defines their execution
+    """
+    FOLDER = '.afml/cache'
+
+    def __init__(self, budget='1G', folder=FOLDER):
+        super().__init__(folder, budget)
+
+    @staticmethod
+    def _hash_file(path, digest):
+        try:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        except OSError:
+            digest.update(b'<missing>')
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, Dataset):
+            return {'dataset': str(value.folder), 'params': value.params}
+        if isinstance(value, Model):
+            return {
+                'model': f'{value.file}:{value.callable_name}',
+                'params': value.params
+            }
+        return repr(value)
+
+    @staticmethod
+    def get_key(executor: Executor, ctx: RunContext, kwargs: dict) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'executor': repr(executor),
+            'vars': kwargs,
+            'params': ctx.params,
+            'dataset': ctx.dataset,
+            'model': ctx.model,
+        }, sort_keys=True, default=StepCache._encode).encode('utf-8'))
+
+        for source in executor.get_sources():
+            StepCache._hash_file(source, digest)
+        if ctx.model is not None:
+            StepCache._hash_file(ctx.model.file, digest)
+        if ctx.dataset is not None:
+            digest.update(ctx.dataset.fingerprint().encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def get_result(self, key: str) -> Optional[dict]:
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def put_result(self, key: str, output: str):
+        self.put(key, json.dumps({
+            'time': time.time(),
+            'output': output
+        }).encode('utf-8'))
+
+class ModelCache(LRUStore):
+    """
+    Built models, keyed by the source of the model and the parameters used to build it
+    """
+    FOLDER = '.afml/models'
+    BUDGET = '2G'
+
+    _instance: Optional['ModelCache'] = None
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance() -> 'ModelCache':
+        with ModelCache._instance_lock:
+            if ModelCache._instance is None:
+                ModelCache._instance = ModelCache()
+            return ModelCache._instance
+
+    def __init__(self, budget=BUDGET, folder=FOLDER):
+        super().__init__(folder, budget)
+
+    @staticmethod
+    def get_key(model: Model, params: dict) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'callable': model.callable_name,
+            'params': params,
+        }, sort_keys=True, default=repr).encode('utf-8'))
+        StepCache._hash_file(model.file, digest)
+        return digest.hexdigest()
+
+    def build(self, model: Model, params: dict):
+        '''Load a copy of the model built with the given params, building and storing it if needed'''
+        key = ModelCache.get_key(model, params)
+        # The classes of the built object are defined in the model module
+        module = model.module
+        data = self.get(key)
+        if data is not None:
+            try:
+                return pickle.loads(data)
+            except Exception:
+                # Entries of a previous version of the model can't be loaded
+                pass
+
+        built = getattr(module, model.callable_name)(**params)
+        try:
+            data = pickle.dumps(built, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Objects that can't be pickled are just not cached
+            return built
+        self.put(key, data)
+        return built
@@ -0,0 +1,490 @@
+"""
+    Command line interface, importing the framework only once arguments are parsed
+"""
+import os
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import Tuple
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    try:
+        index, count = (int(value) for value in shard.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid shard '{shard}', expected 'i/N'") from None
+    if not 1 <= index <= count:
+        raise ArgumentTypeError(f"Invalid shard '{shard}', expected 1 <= i <= N")
+    return index - 1, count
+
+def main():
+    parser = ArgumentParser("AFML")
+    parser.add_argument(
+        '-p',
+        '--project',
+        dest='project_file',
+        help="Project file",
+        default="project.yml",
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="Run project jobs")
+    run_parser.add_argument(
+        '-j', '--job',
+        dest='job_name',  action='append',
+        help="Job to execute"
+    )
+    run_parser.add_argument(
+        '--jobs',
+        dest='workers', type=int,
+        help="Number of matrix instances to run in parallel. By default one, or as many as fit "
+             "the --cpus and --memory if steps declare their resources"
+    )
+    run_parser.add_argument(
+        '--cache',
+        dest='cache', action='store_true',
+        help="Skip steps whose last successful execution had the same inputs"
+    )
+    run_parser.add_argument(
+        '--cache-size',
+        dest='cache_size', default='1G',
+        help="Size budget of the step cache, such as 512M or 2G"
+    )
+
+    run_parser.add_argument(
+        '--shard',
+        dest='shard', type=parse_shard,
+        help="Run only the i-th of N disjoint slices of the matrix instances of every job, as 'i/N'"
+    )
+    run_parser.add_argument(
+        '--plan',
+        dest='plan_file', metavar='FILE',
+        help="Run a plan saved by 'afml plan --output', without formatting the project again"
+    )
+    run_parser.add_argument(
+        '--resume',
+        dest='resume', action='store_true',
+        help="Resume the last run, skipping the steps it completed"
+    )
+    run_parser.add_argument(
+        '--retry',
+        dest='retries', type=int, default=0, metavar='N',
+        help="Retry failed steps up to N times, waiting longer before every retry"
+    )
+    run_parser.add_argument(
+        '--dedupe',
+        dest='dedupe', action='store_true',
+        help="Run steps doing identical work in several matrix instances once, sharing their result. "
+             "Steps must not read matrix values that their params don't use"
+    )
+    run_parser.add_argument(
+        '--compress-logs',
+        dest='compress_logs', action='store_true',
+        help="Compress the log files of the steps with gzip"
+    )
+    run_parser.add_argument(
+        '--cpus',
+        dest='cpus', type=float,
+        help="CPUs shared by the steps that declare their resources, detected by default"
+    )
+    run_parser.add_argument(
+        '--memory',
+        dest='memory',
+        help="Memory shared by the steps that declare their resources, such as 64G, detected by default"
+    )
+    run_parser.add_argument(
+        '--distributed',
+        dest='distributed', nargs='?', const='', metavar='ADDRESS',
+        help="Hand out the steps to 'afml worker' agents connecting to this address, 127.0.0.1:7313 "
+             "by default. Use --jobs to run several matrix instances at once"
+    )
+    run_parser.add_argument(
+        '--token',
+        dest='token', default=os.environ.get('AFML_TOKEN'),
+        help="Token that workers must present, $AFML_TOKEN by default"
+    )
+
+    plan_parser = subparsers.add_parser(
+        'plan',
+        help="Format every step of the project without running it, showing or saving the plan"
+    )
+    plan_parser.add_argument(
+        '-j', '--job',
+        dest='job_name', action='append',
+        help="Job to plan"
+    )
+    plan_parser.add_argument(
+        '--shard',
+        dest='shard', type=parse_shard,
+        help="Plan only the i-th of N disjoint slices of the matrix instances of every job, as 'i/N'"
+    )
+    plan_parser.add_argument(
+        '--steps',
+        dest='steps', action='store_true',
+        help="List every planned step with its arguments"
+    )
+    plan_parser.add_argument(
+        '--dedupe',
+        dest='dedupe', action='store_true',
+        help="Count the steps that 'afml run --dedupe' would not run again"
+    )
+    plan_parser.add_argument(
+        '-o', '--output',
+        dest='output', metavar='FILE',
+        help="Save the plan as JSON, to be run with 'afml run --plan FILE'"
+    )
+
+    dataset_parser = subparsers.add_parser('dataset', help="Manage project datasets")
+    dataset_subparsers = dataset_parser.add_subparsers(dest='dataset_command')
+    index_parser = dataset_subparsers.add_parser(
+        'index',
+        help="Update the manifest of datasets files"
+    )
+    index_parser.add_argument(
+        'dataset_names', nargs='*',
+        help="Datasets names or folders, all the project datasets by default"
+    )
+    index_parser.add_argument(
+        '--no-hash',
+        dest='hashes', action='store_false',
+        help="Only scan files metadata, without hashing their contents"
+    )
+    index_parser.add_argument(
+        '--workers',
+        dest='workers', type=int,
+        help="Number of threads hashing files"
+    )
+
+    pack_parser = dataset_subparsers.add_parser(
+        'pack',
+        help="Pack datasets files into memory-mapped shards"
+    )
+    pack_parser.add_argument(
+        'dataset_names', nargs='*',
+        help="Datasets names or folders, all the project datasets by default"
+    )
+    pack_parser.add_argument(
+        '-o', '--output',
+        dest='output',
+        help="Folder of the packed dataset, '<folder>.packed' by default. Only for a single dataset"
+    )
+    pack_parser.add_argument(
+        '--shard-size',
+        dest='shard_size', default='256M',
+        help="Approximate size of each shard, such as 64M or 1G"
+    )
+    pack_parser.add_argument(
+        '--arrays',
+        dest='arrays', action='store_true',
+        help="Pack '.npy' files as arrays that can be read in place (requires NumPy)"
+    )
+    pack_parser.add_argument(
+        '--workers',
+        dest='workers', type=int,
+        help="Number of threads reading files"
+    )
+
+    stats_parser = subparsers.add_parser(
+        'stats',
+        help="Summarize the resources used by the steps of recorded runs"
+    )
+    stats_parser.add_argument(
+        'run', nargs='?',
+        help="Run to summarize, named by its start time. The last one by default"
+    )
+    stats_parser.add_argument(
+        '--all',
+        dest='all_runs', action='store_true',
+        help="Summarize all the recorded runs"
+    )
+    stats_parser.add_argument(
+        '-j', '--job',
+        dest='job_name', action='append',
+        help="Only summarize the steps of this job"
+    )
+    stats_parser.add_argument(
+        '--top',
+        dest='top', type=int, default=10,
+        help="Number of slowest executions to list"
+    )
+
+    runs_parser = subparsers.add_parser(
+        'runs',
+        help="Query the history of executed jobs and steps"
+    )
+    runs_subparsers = runs_parser.add_subparsers(dest='runs_command')
+    runs_list_parser = runs_subparsers.add_parser('list', help="List the last records")
+    runs_query_parser = runs_subparsers.add_parser(
+        'query',
+        help="List the records matching a filter, such as 'matrix.run=2 and metric.acc>0.9'"
+    )
+    runs_query_parser.add_argument(
+        'filter',
+        help="Comparisons (=, !=, <, <=, >, >=, ~) of record columns, params.*, matrix.* "
+             "or metric.*, combined with and, or, not and parentheses"
+    )
+    for runs_command_parser in (runs_list_parser, runs_query_parser):
+        runs_command_parser.add_argument(
+            '-c', '--column',
+            dest='columns', action='append',
+            help="Extra column to show, such as params.lr or metric.acc"
+        )
+        runs_command_parser.add_argument(
+            '--kind',
+            dest='kind', choices=('job', 'step'),
+            help="Only list job or step records"
+        )
+        runs_command_parser.add_argument(
+            '-n', '--limit',
+            dest='limit', type=int, default=20,
+            help="Maximum number of records to list, 0 for all"
+        )
+    runs_show_parser = runs_subparsers.add_parser('show', help="Show a record in detail")
+    runs_show_parser.add_argument('record_id', type=int, help="Id of the record")
+
+    logs_parser = subparsers.add_parser(
+        'logs',
+        help="Show or search the output of the steps of recorded runs"
+    )
+    logs_parser.add_argument(
+        'run', nargs='?',
+        help="Run whose logs to show, named by its start time. The last one by default"
+    )
+    logs_parser.add_argument(
+        '-j', '--job',
+        dest='job_name',
+        help="Only show the logs of the jobs matching this pattern, such as 'train*'"
+    )
+    logs_parser.add_argument(
+        '-s', '--step',
+        dest='step_name',
+        help="Only show the logs of the steps matching this pattern"
+    )
+    logs_parser.add_argument(
+        '-m', '--matrix',
+        dest='matrix',
+        help="Only show the logs of the matrix instances containing this text, such as 'lr=0.1', "
+             "or 'cfg.depth=3' for nested values"
+    )
+    logs_parser.add_argument(
+        '-n', '--lines',
+        dest='lines', type=int, default=20,
+        help="Number of last lines to show of every log, 0 for all"
+    )
+    logs_parser.add_argument(
+        '-g', '--grep',
+        dest='pattern',
+        help="Show the lines matching this regular expression instead"
+    )
+    logs_parser.add_argument(
+        '-i', '--ignore-case',
+        dest='ignore_case', action='store_true',
+        help="Match the --grep expression ignoring case"
+    )
+    logs_parser.add_argument(
+        '-f', '--follow',
+        dest='follow', action='store_true',
+        help="Keep printing the lines appended to the last modified log"
+    )
+
+    worker_parser = subparsers.add_parser(
+        'worker',
+        help="Run the steps of distributed runs, from the project folder"
+    )
+    worker_parser.add_argument(
+        'address', nargs='?',
+        help="Address of the coordinator, 127.0.0.1:7313 by default"
+    )
+    worker_parser.add_argument(
+        '--slots',
+        dest='slots', type=int, default=1,
+        help="Number of steps to run at once"
+    )
+    worker_parser.add_argument(
+        '--name',
+        dest='name',
+        help="Name of the worker, '<host>-<pid>' by default"
+    )
+    worker_parser.add_argument(
+        '--token',
+        dest='token', default=os.environ.get('AFML_TOKEN'),
+        help="Token of the coordinator, $AFML_TOKEN by default"
+    )
+    worker_parser.add_argument(
+        '--once',
+        dest='once', action='store_true',
+        help="Exit when the first run finishes, instead of waiting for the next one"
+    )
+
+    # The benchmarks parse their own arguments, so they are only imported when run
+    subparsers.add_parser(
+        'bench',
+        help="Benchmark the framework itself",
+        add_help=False
+    )
+
+    args, unknown_args = parser.parse_known_args()
+
+    if args.command == 'bench':
+        from . import bench
+        bench.main(unknown_args, prog='afml bench')
+        return
+
+    if args.command == 'worker':
+        # Workers only run the steps they receive, the project is not loaded
+        from termcolor import cprint
+        from .distributed import DistributedError, WorkerAgent
+        try:
+            WorkerAgent(args.address, args.token, args.slots, args.name, args.once).run()
+        except DistributedError as e:
+            cprint(f"ERROR: {e}", 'red')
+            sys.exit(1)
+        return
+
+    if args.command == 'runs':
+        # The history is queried without loading the project
+        from termcolor import cprint
+        from .history import History, HistoryReport, QueryError
+        if args.runs_command is None:
+            runs_parser.print_help()
+            return
+        if not os.path.isfile(History.FILE):
+            print("No runs were recorded")
+            return
+        report = HistoryReport(History())
+        try:
+            if args.runs_command == 'show':
+                report.show(args.record_id)
+            else:
+                report.table(
+                    report.history.query(
+                        args.filter if args.runs_command == 'query' else None,
+                        args.limit, args.kind
+                    ),
+                    args.columns
+                )
+        except (QueryError, LookupError) as e:
+            cprint(f"ERROR: {e}", 'red')
+            sys.exit(1)
+        return
+
+    if args.command == 'logs':
+        # Logs are read without loading the project
+        from .logs import LogViewer
+        viewer = LogViewer()
+        files = viewer.files(args.run, args.job_name, args.step_name, args.matrix)
+        if not files:
+            print("No logs were found")
+            return
+        if args.pattern:
+            if not viewer.grep(files, args.pattern, args.ignore_case):
+                sys.exit(1)
+            return
+        viewer.tail(files[-1:] if args.follow else files, args.lines)
+        if args.follow:
+            try:
+                viewer.follow(files[-1])
+            except KeyboardInterrupt:
+                pass
+        return
+
+    if args.command == 'stats':
+        # Summaries don't need to load the project
+        from .stats import RunStats
+        RunStats().show(args.run, args.all_runs, args.job_name, args.top)
+        return
+
+    if args.command == 'run' and args.plan_file and (args.job_name or args.shard):
+        parser.error("--plan runs the jobs and shard it was made with, --job and --shard can't be given")
+
+    from termcolor import cprint
+    from .afml import AFML
+    from .cache import StepCache
+    from .session import Session
+    from .history import History
+    from .journal import RunJournal
+    from .logs import RunLogs
+    from .plan import Plan, PlanError, StepDeduplicator
+    from .resources import ResourcePool
+    from .stats import RunRecorder
+    from .utils.time import Time
+
+    app = AFML(args.project_file)
+
+    if args.command == 'plan':
+        try:
+            plan = app.plan(args.job_name, Session(shard=args.shard))
+            plan.show(args.steps)
+            if args.dedupe:
+                print(
+                    f"Duplicates: {plan.count_duplicates()} of {plan.steps} step(s) "
+                    "do the same work as a previous one"
+                )
+            if args.output:
+                plan.save(args.output)
+                cprint(f"Plan saved to {args.output}", 'green')
+        except PlanError as e:
+            cprint(f"ERROR: {e}", 'red')
+            sys.exit(1)
+
+    elif args.command == 'run':
+        plan = None
+        if args.plan_file:
+            try:
+                plan = Plan.load(args.plan_file)
+            except PlanError as e:
+                cprint(f"ERROR: {e}", 'red')
+                sys.exit(1)
+            if plan.project != Plan.hash_project(args.project_file):
+                cprint("WARNING: The project file changed since the plan was made", 'yellow')
+            # Outputs were formatted with the time of the plan
+            Time.resume(plan.time)
+
+        # The journal restores the time of a resumed run, so it goes before anything reads it
+        journal = RunJournal(shard=args.shard)
+        if args.resume:
+            journal.resume(args.project_file, args.job_name)
+        else:
+            journal.start(args.project_file, args.job_name)
+
+        coordinator = None
+        if args.distributed is not None:
+            from .distributed import Coordinator
+            coordinator = Coordinator(args.distributed, args.token)
+            coordinator.listen()
+        session = Session(
+            cache=StepCache(args.cache_size) if args.cache else None,
+            shard=args.shard,
+            recorder=RunRecorder(),
+            history=History(),
+            # Distributed steps are limited by the slots of the workers instead
+            resources=ResourcePool(args.cpus, args.memory) if coordinator is None else None,
+            coordinator=coordinator,
+            journal=journal,
+            retries=args.retries,
+            logs=RunLogs(compress=args.compress_logs),
+            dedupe=StepDeduplicator() if args.dedupe else None
+        )
+        try:
+            if plan is None:
+                # Every step is formatted before the first one runs
+                plan = app.plan(args.job_name, session)
+            app.run_plan(plan, args.workers, session)
+        except PlanError as e:
+            cprint(f"ERROR: {e}", 'red')
+            sys.exit(1)
+        finally:
+            if coordinator is not None:
+                coordinator.close()
+            if session.dedupe is not None:
+                session.dedupe.report()
+
+    elif args.command == 'dataset':
+        if args.dataset_command == 'index':
+            app.index_datasets(args.dataset_names, args.hashes, args.workers)
+        elif args.dataset_command == 'pack':
+            if args.output and len(args.dataset_names) != 1:
+                parser.error("--output requires a single dataset")
+            app.pack_datasets(
+                args.dataset_names, args.output, args.shard_size, args.arrays, args.workers
+            )
+        else:
+            dataset_parser.print_help()
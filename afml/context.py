@@ -1,28 +1,90 @@
+"""
+    Context of a step, passed to its process through an inherited file descriptor.
+    The serialized context is a header line followed by independent sections,
+    which the step only decodes when they are accessed:
 
+        AFMLCTX <version>
+        {"id": ..., "sections": [[name, encoding, length], ...]}
+        <section bytes>...
+"""
+import itertools
+import json
+import os
 import pickle
-from argparse import ArgumentParser
-from pathlib import Path
+import sys
+import threading
+from typing import Dict, Optional, Tuple
 
-from munch import Munch, munchify
-
-from .utils.format import ParamsFormatter
-from .dataset import Dataset
-from .model import Model
+from .metrics import MetricsWriter
 
 
 class RunContext:
-    def __init__(self, project, job, step, dataset=None, model=None, formatter=ParamsFormatter()):
-        self.id = f"CTX-J{job.index}-S{step.index}"
+    MAGIC = b'AFMLCTX'
+    VERSION = 1
+    SECTIONS = ('params', 'dataset', 'model')
+
+    _ids = itertools.count()
+    # Identifies this invocation, so contexts of concurrent runs never collide
+    _invocation = f'{os.getpid():x}{os.urandom(2).hex()}'
+
+    def __init__(self, project, job, step, dataset=None, model=None, formatter=None):
+        if formatter is None:
+            from .utils.format import ParamsFormatter
+            formatter = ParamsFormatter()
+
+        self.id = f"CTX-J{job.index}-S{step.index}-{RunContext._invocation}-{next(RunContext._ids)}"
         self._params = None
-        self.project_params = formatter.format(project.params)
-        self.job_params = formatter.format(job.params)
-        self.step_params = formatter.format(step.params)
-        self.dataset : 'Dataset' = dataset
-        self.model : 'Model' = model.get_formatted(formatter) if model else None
+        self._matrix = None
+        self._sections: Dict[str, Tuple[str, bytes]] = {}
+        self._decoded = {
+            'params': {
+                'project': formatter.format(project.params),
+                'job': formatter.format(job.params),
+                'step': formatter.format(step.params),
+                'matrix': RunContext._plain(formatter.variables.get('matrix')),
+            },
+            'dataset': dataset,
+            'model': model.get_formatted(formatter) if model else None,
+        }
+
+    def _section(self, name: str):
+        '''Decoded content of a section, which is only decoded on its first access'''
+        if name not in self._decoded:
+            encoding, data = self._sections.pop(name, ('json', b'null'))
+            self._decoded[name] = RunContext._decode(encoding, data, name)
+        return self._decoded[name]
+
+    @property
+    def project_params(self) -> dict:
+        return self._section('params')['project']
+
+    @property
+    def job_params(self) -> dict:
+        return self._section('params')['job']
+
+    @property
+    def step_params(self) -> dict:
+        return self._section('params')['step']
+
+    @property
+    def matrix(self) -> Optional['MatrixInstance']:
+        if self._matrix is None and self._section('params')['matrix'] is not None:
+            from .matrix import MatrixInstance
+            self._matrix = MatrixInstance(**self._section('params')['matrix'])
+        return self._matrix
+
+    @property
+    def dataset(self) -> 'Dataset':
+        return self._section('dataset')
+
+    @property
+    def model(self) -> 'Model':
+        return self._section('model')
 
     @property
     def params(self) -> 'Munch':
         if self._params is None:
+            from munch import munchify
             self._params = munchify({
                 **self.project_params,
                 **self.job_params,
@@ -30,28 +92,197 @@ class RunContext:
             })
         return self._params
 
+    def log_metric(self, name: str, value, step: int = None):
+        '''Log a metric of the step, buffered and sent to afml in batches'''
+        MetricsWriter.get_instance().log(name, value, step)
+
+    def log_metrics(self, metrics: dict, step: int = None):
+        log = MetricsWriter.get_instance().log
+        for name, value in metrics.items():
+            log(name, value, step)
+
+    def flush_metrics(self):
+        '''Send the buffered metrics now, instead of waiting for the next batch'''
+        MetricsWriter.get_instance().flush()
+
+    @staticmethod
+    def _encode_object(value):
+        from .dataset import Dataset
+        from .model import Model
+        if isinstance(value, Dataset):
+            return {'__afml_dataset__': value.to_definition()}
+        if isinstance(value, Model):
+            return {'__afml_model__': value.to_definition()}
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    @staticmethod
+    def _decode_object(value: dict):
+        if len(value) == 1:
+            if '__afml_dataset__' in value:
+                from .dataset import Dataset
+                return Dataset.parse(value['__afml_dataset__'])
+            if '__afml_model__' in value:
+                from .model import Model
+                return Model.parse(value['__afml_model__'])
+        return value
+
+    @staticmethod
+    def _plain(matrix) -> Optional[dict]:
+        '''Matrix instance as plain dicts, which are wrapped again when accessed'''
+        if matrix is None:
+            return None
+        from munch import Munch
+        return Munch.toDict(matrix)
+
+    @staticmethod
+    def _is_json(value) -> bool:
+        '''Whether JSON decodes the value as it was: dicts with string keys, lists and scalars'''
+        from munch import Munch
+        from .dataset import Dataset
+        from .model import Model
+        if value is None or type(value) in (str, int, float, bool):
+            return True
+        if type(value) is list:
+            return all(RunContext._is_json(item) for item in value)
+        if type(value) in (dict, Munch):
+            return all(type(key) is str and RunContext._is_json(item) for key, item in value.items())
+        return isinstance(value, (Dataset, Model))
+
+    @staticmethod
+    def _encode(value) -> Tuple[str, bytes]:
+        # Parameters evaluated to tuples, sets or arbitrary objects would change in JSON
+        if RunContext._is_json(value):
+            try:
+                return 'json', json.dumps(
+                    value, default=RunContext._encode_object, separators=(',', ':')
+                ).encode('utf-8')
+            except (TypeError, ValueError):
+                pass
+        return 'pickle', pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _decode(encoding: str, data: bytes, section: str = None):
+        if encoding == 'json':
+            if section == 'params':
+                # Formatted parameters are munches, as returned by the formatter
+                from munch import Munch
+                return json.loads(data, object_hook=Munch)
+            return json.loads(data, object_hook=RunContext._decode_object)
+        if encoding == 'pickle':
+            return pickle.loads(data)
+        raise ValueError(f"Unknown context section encoding '{encoding}'")
+
+    def to_bytes(self) -> bytes:
+        # Sections that were never decoded are copied as they were received
+        sections = [
+            (name, *self._sections[name]) if name in self._sections
+            else (name, *RunContext._encode(self._section(name)))
+            for name in RunContext.SECTIONS
+        ]
+        header = json.dumps({
+            'id': self.id,
+            'sections': [[name, encoding, len(data)] for name, encoding, data in sections],
+        }, separators=(',', ':')).encode('utf-8')
+        return b''.join((
+            RunContext.MAGIC, b' ', str(RunContext.VERSION).encode('ascii'), b'\n',
+            header, b'\n',
+            *(data for _, _, data in sections)
+        ))
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'RunContext':
+        '''Read a serialized context, leaving its sections encoded until they are accessed'''
+        magic, _, rest = data.partition(b'\n')
+        if magic != RunContext.MAGIC + b' ' + str(RunContext.VERSION).encode('ascii'):
+            raise ValueError(f"Unsupported context format: {magic[:32]!r}")
+        header, _, body = rest.partition(b'\n')
+        header = json.loads(header)
+
+        ctx = RunContext.__new__(RunContext)
+        ctx.id = header['id']
+        ctx._params = None
+        ctx._matrix = None
+        ctx._decoded = {}
+        ctx._sections = {}
+        offset = 0
+        for name, encoding, length in header['sections']:
+            ctx._sections[name] = (encoding, body[offset:offset + length])
+            offset += length
+        return ctx
+
     def dump(self, file):
         with open(file, 'wb') as serialized_file:
-            pickle.dump(self, serialized_file)
+            serialized_file.write(self.to_bytes())
 
     @staticmethod
     def load(file) -> 'RunContext':
         with open(file, 'rb') as serialized_file:
-            return pickle.load(serialized_file)
+            return RunContext.from_bytes(serialized_file.read())
+
+    def send(self) -> int:
+        '''
+        Write the context to a pipe from a background thread, returning its read end.
+        The read end must be inherited by the step process, and closed by the caller
+        '''
+        data = self.to_bytes()
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(write_fd, view):]
+            except OSError:
+                # The step finished without reading its context
+                pass
+            finally:
+                os.close(write_fd)
+
+        threading.Thread(target=write, name=f'afml-{self.id}', daemon=True).start()
+        return read_fd
 
     @staticmethod
-    def get_current() -> 'RunContext':
-        parser = ArgumentParser(add_help=False)
-        parser.add_argument('--afml-context', type=Path, dest='afml_context_file')
+    def receive(fd: int) -> 'RunContext':
+        '''Read a context from an inherited file descriptor, closing it'''
+        chunks = []
         try:
-            args, _ = parser.parse_known_args()
-        except SystemExit:
-            return None
+            while True:
+                chunk = os.read(fd, 1 << 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        return RunContext.from_bytes(b''.join(chunks))
 
-        if not args.afml_context_file or not args.afml_context_file.is_file():
+    @staticmethod
+    def get_current() -> 'RunContext':
+        # Parsed by hand, to avoid importing argparse in every step
+        argv = sys.argv[1:]
+        location = None
+        for index, arg in enumerate(argv):
+            if arg == '--afml-context' and index + 1 < len(argv):
+                location = argv[index + 1]
+            elif arg.startswith('--afml-context='):
+                location = arg.split('=', 1)[1]
+        if not location:
             return None
 
-        return RunContext.load(args.afml_context_file)
+        # The context is sent through a file descriptor, 'fd:<number>', or written to a file
+        if location.startswith('fd:'):
+            try:
+                return RunContext.receive(int(location[3:]))
+            except (ValueError, OSError):
+                return None
+
+        if not os.path.isfile(location):
+            return None
+        return RunContext.load(location)
 
 
-run_ctx = RunContext.get_current()
+def __getattr__(name):
+    # The current context is only loaded when a step script imports it
+    if name == 'run_ctx':
+        globals()['run_ctx'] = RunContext.get_current()
+        return globals()['run_ctx']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
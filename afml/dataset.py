@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Callable, Iterator, List, Optional
 
 from .base import BaseObject
 
@@ -17,6 +18,11 @@ class Dataset(BaseObject):
     def __init__(self, folder, name: str = None, params: dict = None):
         super().__init__(name, params)
         self._folder = folder
+        self._packed = None
+
+    def __getstate__(self):
+        # The memory maps of packed datasets are opened again when needed
+        return {**self.__dict__, '_packed': None}
 
     @property
     def name(self) -> str:
@@ -26,6 +32,83 @@ class Dataset(BaseObject):
     def folder(self) -> Path:
         return Path(self._folder)
 
+    @property
+    def packed(self) -> 'Optional[PackedDataset]':
+        '''Packed dataset in the folder, or None for folders of regular files'''
+        if self._packed is None:
+            from .pack import PackedDataset
+            self._packed = PackedDataset(self.folder) if PackedDataset.is_packed(self.folder) else False
+        return self._packed or None
+
+    def iter_names(self, shuffle: bool = False, seed=None) -> Iterator[str]:
+        '''Lazily yield the paths of the dataset files relative to its folder, shuffled if requested'''
+        from .loader import DataLoader
+        if self.packed is not None:
+            return DataLoader.order(self.packed.names(), shuffle, seed)
+        return DataLoader.order((name for name, _ in DataLoader.walk(self.folder)), shuffle, seed)
+
+    def iter_files(self, shuffle: bool = False, seed=None) -> Iterator[Path]:
+        '''Lazily yield the files of the dataset, which must not be packed'''
+        from .loader import DataLoader
+        if self.packed is not None:
+            from .pack import PackedDatasetError
+            raise PackedDatasetError(
+                f"The dataset '{self.name}' is packed, its files are read with iter_names() and read()"
+            )
+        return DataLoader.iter_files(self.folder, shuffle, seed)
+
+    def read(self, name: str) -> 'bytes | memoryview':
+        '''Content of a dataset file, which is a view of the shard in packed datasets'''
+        if self.packed is not None:
+            return self.packed.read(name)
+        from .loader import DataLoader
+        return DataLoader.read_file(self.folder / name)
+
+    def array(self, name: str):
+        '''NumPy array of a '.npy' dataset file, read in place when the dataset was packed with arrays'''
+        if self.packed is not None:
+            return self.packed.array(name)
+        import numpy as np
+        return np.load(self.folder / name, allow_pickle=False)
+
+    def batches(
+        self,
+        size: int,
+        transform: Callable[[str, object], object] = None,
+        workers: int = None,
+        prefetch: int = 2,
+        shuffle: bool = False,
+        seed=None,
+        drop_last: bool = False
+    ) -> Iterator[List]:
+        '''
+        Yield batches of the dataset files, read in a thread pool.
+        Each item is the content of a file, or 'transform(name, content)' if given.
+        The following 'prefetch' batches are read ahead while the current one is used
+        '''
+        from .loader import DataLoader
+        return DataLoader.batches(
+            self.iter_names(shuffle, seed), self.read, size, transform, workers, prefetch, drop_last
+        )
+
+    def manifest(self) -> 'DatasetManifest':
+        from .manifest import DatasetManifest
+        return DatasetManifest(self.folder)
+
+    def fingerprint(self, workers: int = None) -> str:
+        '''Hash of the dataset files, updating its manifest incrementally'''
+        manifest = self.manifest()
+        manifest.update(workers=workers)
+        return manifest.fingerprint()
+
+    def to_definition(self) -> dict:
+        '''Definition of the dataset, as accepted by Dataset.parse'''
+        return {
+            'folder': str(self._folder),
+            'name': super().name,
+            'params': dict(self.params),
+        }
+
     @staticmethod
     def parse(definition: dict):
         if 'folder' not in definition:
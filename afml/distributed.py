@@ -0,0 +1,404 @@
+"""
+    Distributed runs, whose steps are executed by worker agents connected to the coordinator over TCP.
+    Workers run the steps from the same project folder, so the project files must be shared or synced.
+    Messages are JSON lines:
+
+        worker      -> coordinator  {"type": "hello", "name", "slots", "token"}
+        coordinator -> worker       {"type": "run", "id", "executor", "kwargs", "context"}
+        worker      -> coordinator  {"type": "output", "id", "text", "stream", "progress"}
+        worker      -> coordinator  {"type": "exit", "id", "exit_code", "usage", "metrics"}
+        coordinator -> worker       {"type": "bye"} or {"type": "error", "message"}
+        both                        {"type": "ping"}
+"""
+import base64
+import hmac
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from termcolor import cprint
+
+from .context import RunContext
+from .executor import Executor, get_executor
+from .metrics import MetricsCollector
+from .process import Output
+
+
+class DistributedError(RuntimeError): ...
+
+DEFAULT_ADDRESS = '127.0.0.1:7313'
+# Seconds between pings, peers silent for three of them are considered lost
+HEARTBEAT = 5.0
+MAX_MESSAGE = 1 << 30
+
+def parse_address(address: Optional[str]) -> Tuple[str, int]:
+    '''Parse 'host:port', ':port' or 'port' addresses, or the default one if empty'''
+    host, _, port = str(address or DEFAULT_ADDRESS).rpartition(':')
+    try:
+        return host.strip('[]') or '127.0.0.1', int(port)
+    except ValueError:
+        raise DistributedError(f"Invalid address '{address}', expected 'host:port'") from None
+
+class Connection:
+    """
+    Socket exchanging JSON messages, which can be sent from any thread
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.socket.settimeout(HEARTBEAT * 3)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = sock.makefile('rb')
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message: dict):
+        data = json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            self.socket.sendall(data)
+
+    def receive(self) -> Optional[dict]:
+        '''Next message, or None once the connection is closed or the peer is silent'''
+        try:
+            line = self._file.readline(MAX_MESSAGE)
+        except OSError:
+            return None
+        if not line:
+            return None
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._file.close()
+        self.socket.close()
+
+    def ping(self):
+        '''Ping the peer until the connection is closed'''
+        while not self.closed:
+            time.sleep(HEARTBEAT)
+            try:
+                self.send({'type': 'ping'})
+            except OSError:
+                return
+
+class RemoteExecution:
+    """
+    Step sent to the workers, behaving like the executions of local executors
+    """
+
+    def __init__(self, message: dict):
+        self.id = message['id']
+        self.message = message
+        self.attempts = 0
+        self.exit_code = None
+        self.usage = {}
+        self.metrics = MetricsCollector()
+        self._queue = queue.SimpleQueue()
+
+    def __iter__(self) -> Iterator[Output]:
+        while True:
+            output = self._queue.get()
+            if output is None:
+                break
+            yield output
+        return self.exit_code
+
+    def output(self, text: str, stream: str = Output.STDERR, progress: bool = False):
+        self._queue.put(Output(text, stream, progress))
+
+    def finish(self, exit_code: int, usage: dict = None, metrics: dict = None):
+        self.exit_code = exit_code
+        self.usage = usage or {}
+        self.metrics.metrics = metrics or {}
+        self._queue.put(None)
+
+class RemoteWorker:
+    def __init__(self, connection: Connection, name: str, slots: int):
+        self.connection = connection
+        self.name = name
+        self.slots = slots
+        self.running: Dict[int, RemoteExecution] = {}
+
+    @property
+    def free_slots(self) -> int:
+        return self.slots - len(self.running)
+
+class Coordinator:
+    """
+    Hand out the steps of a run to the connected workers, re-queueing the ones of lost workers
+    """
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, address: str = None, token: str = None):
+        self.host, self.port = parse_address(address)
+        self.token = token
+        self._listener: Optional[socket.socket] = None
+        self._workers: List[RemoteWorker] = []
+        self._pending: deque = deque()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._closed = False
+
+    def listen(self):
+        self._listener = socket.create_server((self.host, self.port))
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        cprint(f"Coordinator listening on {self.host}:{self.port}", 'cyan')
+        if not self.token and self.host not in ('127.0.0.1', 'localhost', '::1'):
+            cprint("WARNING: Workers are accepted without a token", 'yellow')
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(Connection(sock),), daemon=True).start()
+
+    def _serve(self, connection: Connection):
+        hello = connection.receive()
+        if not hello or hello.get('type') != 'hello':
+            connection.close()
+            return
+        if self.token and not hmac.compare_digest(
+            str(hello.get('token') or '').encode('utf-8'), self.token.encode('utf-8')
+        ):
+            Coordinator._reject(connection, "Invalid token")
+            return
+        try:
+            slots = max(1, int(hello.get('slots') or 1))
+        except (TypeError, ValueError):
+            Coordinator._reject(connection, f"Invalid slots '{hello.get('slots')}'")
+            return
+
+        worker = RemoteWorker(connection, str(hello.get('name')), slots)
+        with self._lock:
+            if self._closed:
+                connection.close()
+                return
+            self._workers.append(worker)
+        cprint(f"Worker {worker.name} connected with {worker.slots} slot(s)", 'cyan')
+        threading.Thread(target=connection.ping, daemon=True).start()
+        self._dispatch()
+
+        while True:
+            message = connection.receive()
+            if message is None:
+                break
+            if message.get('type') == 'output':
+                execution = worker.running.get(message['id'])
+                if execution is not None:
+                    execution.output(message['text'], message['stream'], message['progress'])
+            elif message.get('type') == 'exit':
+                with self._lock:
+                    execution = worker.running.pop(message['id'], None)
+                if execution is not None:
+                    execution.finish(message['exit_code'], message.get('usage'), message.get('metrics'))
+                self._dispatch()
+
+        self._lost(worker)
+
+    @staticmethod
+    def _reject(connection: Connection, message: str):
+        '''Reply to a worker that is not accepted and close its connection'''
+        try:
+            connection.send({'type': 'error', 'message': message})
+        except OSError:
+            pass
+        connection.close()
+
+    def _lost(self, worker: RemoteWorker):
+        '''Re-queue the steps of a worker whose connection was lost'''
+        with self._lock:
+            if worker not in self._workers:
+                return
+            self._workers.remove(worker)
+            executions = list(worker.running.values())
+            worker.running.clear()
+            for execution in reversed(executions):
+                if self._closed or execution.attempts >= Coordinator.MAX_ATTEMPTS:
+                    execution.output(f"ERROR: Worker {worker.name} was lost, the step is not retried\n")
+                    execution.finish(1)
+                else:
+                    execution.output(f"WARNING: Worker {worker.name} was lost, re-queueing the step\n")
+                    self._pending.appendleft(execution)
+        worker.connection.close()
+        if not self._closed:
+            cprint(f"Worker {worker.name} disconnected", 'yellow')
+        self._dispatch()
+
+    def _dispatch(self):
+        '''Send the pending steps to the workers with free slots, the least loaded first'''
+        assignments = []
+        with self._lock:
+            while self._pending:
+                worker = max(
+                    (worker for worker in self._workers if worker.free_slots > 0),
+                    key=lambda worker: worker.free_slots, default=None
+                )
+                if worker is None:
+                    break
+                execution = self._pending.popleft()
+                execution.attempts += 1
+                worker.running[execution.id] = execution
+                assignments.append((worker, execution))
+
+        for worker, execution in assignments:
+            try:
+                worker.connection.send(execution.message)
+            except OSError:
+                self._lost(worker)
+
+    def start(self, executor: Executor, ctx: RunContext, kwargs: dict) -> RemoteExecution:
+        '''Queue a step, returning its execution'''
+        execution = RemoteExecution({
+            'type': 'run',
+            'id': next(self._ids),
+            'executor': executor.to_definition(),
+            'kwargs': kwargs,
+            'context': base64.b64encode(ctx.to_bytes()).decode('ascii'),
+        })
+        with self._lock:
+            self._pending.append(execution)
+        self._dispatch()
+        with self._lock:
+            if execution in self._pending:
+                execution.output("Waiting for a worker\n")
+        return execution
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+            pending = list(self._pending)
+            self._pending.clear()
+        if self._listener is not None:
+            self._listener.close()
+        for execution in pending:
+            execution.finish(1)
+        for worker in workers:
+            try:
+                worker.connection.send({'type': 'bye'})
+            except OSError:
+                pass
+            worker.connection.close()
+
+class WorkerAgent:
+    """
+    Daemon running the steps handed out by the coordinators it connects to
+    """
+
+    def __init__(
+        self,
+        address: str = None,
+        token: str = None,
+        slots: int = 1,
+        name: str = None,
+        once: bool = False
+    ):
+        self.host, self.port = parse_address(address)
+        self.token = token
+        self.slots = max(1, slots)
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.once = once
+
+    def _connect(self) -> Connection:
+        '''Connect to the coordinator, waiting until it is listening'''
+        waiting = False
+        while True:
+            try:
+                return Connection(socket.create_connection((self.host, self.port), timeout=HEARTBEAT))
+            except OSError:
+                if not waiting:
+                    cprint(f"Waiting for a coordinator at {self.host}:{self.port}", 'cyan')
+                    waiting = True
+                time.sleep(1)
+
+    def run(self):
+        while True:
+            connection = self._connect()
+            try:
+                self._serve(connection)
+            finally:
+                connection.close()
+            if self.once:
+                return
+            # Give the coordinator time to stop listening, before waiting for the next one
+            time.sleep(1)
+
+    def _serve(self, connection: Connection):
+        connection.send({'type': 'hello', 'name': self.name, 'slots': self.slots, 'token': self.token})
+        cprint(f"Connected to {self.host}:{self.port} as {self.name}", 'green')
+        threading.Thread(target=connection.ping, daemon=True).start()
+
+        while True:
+            message = connection.receive()
+            if message is None:
+                cprint("Connection to the coordinator lost", 'yellow')
+                return
+            if message.get('type') == 'run':
+                threading.Thread(target=self._run, args=(connection, message), daemon=True).start()
+            elif message.get('type') == 'bye':
+                cprint("Run finished", 'green')
+                return
+            elif message.get('type') == 'error':
+                raise DistributedError(f"Rejected by the coordinator: {message.get('message')}")
+
+    def _run(self, connection: Connection, message: dict):
+        '''Run a step, streaming its output. Steps whose coordinator is lost are killed on their next output'''
+        execution_id = message['id']
+        outputs = None
+        try:
+            executor = get_executor(message['executor'])
+            if executor is None:
+                raise DistributedError(f"Unknown executor {message['executor']}")
+            ctx = RunContext.from_bytes(base64.b64decode(message['context']))
+            cprint(f"Running {executor} ({ctx.id})", 'cyan')
+
+            execution = Executor.ExecutionWrapper(executor.run(ctx, **message['kwargs']))
+            outputs = iter(execution)
+            for output in outputs:
+                connection.send({
+                    'type': 'output', 'id': execution_id,
+                    'text': str(output), 'stream': output.stream, 'progress': output.progress,
+                })
+            connection.send({
+                'type': 'exit', 'id': execution_id,
+                'exit_code': int(execution.exit_code),
+                'usage': execution.usage,
+                'metrics': execution.metrics.metrics if execution.metrics else {},
+            })
+        except OSError:
+            # The coordinator is gone, the step will be re-queued to another worker
+            pass
+        except Exception:
+            try:
+                connection.send({
+                    'type': 'output', 'id': execution_id,
+                    'text': traceback.format_exc(), 'stream': Output.STDERR, 'progress': False,
+                })
+                connection.send({'type': 'exit', 'id': execution_id, 'exit_code': 1})
+            except OSError:
+                pass
+        finally:
+            if outputs is not None:
+                outputs.close()
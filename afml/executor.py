@@ -1,8 +1,12 @@
 import os
-import subprocess
+import shlex
 from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List
 
 from .context import RunContext
+from .metrics import MetricsCollector
+from .process import Output, Process
 from .utils.format import ParamsFormatter
 
 
@@ -11,6 +15,7 @@ def get_executor(definition: dict) -> 'Executor':
         executor = {
             'python': PythonExecutor,
             'python-module': PythonExecutor,
+            'python-worker': PythonExecutor,
             'shell': ShellExecutor
         }.get(definition['mode'], None)
         if executor is None:
@@ -54,9 +59,17 @@ class Executor(ABC):
         def __init__(self, executor_run):
             self.run_func = executor_run
             self.exit_code = False
-        
+            self.usage = {}
+            self.metrics = None
+
         def __iter__(self):
-            self.exit_code = yield from self.run_func
+            # Executors return the exit code, or the finished process to report its usage
+            result = yield from self.run_func
+            if isinstance(result, Process):
+                self.usage = result.usage
+                self.metrics = result.metrics
+                result = result.exit_code
+            self.exit_code = result
             return self.exit_code
 
     def __init__(self, **formatable_vars):
@@ -79,11 +92,27 @@ class Executor(ABC):
     @abstractmethod
     def run(self, ctx: RunContext, **kwargs): ...
 
-    def start(self, ctx: RunContext, formatter: ParamsFormatter):
-        return Executor.ExecutionWrapper(self.run(
-            ctx,
-            **formatter.format(self._formatable_vars)
-        ))
+    @abstractmethod
+    def to_definition(self) -> dict:
+        '''Definition that 'get_executor' parses into an equivalent executor'''
+
+    def get_sources(self) -> List[Path]:
+        '''Files whose content defines what the executor runs'''
+        return []
+
+    def format_vars(self, formatter: ParamsFormatter) -> dict:
+        return formatter.format(self._formatable_vars)
+
+    def start(self, ctx: RunContext, kwargs: dict):
+        '''Run with the variables given by format_vars'''
+        return Executor.ExecutionWrapper(self.run(ctx, **kwargs))
+
+    @staticmethod
+    def stream(command: str):
+        '''Run a shell command yielding its output, and return the finished process'''
+        process = Process.spawn(command)
+        yield from process
+        return process
 
 class PythonExecutor(Executor):
     DEFAULT_INTERPRETER = 'python'
@@ -92,7 +121,9 @@ class PythonExecutor(Executor):
         self,
         script: str,
         as_module: bool = False,
-        interpreter=DEFAULT_INTERPRETER
+        interpreter=DEFAULT_INTERPRETER,
+        worker: bool = False,
+        preload: List[str] = None
     ):
         Executor.__init__(self)
         if as_module and script.startswith('-m'):
@@ -104,12 +135,15 @@ class PythonExecutor(Executor):
 
         self.as_module = as_module
         self.interpreter = interpreter
+        # Run in a process forked from a warm worker, which imported the preloaded modules
+        self.worker = worker
+        self.preload = preload or []
 
     @staticmethod
     def parse(definition):
         # Check that this is the selected executor
         mode = definition.get('mode', 'auto')
-        if mode not in ('auto', 'python', 'python-module'):
+        if mode not in ('auto', 'python', 'python-module', 'python-worker'):
             #raise Error
             return None
 
@@ -127,18 +161,26 @@ class PythonExecutor(Executor):
         interpreter = str(definition.get('python-interpreter',
                                          PythonExecutor.DEFAULT_INTERPRETER))
 
+        # The 'python-worker' mode reuses warm workers, with optional preloaded modules
+        worker = mode == 'python-worker'
+        preload = definition.get('python-preload') or []
+        if isinstance(preload, str):
+            preload = preload.split(',')
+        preload = [str(module).strip() for module in preload]
+
         # The 'python' key is allowed in any mode
         if 'python' in definition:
             script = str(definition['python'])
             return PythonExecutor(script,
                                   mode == 'python-module',
-                                  interpreter)
+                                  interpreter,
+                                  worker, preload)
 
         # The 'python-module' key will enfoce to run the
         # script as a module, no matter what mode is selected
         if 'python-module' in definition:
             module = str(definition['python-module'])
-            return PythonExecutor(module, True, interpreter)
+            return PythonExecutor(module, True, interpreter, worker, preload)
 
         # The 'script' key is generic. The module detection
         # depends on 'mode', the '-m' preffix and the 'script'
@@ -149,15 +191,15 @@ class PythonExecutor(Executor):
                 mode == 'python-module'
                 or script.startswith('-m')
                 or (
-                    mode == 'auto'
+                    mode in ('auto', 'python-worker')
                     and not script.endswith('.py')
                     and '/' not in script
                     and '\\' not in script
                 )
             ):
-                return PythonExecutor(script, True, interpreter)
+                return PythonExecutor(script, True, interpreter, worker, preload)
 
-            return PythonExecutor(script, False, interpreter)
+            return PythonExecutor(script, False, interpreter, worker, preload)
 
         #raise Error
         return None
@@ -167,7 +209,8 @@ class PythonExecutor(Executor):
             "Python("
             f"{'module' if self.as_module else 'script'}="
             f"{self.script}, "
-            f"interpreter={self.interpreter})"
+            f"interpreter={self.interpreter}"
+            f"{', worker=True' if self.worker else ''})"
         )
 
     def __str__(self):
@@ -175,31 +218,97 @@ class PythonExecutor(Executor):
             return f"{self.interpreter} {self.script}"
         return self.script
 
+    def to_definition(self) -> dict:
+        if self.worker:
+            mode = 'python-worker'
+        else:
+            mode = 'python-module' if self.as_module else 'python'
+        return {
+            'mode': mode,
+            'script': f'-m {self.script}' if self.as_module else self.script,
+            'python-interpreter': self.interpreter,
+            'python-preload': list(self.preload),
+        }
+
+    def get_sources(self) -> List[Path]:
+        if not self.as_module:
+            return [Path(self.script)]
+
+        # Find the module file without importing its packages
+        module_path = Path(*self.script.split('.'))
+        for path in (module_path.with_suffix('.py'), module_path / '__init__.py'):
+            if path.is_file():
+                return [path]
+        return []
+
     def run(self, ctx: RunContext, **kwargs):
-        context_file = f".afml/{ctx.id}.pickle"
-        ctx.dump(context_file)
-
-        with subprocess.Popen(
-            ' '.join((
-                self.interpreter,
-                '-m' if self.as_module else '',
-                f'"{self.script}"',
-                f'--afml-context "{context_file}"'
-            )),
-            shell=True,
-            cwd=os.getcwd(),
-            stderr=subprocess.PIPE,
-        ) as proc:
-            while True:
-                output = proc.stderr.readline()
-                if output:
-                    yield output.decode('utf-8', errors='replace')
-
-                if proc.poll() is not None:
-                    break
-
-            os.remove(context_file)
-            return proc.poll()
+        # Without inheritable descriptors (Windows) the context is written to a file
+        if os.name == 'nt':
+            context_file = f".afml/{ctx.id}.ctx"
+            ctx.dump(context_file)
+            try:
+                return (yield from Executor.stream(self._command(f'"{context_file}"')))
+            finally:
+                os.remove(context_file)
+
+        # The step reads its context and writes its metrics through inherited pipes
+        context_fd = ctx.send()
+        metrics_read, metrics_write = os.pipe()
+        try:
+            streams = {MetricsCollector.STREAM: os.fdopen(metrics_read, 'rb')}
+        except BaseException:
+            os.close(metrics_read)
+            os.close(metrics_write)
+            os.close(context_fd)
+            raise
+
+        try:
+            process = None
+            if self.worker:
+                process = yield from self._spawn_worker(context_fd, metrics_write, streams)
+
+            if process is None:
+                process = Process.spawn(
+                    self._command(f'fd:{context_fd}', f'fd:{metrics_write}'),
+                    streams,
+                    pass_fds=(context_fd, metrics_write)
+                )
+        except BaseException:
+            streams[MetricsCollector.STREAM].close()
+            raise
+        finally:
+            os.close(context_fd)
+            os.close(metrics_write)
+
+        yield from process
+        return process
+
+    def _command(self, context: str, metrics: str = None) -> str:
+        return ' '.join((
+            self.interpreter,
+            '-m' if self.as_module else '',
+            f'"{self.script}"',
+            f'--afml-context {context}',
+            f'--afml-metrics {metrics}' if metrics else ''
+        ))
+
+    def _spawn_worker(self, context_fd: int, metrics_fd: int, streams: dict):
+        '''Fork the step from a warm worker, or yield a warning and return None if not possible'''
+        from .forkserver import ForkServer, ForkServerError
+
+        if not ForkServer.is_supported():
+            yield Output("WARNING: Python workers are not supported in this platform\n")
+            return None
+
+        try:
+            server = ForkServer.get(self.interpreter, self.preload)
+            return server.spawn(self.script, self.as_module, {
+                '--afml-context': context_fd,
+                '--afml-metrics': metrics_fd,
+            }, streams)
+        except (OSError, ForkServerError) as e:
+            yield Output(f"WARNING: Python worker not available, {e}\n")
+            return None
 
 class ShellExecutor(Executor):
     def __init__(self, command: str, args: str = ''):
@@ -247,19 +356,21 @@ class ShellExecutor(Executor):
     def __str__(self):
         return self.command.strip().split(' ')[0]
 
+    def to_definition(self) -> dict:
+        return {
+            'mode': 'shell',
+            'command': self.command,
+            'shell-args': self._formatable_vars['args'],
+        }
+
+    def get_sources(self) -> List[Path]:
+        try:
+            program = shlex.split(self.command)[0]
+        except (ValueError, IndexError):
+            return []
+        return [Path(program)] if os.path.isfile(program) else []
+
     def run(self, ctx: RunContext, **kwargs):
-        with subprocess.Popen(
-            ' '.join((self.command, kwargs.get('args', ''))),
-            shell=True,
-            cwd=os.getcwd(),
-            stderr=subprocess.PIPE,
-        ) as proc:
-            while True:
-                output = proc.stderr.readline()
-                if output:
-                    yield output.decode('utf-8', errors='replace')
-
-                if proc.poll() is not None:
-                    break
-
-            return proc.poll()
+        return (yield from Executor.stream(
+            ' '.join((self.command, kwargs.get('args', '')))
+        ))
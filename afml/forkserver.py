@@ -0,0 +1,298 @@
+"""
+    Warm Python workers, forking steps from a server that already imported heavy modules.
+    The server is started with 'python -m afml.forkserver <socket> [modules...]'
+"""
+import atexit
+import importlib
+import json
+import os
+import runpy
+import selectors
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+from typing import Dict, IO, List, Tuple
+
+from .process import Output, Process, ResourceUsage
+
+
+class ForkServerError(RuntimeError): ...
+
+class WorkerProcess(Process):
+    """
+    Step forked by a fork server, whose exit code is reported through its connection
+    """
+
+    def __init__(
+        self,
+        connection: socket.socket,
+        reply: IO[bytes],
+        pid: int,
+        streams: Dict[str, IO[bytes]]
+    ):
+        self.pid = pid
+        self._connection = connection
+        self._reply = reply
+        self._exit_code = None
+        super().__init__(None, streams)
+
+    def wait(self) -> int:
+        if self._exit_code is None:
+            with self._connection, self._reply:
+                line = self._reply.readline()
+            # A server that died can't report the exit code
+            reply = json.loads(line) if line else {'exit_code': 1}
+            self._exit_code = reply['exit_code']
+            self.usage = reply.get('usage', {})
+        return self._exit_code
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+class ForkServer:
+    """
+    Server process that imports a list of modules once, and forks a child for every step
+    """
+    _servers: Dict[Tuple[str, Tuple[str, ...]], 'ForkServer'] = {}
+    _servers_lock = threading.Lock()
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(os, 'fork') and hasattr(socket, 'send_fds')
+
+    @staticmethod
+    def get(interpreter: str, preload: List[str] = None) -> 'ForkServer':
+        '''Get the running server for an interpreter and its preloaded modules'''
+        key = (interpreter, tuple(preload or ()))
+        with ForkServer._servers_lock:
+            server = ForkServer._servers.get(key)
+            if server is None or server.popen.poll() is not None:
+                server = ForkServer._servers[key] = ForkServer(*key)
+            return server
+
+    def __init__(self, interpreter: str, preload: Tuple[str, ...] = ()):
+        self.folder = tempfile.mkdtemp(prefix='afml-forkserver-')
+        self.socket_path = os.path.join(self.folder, 'socket')
+        # The server exits when its stdin is closed, so it doesn't outlive this process.
+        # Its children inherit its environment, so their output is unbuffered as for fresh processes
+        self.popen = subprocess.Popen(
+            ' '.join((
+                interpreter, '-m', 'afml.forkserver',
+                f'"{self.socket_path}"', *preload
+            )),
+            shell=True,
+            cwd=os.getcwd(),
+            env=Process.get_env(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        while True:
+            line = self.popen.stdout.readline()
+            if line == b'ready\n':
+                break
+            if not line:
+                self.close()
+                raise ForkServerError(f"Fork server for '{interpreter}' failed to start")
+        atexit.register(self.close)
+
+    def close(self):
+        if self.popen.poll() is None:
+            self.popen.stdin.close()
+            self.popen.wait()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def spawn(
+        self,
+        script: str,
+        as_module: bool,
+        fd_args: Dict[str, int] = None,
+        streams: Dict[str, IO[bytes]] = None
+    ) -> WorkerProcess:
+        '''
+        Fork a child running a script or module. Every descriptor of 'fd_args'
+        is sent to the child, and given to the script as '<arg> fd:<number>'
+        '''
+        fd_args = fd_args or {}
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+            socket.send_fds(connection, [json.dumps({
+                'script': script,
+                'as_module': as_module,
+                'cwd': os.getcwd(),
+                'fd_args': list(fd_args),
+            }).encode('utf-8')], [stdout_write, stderr_write, *fd_args.values()])
+            reply = connection.makefile('rb')
+            line = reply.readline()
+            if not line:
+                raise ForkServerError("Fork server closed the connection")
+            pid = json.loads(line)['pid']
+        except (OSError, ForkServerError):
+            connection.close()
+            os.close(stdout_read)
+            os.close(stderr_read)
+            raise
+        finally:
+            os.close(stdout_write)
+            os.close(stderr_write)
+
+        return WorkerProcess(connection, reply, pid, {
+            Output.STDOUT: os.fdopen(stdout_read, 'rb'),
+            Output.STDERR: os.fdopen(stderr_read, 'rb'),
+            **(streams or {}),
+        })
+
+def _run_child(request: dict, fds: List[int]):
+    '''Run the requested script in the forked child, never returning'''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdin = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(stdin, 0)
+    os.dup2(fds[0], 1)
+    os.dup2(fds[1], 2)
+    for fd in (stdin, *fds[:2]):
+        os.close(fd)
+
+    os.chdir(request['cwd'])
+    sys.argv = [request['script']]
+    for arg, fd in zip(request.get('fd_args', ()), fds[2:]):
+        sys.argv += [arg, f'fd:{fd}']
+    if request['as_module']:
+        sys.path.insert(0, os.getcwd())
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(request['script'])))
+
+    exit_code = 0
+    try:
+        # Modules importing the context get the one of this step
+        from . import context
+        context.run_ctx = context.RunContext.get_current()
+
+        if request['as_module']:
+            runpy.run_module(request['script'], run_name='__main__', alter_sys=True)
+        else:
+            runpy.run_path(request['script'], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException as e:
+        # Hide the frames running the script, as the interpreter would
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename in (__file__, runpy.__file__, '<frozen runpy>'):
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb)
+        exit_code = 1
+
+    try:
+        # The exit handlers don't run, so the buffered metrics are sent now
+        from .metrics import MetricsWriter
+        MetricsWriter.close_instance()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code)
+
+def serve(socket_path: str, preload: List[str]):
+    for module in preload:
+        importlib.import_module(module)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen()
+
+    # Finished children wake up the selector
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ, 'accept')
+    selector.register(wakeup_read, selectors.EVENT_READ, 'wakeup')
+    selector.register(sys.stdin, selectors.EVENT_READ, 'stdin')
+    children: Dict[int, socket.socket] = {}
+
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+
+    while True:
+        for key, _ in selector.select():
+            if key.data == 'stdin':
+                if not os.read(sys.stdin.fileno(), 4096):
+                    return
+
+            elif key.data == 'accept':
+                connection, _ = listener.accept()
+                message, fds, _, _ = socket.recv_fds(connection, 1 << 16, 8)
+                if not message or len(fds) < 2:
+                    connection.close()
+                    for fd in fds:
+                        os.close(fd)
+                    continue
+
+                pid = os.fork()
+                if pid == 0:
+                    signal.set_wakeup_fd(-1)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    selector.close()
+                    listener.close()
+                    connection.close()
+                    for child_connection in children.values():
+                        child_connection.close()
+                    os.close(wakeup_read)
+                    os.close(wakeup_write)
+                    _run_child(json.loads(message), fds)
+
+                for fd in fds:
+                    os.close(fd)
+                children[pid] = connection
+                try:
+                    connection.sendall(json.dumps({'pid': pid}).encode('utf-8') + b'\n')
+                except OSError:
+                    pass
+
+            elif key.data == 'wakeup':
+                try:
+                    while os.read(wakeup_read, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+                while children:
+                    try:
+                        finished = ResourceUsage.wait(block=False)
+                    except ChildProcessError:
+                        break
+                    if finished is None:
+                        break
+                    pid, exit_code, usage = finished
+                    connection = children.pop(pid, None)
+                    if connection is None:
+                        continue
+                    with connection:
+                        try:
+                            connection.sendall(json.dumps({
+                                'exit_code': exit_code,
+                                'usage': usage,
+                            }).encode('utf-8') + b'\n')
+                        except OSError:
+                            pass
+
+if __name__ == '__main__':
+    serve(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,454 @@
+"""
+    History of the executed jobs and steps, stored in a SQLite database at '.afml/history.db'.
+
+    Params, matrix entries and metrics are stored as indexed key/value rows, so filters such as
+    'matrix.run=2 and metric.acc>0.9' only read the matching records
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class QueryError(ValueError): ...
+
+class History:
+    FILE = '.afml/history.db'
+    SCHEMA_VERSION = 1
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY,
+            parent INTEGER,
+            run TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            job TEXT NOT NULL,
+            step TEXT,
+            status TEXT NOT NULL,
+            exit_code INTEGER,
+            started REAL NOT NULL,
+            finished REAL,
+            wall REAL,
+            cpu REAL,
+            max_rss INTEGER,
+            dataset TEXT,
+            model TEXT,
+            matrix TEXT,
+            params TEXT,
+            usage TEXT
+        );
+        CREATE INDEX IF NOT EXISTS records_run ON records (run);
+        CREATE INDEX IF NOT EXISTS records_job ON records (job, step);
+        CREATE INDEX IF NOT EXISTS records_parent ON records (parent);
+        CREATE TABLE IF NOT EXISTS fields (
+            record INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            number REAL,
+            text TEXT
+        );
+        CREATE INDEX IF NOT EXISTS fields_number ON fields (key, number, record);
+        CREATE INDEX IF NOT EXISTS fields_text ON fields (key, text, record);
+        CREATE INDEX IF NOT EXISTS fields_record ON fields (record);
+        CREATE TABLE IF NOT EXISTS metrics (
+            record INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value REAL,
+            step INTEGER,
+            PRIMARY KEY (record, key)
+        );
+        CREATE INDEX IF NOT EXISTS metrics_value ON metrics (key, value, record);
+    '''
+
+    # Record columns that can be used in filters, besides the fields and metrics
+    COLUMNS = (
+        'id', 'parent', 'run', 'kind', 'job', 'step', 'status', 'exit_code',
+        'started', 'finished', 'wall', 'cpu', 'max_rss', 'dataset', 'model'
+    )
+
+    def __init__(self, file=FILE, run: str = None):
+        self.file = file
+        self._run = run
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            # Several processes may write the history at the same time
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(History.SCHEMA)
+            self._connection.execute(f'PRAGMA user_version={History.SCHEMA_VERSION}')
+
+    @property
+    def run(self) -> str:
+        '''Start time of the current run, identifying the records it adds'''
+        if self._run is None:
+            from .utils.time import Time
+            self._run = Time.get_params()['time']
+        return self._run
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def flatten(value, prefix: str) -> Iterator[Tuple[str, object]]:
+        '''Yield the leaves of nested dictionaries with dotted keys'''
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield from History.flatten(item, f'{prefix}.{key}')
+        else:
+            yield prefix, value
+
+    @staticmethod
+    def _field(key: str, value) -> Tuple[str, Optional[float], Optional[str]]:
+        if isinstance(value, (bool, int, float)):
+            return key, float(value), None
+        if value is None:
+            return key, None, None
+        if isinstance(value, str):
+            return key, None, value
+        return key, None, json.dumps(value, default=repr)
+
+    @staticmethod
+    def _identity(value) -> Optional[str]:
+        return value.name if value is not None else None
+
+    @staticmethod
+    def _definition(value) -> dict:
+        return value.to_definition() if value is not None else None
+
+    def _insert(
+        self,
+        parent: Optional[int],
+        kind: str,
+        job,
+        step,
+        status: str,
+        params: dict,
+        matrix: dict,
+        dataset,
+        model,
+        started: float,
+        finished: float = None,
+        exit_code: int = None,
+        usage: dict = None,
+        metrics: Dict[str, Tuple[float, Optional[int]]] = None
+    ) -> int:
+        usage = usage or {}
+        params = dict(params or {})
+        matrix = dict(matrix or {})
+        fields = [
+            *(History._field(key, value) for key, value in History.flatten(params, 'params')),
+            *(History._field(key, value) for key, value in History.flatten(matrix, 'matrix')),
+            *(History._field(key, value) for key, value in History.flatten(
+                History._definition(dataset) or {}, 'dataset')),
+            *(History._field(key, value) for key, value in History.flatten(
+                History._definition(model) or {}, 'model')),
+        ]
+        with self._lock, self._connection:
+            record = self._connection.execute(
+                'INSERT INTO records (parent, run, kind, job, step, status, exit_code, started, finished,'
+                ' wall, cpu, max_rss, dataset, model, matrix, params, usage)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    parent, self.run, kind, job.display_name,
+                    step.display_name if step is not None else None,
+                    status, exit_code, started, finished,
+                    usage.get('wall', finished - started if finished is not None else None),
+                    usage['user'] + usage['system'] if 'user' in usage else None,
+                    usage.get('max_rss'),
+                    History._identity(dataset), History._identity(model),
+                    json.dumps(matrix, default=repr),
+                    json.dumps(params, default=repr),
+                    json.dumps(usage),
+                )
+            ).lastrowid
+            self._connection.executemany(
+                'INSERT INTO fields (record, key, number, text) VALUES (?, ?, ?, ?)',
+                ((record, *field) for field in fields)
+            )
+            if metrics:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO metrics (record, key, value, step) VALUES (?, ?, ?, ?)',
+                    ((record, key, value, step) for key, (value, step) in metrics.items())
+                )
+        return record
+
+    def add_job(self, job, matrix: dict, params: dict, dataset=None, model=None) -> int:
+        '''Record the start of a job matrix instance, returning the id of its record'''
+        return self._insert(None, 'job', job, None, 'running', params, matrix, dataset, model, time.time())
+
+    def finish_job(self, record: int, status: str):
+        finished = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE records SET status = ?, finished = ?, wall = ? - started WHERE id = ?',
+                (status, finished, finished, record)
+            )
+
+    def add_step(
+        self,
+        parent: Optional[int],
+        job,
+        step,
+        status: str,
+        started: float,
+        params: dict = None,
+        matrix: dict = None,
+        dataset=None,
+        model=None,
+        exit_code: int = None,
+        usage: dict = None,
+        metrics: Dict[str, Tuple[float, Optional[int]]] = None
+    ) -> int:
+        '''Record a finished step, returning the id of its record'''
+        return self._insert(
+            parent, 'step', job, step, status, params, matrix, dataset, model,
+            started, time.time(), exit_code, usage, metrics
+        )
+
+    _tokens = re.compile(r'''
+        \s*(?:
+            (?P<paren>[()])
+            | (?P<keyword>(?:and|or|not)\b)
+            | (?P<field>[A-Za-z_][\w.\-]*)\s*(?P<op>==|!=|<=|>=|=|<|>|~)\s*
+              (?P<value>"[^"]*"|'[^']*'|[^\s()]+)
+        )''', re.VERBOSE | re.IGNORECASE)
+
+    @staticmethod
+    def _tokenize(query: str) -> List[re.Match]:
+        tokens = []
+        position = 0
+        query = query.strip()
+        while position < len(query):
+            match = History._tokens.match(query, position)
+            if match is None or match.end() == position:
+                raise QueryError(f"Invalid filter at '{query[position:]}'")
+            tokens.append(match)
+            position = match.end()
+            while position < len(query) and query[position].isspace():
+                position += 1
+        return tokens
+
+    @staticmethod
+    def _condition(field: str, op: str, value: str) -> Tuple[str, list]:
+        '''SQL condition on the records, and its arguments'''
+        op = {'==': '=', '~': 'GLOB'}.get(op, op)
+        quoted = value[:1] in ('"', "'")
+        if quoted:
+            value = value[1:-1]
+        number = None
+        if not quoted:
+            try:
+                number = float(value)
+            except ValueError:
+                pass
+
+        prefix, _, key = field.partition('.')
+        if prefix in ('metric', 'metrics') and key:
+            if number is None:
+                raise QueryError(f"Metrics can only be compared with numbers, in '{field}{op}{value}'")
+            return f'id IN (SELECT record FROM metrics WHERE key = ? AND value {op} ?)', [key, number]
+
+        if prefix in ('params', 'matrix', 'dataset', 'model') and key:
+            if number is not None and op != 'GLOB':
+                return f'id IN (SELECT record FROM fields WHERE key = ? AND number {op} ?)', [field, number]
+            return f'id IN (SELECT record FROM fields WHERE key = ? AND text {op} ?)', [field, value]
+
+        if field not in History.COLUMNS:
+            raise QueryError(
+                f"Unknown field '{field}', expected one of {', '.join(History.COLUMNS)}"
+                " or params.*, matrix.*, dataset.*, model.*, metric.*"
+            )
+        return f'{field} {op} ?', [number if number is not None and op != 'GLOB' else value]
+
+    @staticmethod
+    def parse_filter(query: str) -> Tuple[str, list]:
+        '''
+        Translate a filter such as 'job=Train and (matrix.run=2 or metric.acc>0.9)' into SQL.
+        Comparisons are =, !=, <, <=, >, >= and ~ (glob pattern), combined with and, or, not
+        '''
+        tokens = History._tokenize(query)
+        position = 0
+
+        def peek(kind: str, text: str = None) -> bool:
+            if position >= len(tokens) or tokens[position].group(kind) is None:
+                return False
+            return text is None or tokens[position].group(kind).lower() == text
+
+        def parse_or() -> Tuple[str, list]:
+            nonlocal position
+            sql, args = parse_and()
+            while peek('keyword', 'or'):
+                position += 1
+                right, right_args = parse_and()
+                sql, args = f'({sql} OR {right})', args + right_args
+            return sql, args
+
+        def parse_and() -> Tuple[str, list]:
+            nonlocal position
+            sql, args = parse_not()
+            while peek('keyword', 'and'):
+                position += 1
+                right, right_args = parse_not()
+                sql, args = f'({sql} AND {right})', args + right_args
+            return sql, args
+
+        def parse_not() -> Tuple[str, list]:
+            nonlocal position
+            if peek('keyword', 'not'):
+                position += 1
+                sql, args = parse_not()
+                return f'(NOT {sql})', args
+            if peek('paren', '('):
+                position += 1
+                sql, args = parse_or()
+                if not peek('paren', ')'):
+                    raise QueryError(f"Missing ')' in '{query}'")
+                position += 1
+                return sql, args
+            if not peek('field'):
+                raise QueryError(f"Expected a comparison in '{query}'")
+            token = tokens[position]
+            position += 1
+            return History._condition(token.group('field'), token.group('op'), token.group('value'))
+
+        if not tokens:
+            return '1', []
+        sql, args = parse_or()
+        if position != len(tokens):
+            raise QueryError(f"Unexpected '{tokens[position].group().strip()}' in '{query}'")
+        return sql, args
+
+    def query(self, query: str = None, limit: int = None, kind: str = None) -> List[sqlite3.Row]:
+        '''Records matching a filter, the most recent first'''
+        sql, args = History.parse_filter(query or '')
+        if kind is not None:
+            sql, args = f'({sql}) AND kind = ?', args + [kind]
+        statement = f'SELECT * FROM records WHERE {sql} ORDER BY id DESC'
+        if limit:
+            statement += f' LIMIT {int(limit)}'
+        with self._lock:
+            return self._connection.execute(statement, args).fetchall()
+
+    def get(self, record: int) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._connection.execute('SELECT * FROM records WHERE id = ?', (record,)).fetchone()
+
+    def children(self, record: int) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._connection.execute(
+                'SELECT * FROM records WHERE parent = ? ORDER BY id', (record,)
+            ).fetchall()
+
+    def metrics(self, records: List[int]) -> Dict[int, Dict[str, float]]:
+        '''Final value of the metrics of each record'''
+        metrics: Dict[int, Dict[str, float]] = {record: {} for record in records}
+        with self._lock:
+            for offset in range(0, len(records), 500):
+                chunk = records[offset:offset + 500]
+                for row in self._connection.execute(
+                    f'SELECT record, key, value FROM metrics WHERE record IN ({",".join("?" * len(chunk))})',
+                    chunk
+                ):
+                    metrics[row['record']][row['key']] = row['value']
+        return metrics
+
+class HistoryReport:
+    """
+    Tables of the records in the history, as printed by 'afml runs'
+    """
+
+    def __init__(self, history: History):
+        self.history = history
+
+    @staticmethod
+    def _format(value) -> str:
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return f'{value:.4g}'
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, separators=(',', ':'))
+        return str(value)
+
+    @staticmethod
+    def _lookup(values: dict, key: str):
+        for part in key.split('.'):
+            if not isinstance(values, dict) or part not in values:
+                return None
+            values = values[part]
+        return values
+
+    def _value(self, record: sqlite3.Row, metrics: Dict[str, float], column: str):
+        prefix, _, key = column.partition('.')
+        if prefix in ('metric', 'metrics') and key:
+            return metrics.get(key)
+        if prefix in ('params', 'matrix') and key:
+            return HistoryReport._lookup(json.loads(record[prefix]), key)
+        if column in ('wall', 'cpu') and record[column] is not None:
+            return f'{record[column]:.2f}s'
+        if column == 'started':
+            return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['started']))
+        return record[column]
+
+    def table(self, records: List[sqlite3.Row], columns: List[str] = None):
+        if not records:
+            print("No records found")
+            return
+
+        columns = ['id', 'run', 'job', 'step', 'status', 'wall', 'matrix', *(columns or [])]
+        metrics = self.history.metrics([record['id'] for record in records])
+        from .utils.utils import Utils
+        Utils.print_table(columns, [
+            [
+                HistoryReport._format(
+                    json.loads(record['matrix']) or None if column == 'matrix'
+                    else self._value(record, metrics[record['id']], column)
+                )
+                for column in columns
+            ]
+            for record in records
+        ])
+
+    def show(self, record_id: int):
+        record = self.history.get(record_id)
+        if record is None:
+            raise LookupError(f"Record {record_id} not found")
+
+        from termcolor import cprint
+        title = record['job'] + (f" / {record['step']}" if record['step'] else '')
+        cprint(f"#{record['id']} {record['kind']} {title}", 'green')
+        for column in ('run', 'status', 'exit_code', 'started', 'wall', 'cpu', 'max_rss', 'dataset', 'model'):
+            value = self._value(record, {}, column)
+            if value is not None:
+                print(f"  {column}: {value}")
+        if record['parent'] is not None:
+            print(f"  job record: #{record['parent']}")
+
+        for section in ('matrix', 'params'):
+            values = json.loads(record[section])
+            if values:
+                cprint(f"  {section}:", 'blue')
+                for key, value in History.flatten(values, ''):
+                    print(f"    {key[1:]}: {HistoryReport._format(value)}")
+
+        metrics = self.history.metrics([record['id']])[record['id']]
+        if metrics:
+            cprint("  metrics:", 'blue')
+            for key, value in metrics.items():
+                print(f"    {key}: {HistoryReport._format(value)}")
+
+        usage = json.loads(record['usage'] or '{}')
+        if usage:
+            cprint("  usage:", 'blue')
+            for key, value in usage.items():
+                print(f"    {key}: {HistoryReport._format(value)}")
+
+        children = self.history.children(record['id'])
+        if children:
+            cprint("  steps:", 'blue')
+            for child in children:
+                print(f"    #{child['id']} {child['step']}: {child['status']}")
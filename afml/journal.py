@@ -0,0 +1,138 @@
+"""
+    Journal of the last run, recording the steps that finished so the run can be resumed.
+    Each shard of a sharded run has its own journal, '.afml/journal.<i>of<N>.jsonl', so
+    shards running in the same project folder don't replace each other's.
+    It is a JSON lines file whose first line describes the run:
+
+        {"type": "run", "time": {"time": ..., "last_time": ...}, "project": <sha256>, "jobs": [...]}
+        {"type": "step", "job": ..., "step": ..., "matrix": {...}, "status": "success"}
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from termcolor import cprint
+
+from .utils.time import Time
+
+
+class RunJournal:
+    FILE = '.afml/journal.jsonl'
+    COMPLETED = ('success', 'cached', 'deduplicated')
+
+    def __init__(self, file=FILE, shard: Tuple[int, int] = None):
+        self.file = Path(file)
+        if shard is not None:
+            self.file = self.file.with_name(f'{self.file.stem}.{shard[0] + 1}of{shard[1]}{self.file.suffix}')
+        self.header: Optional[dict] = None
+        # Completed step executions, with the last value of their metrics
+        self.completed: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(job: str, step: str, matrix: dict) -> str:
+        '''Key of a step execution, by the names of its job and step, and its matrix instance'''
+        return json.dumps(
+            [job, step, dict(matrix) if matrix else {}],
+            sort_keys=True, default=str, separators=(',', ':')
+        )
+
+    @staticmethod
+    def _hash(project_file) -> str:
+        with open(project_file, 'rb') as content:
+            return hashlib.sha256(content.read()).hexdigest()
+
+    def _read(self) -> Optional[dict]:
+        try:
+            with open(self.file, 'r', encoding='utf-8') as journal_file:
+                lines = journal_file.readlines()
+        except OSError:
+            return None
+
+        header = None
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the run was interrupted
+                continue
+            if entry.get('type') == 'run':
+                header = entry
+                self.completed = {}
+            elif entry.get('type') == 'step' and header is not None:
+                if entry['status'] in RunJournal.COMPLETED:
+                    unit = RunJournal._unit(entry['job'], entry['step'], entry['matrix'])
+                    self.completed[unit] = entry.get('metrics') or {}
+        return header
+
+    def _append(self, entry: dict):
+        line = json.dumps(entry, default=str, separators=(',', ':')) + '\n'
+        with self._lock:
+            with open(self.file, 'a', encoding='utf-8') as journal_file:
+                journal_file.write(line)
+                journal_file.flush()
+                # Completed steps must survive a reboot of the machine
+                os.fsync(journal_file.fileno())
+
+    def start(self, project_file, job_names: List[str] = None):
+        '''Start the journal of a new run, replacing the one of the last run'''
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.header = {
+            'type': 'run',
+            'time': Time.get_params(),
+            'project': RunJournal._hash(project_file),
+            'jobs': job_names or [],
+        }
+        self.completed = {}
+        with open(self.file, 'w', encoding='utf-8'):
+            pass
+        self._append(self.header)
+
+    def resume(self, project_file, job_names: List[str] = None) -> bool:
+        '''
+        Continue the journal of the last run, restoring its time so its outputs are completed.
+        Returns False, starting a new run, if there is no run to resume
+        '''
+        header = self._read()
+        if header is None:
+            cprint("No run to resume, starting a new one", 'yellow')
+            self.start(project_file, job_names)
+            return False
+
+        self.header = header
+        Time.resume(header['time'])
+        if header.get('project') != RunJournal._hash(project_file):
+            cprint("WARNING: The project file changed since the resumed run", 'yellow')
+        if sorted(header.get('jobs') or []) != sorted(job_names or []):
+            cprint(
+                f"WARNING: The resumed run executed the jobs: {', '.join(header['jobs']) or 'all'}",
+                'yellow'
+            )
+        cprint(
+            f"Resuming run {header['time']['time']}, {len(self.completed)} step(s) were completed",
+            'cyan'
+        )
+        return True
+
+    def is_completed(self, job, step, matrix: dict) -> bool:
+        return RunJournal._unit(job.display_name, step.display_name, matrix) in self.completed
+
+    def get_metrics(self, job, step, matrix: dict) -> dict:
+        return self.completed.get(RunJournal._unit(job.display_name, step.display_name, matrix)) or {}
+
+    def record(self, job, step, matrix: dict, status: str, metrics: dict = None):
+        if status in RunJournal.COMPLETED:
+            self.completed[RunJournal._unit(job.display_name, step.display_name, matrix)] = metrics or {}
+        entry = {
+            'type': 'step',
+            'job': job.display_name,
+            'step': step.display_name,
+            'matrix': dict(matrix) if matrix else {},
+            'status': status,
+        }
+        if metrics:
+            entry['metrics'] = metrics
+        self._append(entry)
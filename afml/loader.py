@@ -0,0 +1,125 @@
+import itertools
+import os
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+
+class DataLoader:
+    """
+    Lazy iteration over the files of a folder, reading them ahead in a thread pool
+    """
+
+    @staticmethod
+    def default_workers() -> int:
+        # Reading files is bound by I/O, so there are more threads than cores
+        return min(32, (os.cpu_count() or 1) * 4)
+
+    @staticmethod
+    def walk(folder, relative: str = '', _parents: set = None) -> Iterator[Tuple[str, os.DirEntry]]:
+        '''
+        Recursively yield the files of a folder and their relative paths, sorted by name.
+        Symlinked folders are followed, unless they link to one of their parents
+        '''
+        try:
+            stat = os.stat(folder)
+            with os.scandir(folder) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+
+        parents = _parents or set()
+        key = (stat.st_dev, stat.st_ino)
+        if key in parents:
+            return
+        parents.add(key)
+        try:
+            for entry in entries:
+                name = f'{relative}{entry.name}'
+                if entry.is_dir(follow_symlinks=True):
+                    yield from DataLoader.walk(entry.path, f'{name}/', parents)
+                elif entry.is_file(follow_symlinks=True):
+                    yield name, entry
+        finally:
+            parents.discard(key)
+
+    @staticmethod
+    def order(items: Iterable, shuffle: bool = False, seed=None) -> Iterator:
+        '''
+        Yield the items lazily, or shuffled in the same order for a given seed.
+        Shuffling needs to collect all the items first
+        '''
+        if not shuffle:
+            yield from items
+            return
+
+        items = list(items)
+        random.Random(seed).shuffle(items)
+        yield from items
+
+    @staticmethod
+    def iter_files(folder, shuffle: bool = False, seed=None) -> Iterator[Path]:
+        '''Yield the files of a folder as they are found'''
+        return DataLoader.order(
+            (Path(entry.path) for _, entry in DataLoader.walk(folder)), shuffle, seed
+        )
+
+    @staticmethod
+    def prefetch(func: Callable, items: Iterable, workers: int = None, size: int = None) -> Iterator:
+        '''
+        Yield func(item) for each item in order, computing up to 'size' results ahead in a thread pool
+        '''
+        workers = workers or DataLoader.default_workers()
+        size = max(1, size or workers)
+        items = iter(items)
+        with ThreadPoolExecutor(workers, thread_name_prefix='afml-loader') as pool:
+            pending = deque(pool.submit(func, item) for item in itertools.islice(items, size))
+            try:
+                while pending:
+                    result = pending.popleft().result()
+                    for item in itertools.islice(items, 1):
+                        pending.append(pool.submit(func, item))
+                    yield result
+            finally:
+                # Stop reading ahead when the consumer stops iterating
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def read_file(path: Path) -> bytes:
+        with open(path, 'rb') as file:
+            return file.read()
+
+    @staticmethod
+    def batches(
+        names: Iterable[str],
+        read: Callable[[str], object],
+        size: int,
+        transform: Callable[[str, object], object] = None,
+        workers: int = None,
+        prefetch: int = 2,
+        drop_last: bool = False
+    ) -> Iterator[List]:
+        '''
+        Yield lists of 'size' files read and transformed by 'workers' threads.
+        Up to 'prefetch' batches are loaded while the current one is being used
+        '''
+        if size < 1:
+            raise ValueError(f"The batch size must be positive, got {size}")
+
+        if transform is None:
+            load = read
+        else:
+            load = lambda name: transform(name, read(name))
+
+        items = DataLoader.prefetch(load, names, workers, size * max(1, prefetch))
+        try:
+            while True:
+                batch = list(itertools.islice(items, size))
+                if not batch or (drop_last and len(batch) < size):
+                    return
+                yield batch
+        finally:
+            items.close()
@@ -0,0 +1,254 @@
+"""
+    Output of the executed steps, written to '.afml/logs/<run>/<job>/<matrix>/<step>.log',
+    or '.log.gz' if compressed, and shown in the console at a bounded rate
+"""
+import fnmatch
+import gzip
+import hashlib
+import re
+import time
+from collections import deque
+from pathlib import Path
+from typing import IO, Iterator, List, Optional
+
+from termcolor import cprint
+
+from .process import Output
+from .utils.time import Time
+
+
+class StepLog:
+    """
+    Output of a step execution, written to its log file, kept as a bounded tail for error reports,
+    and printed with a bounded number of lines per second. Progress updates are collapsed:
+    only the latest one is shown, at most every PROGRESS_INTERVAL, and none is written to the file
+    """
+    TAIL_LINES = 50
+    # Last lines printed when the step finishes, if they were not shown
+    LAST_LINES = 10
+    MAX_LINES_PER_SECOND = 200
+    PROGRESS_INTERVAL = 0.2
+
+    def __init__(self, file: Optional[Path] = None, show_progress: bool = True):
+        self.file = file
+        self.show_progress = show_progress
+        self.tail: deque = deque(maxlen=StepLog.TAIL_LINES)
+        # Lines that were not printed as they exceeded the rate limit, since the last notice and in total
+        self.skipped = 0
+        self.hidden = 0
+        self._writer: Optional[IO[str]] = None
+        self._progress: Optional[Output] = None
+        self._progress_time = 0.0
+        self._window = 0.0
+        self._window_lines = 0
+
+        if file is not None:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            if file.suffix == '.gz':
+                self._writer = gzip.open(file, 'wt', encoding='utf-8', compresslevel=6)
+            else:
+                self._writer = open(file, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, output: Output):
+        if output.progress:
+            self._progress = output
+            now = time.monotonic()
+            if self.show_progress and now - self._progress_time >= StepLog.PROGRESS_INTERVAL:
+                self._progress_time = now
+                print(output, end='', flush=True)
+            return
+
+        self._progress = None
+        self.tail.append(output)
+        if self._writer is not None:
+            self._writer.write(output)
+
+        now = time.monotonic()
+        if now - self._window >= 1:
+            if self.skipped:
+                cprint(f"... {self.skipped} line(s) not shown", 'cyan')
+                self.skipped = 0
+            if self._writer is not None:
+                # Followers of the log see it at most a second late
+                self._writer.flush()
+            self._window = now
+            self._window_lines = 0
+        if self._window_lines >= StepLog.MAX_LINES_PER_SECOND:
+            self.skipped += 1
+            self.hidden += 1
+            return
+        self._window_lines += 1
+        if output.stream == Output.STDERR:
+            cprint(output, 'yellow', end='')
+        else:
+            print(output, end='')
+
+    def close(self):
+        # A progress update without a newline is the last state of the step
+        if self._progress is not None:
+            line = Output(self._progress.rstrip('\r') + '\n', self._progress.stream)
+            self.tail.append(line)
+            if self._writer is not None:
+                self._writer.write(line)
+            if self.show_progress:
+                print(line, end='')
+            self._progress = None
+
+        if self.skipped:
+            cprint(
+                f"... {self.skipped} line(s) not shown" + (f", see {self.file}" if self.file else ''),
+                'cyan'
+            )
+            for line in list(self.tail)[-min(self.skipped, StepLog.LAST_LINES):]:
+                if line.stream == Output.STDERR:
+                    cprint(line, 'yellow', end='')
+                else:
+                    print(line, end='')
+            self.skipped = 0
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def report(self):
+        '''Print where the output of a failed step is, and its last lines if they were not all shown'''
+        if self.hidden:
+            cprint(f"Last {len(self.tail)} line(s) of the output:", 'red')
+            for line in self.tail:
+                cprint(line, 'red', end='')
+        if self.file is not None:
+            cprint(f"Output saved to {self.file}", 'red')
+
+class RunLogs:
+    """
+    Log files of the steps executed by a run
+    """
+    FOLDER = '.afml/logs'
+    MAX_NAME = 80
+
+    def __init__(self, folder=FOLDER, compress: bool = False):
+        self.run = Time.get_params()['time']
+        self.folder = Path(folder) / self.run
+        self.compress = compress
+
+    @staticmethod
+    def _name(value: str) -> str:
+        '''Folder or file name for a job, step or matrix, shortened with a hash if too long'''
+        name = re.sub(r'[^\w.=,+@-]+', '_', value).strip('._') or '_'
+        if len(name) > RunLogs.MAX_NAME:
+            digest = hashlib.sha1(value.encode('utf-8')).hexdigest()[:8]
+            name = f'{name[:RunLogs.MAX_NAME - 9]}-{digest}'
+        return name
+
+    @staticmethod
+    def _items(values: dict, prefix: str = '') -> Iterator[str]:
+        '''Matrix instance as key=value pairs, with nested values as key.inner=value'''
+        for key, value in values.items():
+            if isinstance(value, dict):
+                yield from RunLogs._items(value, f'{prefix}{key}.')
+            else:
+                yield f'{prefix}{key}={value}'
+
+    def path(self, job, step, matrix: dict, attempt: int = 1) -> Path:
+        matrix_name = ','.join(RunLogs._items(matrix or {})) or 'default'
+        name = RunLogs._name(step.display_name) + (f'.{attempt}' if attempt > 1 else '')
+        return (
+            self.folder / RunLogs._name(job.display_name) / RunLogs._name(matrix_name)
+            / (name + ('.log.gz' if self.compress else '.log'))
+        )
+
+    def open(self, job, step, matrix: dict, attempt: int = 1, show_progress: bool = True) -> StepLog:
+        return StepLog(self.path(job, step, matrix, attempt), show_progress)
+
+class LogViewer:
+    """
+    Tail, follow or search the logs of the recorded runs, as done by 'afml logs'
+    """
+
+    def __init__(self, folder=RunLogs.FOLDER):
+        self.folder = Path(folder)
+
+    def runs(self) -> List[str]:
+        return sorted(path.name for path in self.folder.glob('*') if path.is_dir())
+
+    @staticmethod
+    def _pattern(value: str) -> str:
+        '''Glob pattern of names, replacing the characters that are replaced in them'''
+        return re.sub(r'[^\w.=,+@*?-]+', '_', value)
+
+    def files(self, run: str = None, job: str = None, step: str = None, matrix: str = None) -> List[Path]:
+        '''Log files of a run, the last one by default, filtered by glob patterns of their names'''
+        runs = self.runs()
+        if not runs:
+            return []
+        run = run or runs[-1]
+        if run not in runs:
+            raise LookupError(f"Run '{run}' not found, the logged runs are: {', '.join(runs)}")
+
+        files = []
+        for path in (self.folder / run).glob('*/*/*.log*'):
+            # Retries are logged as '<step>.<attempt>.log'
+            step_name = path.name.split('.log', 1)[0]
+            if job and not fnmatch.fnmatch(path.parent.parent.name, LogViewer._pattern(job)):
+                continue
+            if matrix and not fnmatch.fnmatch(path.parent.name, f'*{LogViewer._pattern(matrix)}*'):
+                continue
+            if step and not any(
+                fnmatch.fnmatch(step_name, pattern)
+                for pattern in (LogViewer._pattern(step), LogViewer._pattern(step) + '.[0-9]*')
+            ):
+                continue
+            files.append(path)
+        return sorted(files, key=lambda path: path.stat().st_mtime)
+
+    @staticmethod
+    def _open(path: Path) -> IO[str]:
+        if path.suffix == '.gz':
+            return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+        return open(path, 'r', encoding='utf-8', errors='replace')
+
+    @staticmethod
+    def lines(path: Path) -> Iterator[str]:
+        try:
+            with LogViewer._open(path) as log_file:
+                yield from log_file
+        except EOFError:
+            # Compressed logs of running steps are incomplete
+            return
+
+    def tail(self, files: List[Path], count: int = 20):
+        for path in files:
+            cprint(f"==> {path.relative_to(self.folder)} <==", 'green')
+            for line in deque(LogViewer.lines(path), maxlen=count) if count > 0 else LogViewer.lines(path):
+                print(line, end='')
+
+    def grep(self, files: List[Path], pattern: str, ignore_case: bool = False) -> int:
+        '''Print the lines matching a regular expression, returning their number'''
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        matches = 0
+        for path in files:
+            name = path.relative_to(self.folder)
+            for number, line in enumerate(LogViewer.lines(path), 1):
+                if regex.search(line):
+                    matches += 1
+                    print(f"{name}:{number}: {line}", end='' if line.endswith('\n') else '\n')
+        return matches
+
+    @staticmethod
+    def follow(path: Path, interval: float = 0.5):
+        '''Print the lines appended to a log until interrupted'''
+        if path.suffix == '.gz':
+            raise ValueError("Compressed logs can't be followed")
+        with open(path, 'r', encoding='utf-8', errors='replace') as log_file:
+            log_file.seek(0, 2)
+            while True:
+                line = log_file.readline()
+                if line:
+                    print(line, end='', flush=True)
+                else:
+                    time.sleep(interval)
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .loader import DataLoader
+
+
+class DatasetManifest:
+    """
+    Persistent index of the files of a dataset folder.
+
+    Each file is recorded with its size, modification time and content hash.
+    Scans only stat the files, and hashes are computed lazily for the files
+    that are new or changed since the last scan
+    """
+    FOLDER = '.afml/datasets'
+    HASH_CHUNK_SIZE = 1 << 20
+    # Seconds between saves while hashing, so interrupted indexes keep their progress
+    SAVE_INTERVAL = 30.0
+
+    _locks: Dict[str, threading.Lock] = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, folder, manifest_folder=FOLDER):
+        self.folder = Path(folder)
+        key = hashlib.sha256(str(self.folder.resolve()).encode('utf-8')).hexdigest()
+        self.file = Path(manifest_folder) / f'{key[:16]}.json'
+        # path -> [size, mtime_ns, hash]
+        self.files: Dict[str, List] = {}
+        self._load()
+
+    @property
+    def lock(self) -> threading.Lock:
+        with DatasetManifest._locks_lock:
+            return DatasetManifest._locks.setdefault(str(self.file), threading.Lock())
+
+    def _load(self):
+        try:
+            with open(self.file, 'r', encoding='utf-8') as manifest_file:
+                self.files = json.load(manifest_file).get('files', {})
+        except (OSError, ValueError):
+            self.files = {}
+
+    def save(self):
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            'w', encoding='utf-8', dir=self.file.parent, delete=False
+        ) as tmp_file:
+            json.dump({
+                'folder': str(self.folder.resolve()),
+                'files': self.files
+            }, tmp_file, separators=(',', ':'))
+        os.replace(tmp_file.name, self.file)
+
+    def scan(self) -> int:
+        '''Update the files using only their metadata, returning how many changed'''
+        files = {}
+        changed = 0
+        for name, entry in DataLoader.walk(self.folder):
+            stat = entry.stat()
+            previous = self.files.get(name)
+            if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+                files[name] = previous
+            else:
+                files[name] = [stat.st_size, stat.st_mtime_ns, None]
+                changed += 1
+
+        changed += len(self.files.keys() - files.keys())
+        self.files = files
+        return changed
+
+    def _hash_file(self, name: str) -> Optional[str]:
+        digest = hashlib.sha256()
+        try:
+            with open(self.folder / name, 'rb') as file:
+                for chunk in iter(lambda: file.read(DatasetManifest.HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def hash(self, workers: int = None) -> int:
+        '''Compute the missing content hashes in parallel, saving them periodically, returning how many were hashed'''
+        pending = [name for name, entry in self.files.items() if entry[2] is None]
+        if not pending:
+            return 0
+
+        saved = time.monotonic()
+        with ThreadPoolExecutor(workers or DataLoader.default_workers()) as pool:
+            for name, file_hash in zip(pending, pool.map(self._hash_file, pending)):
+                self.files[name][2] = file_hash
+                if time.monotonic() - saved >= DatasetManifest.SAVE_INTERVAL:
+                    self.save()
+                    saved = time.monotonic()
+
+        return len(pending)
+
+    def update(self, hashes: bool = True, workers: int = None):
+        '''Scan the folder and save the manifest, hashing the changed files if requested'''
+        with self.lock:
+            self._load()
+            changed = self.scan()
+            hashed = self.hash(workers) if hashes else 0
+            if changed or hashed or not self.file.is_file():
+                self.save()
+        return changed, hashed
+
+    def fingerprint(self) -> str:
+        '''Hash of the indexed files paths and contents'''
+        digest = hashlib.sha256()
+        for name in sorted(self.files):
+            digest.update(f'{name}\0{self.files[name][2]}\n'.encode('utf-8'))
+        return digest.hexdigest()
+
+    @property
+    def size(self) -> int:
+        return sum(entry[0] for entry in self.files.values())
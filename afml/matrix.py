@@ -1,17 +1,523 @@
 import itertools
+import math
+import random
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
 from munch import Munch
 
+class MatrixError(ValueError): ...
+
+class Distribution:
+    """
+    Range of values of a parameter sampled by a search strategy, such as {loguniform: [1e-5, 1e-2]}
+    """
+    KINDS = ('uniform', 'loguniform', 'randint')
+
+    def __repr__(self):
+        return f"Distribution({self.kind}, {self.low}, {self.high})"
+
+    def __init__(self, kind: str, low, high):
+        if kind == 'loguniform' and low <= 0:
+            raise MatrixError("The range of a 'loguniform' distribution must be positive")
+        if high < low:
+            raise MatrixError(f"Invalid range [{low}, {high}] of a '{kind}' distribution")
+        self.kind = kind
+        self.low = low
+        self.high = high
+
+    @staticmethod
+    def parse(definition) -> Optional['Distribution']:
+        '''Parse a mapping such as {uniform: [0, 1]}, or None if it is not a distribution'''
+        if not isinstance(definition, dict) or len(definition) != 1:
+            return None
+        kind, bounds = next(iter(definition.items()))
+        if kind not in Distribution.KINDS:
+            return None
+        try:
+            low, high = (float(bound) for bound in bounds)
+        except (TypeError, ValueError):
+            raise MatrixError(f"Invalid '{kind}' distribution {bounds}, expected [low, high]") from None
+        if kind == 'randint':
+            low, high = int(low), int(high)
+        return Distribution(kind, low, high)
+
+    def at(self, quantile: float):
+        '''Value at a quantile in [0, 1)'''
+        if self.kind == 'uniform':
+            return self.low + quantile * (self.high - self.low)
+        if self.kind == 'loguniform':
+            return math.exp(math.log(self.low) + quantile * (math.log(self.high) - math.log(self.low)))
+        return min(self.low + int(quantile * (self.high - self.low + 1)), self.high)
+
 class Matrix:
-    def __init__(self, **entries):
+    """
+    Combinations of parameters, expanded lazily.
+
+    Combinations matching any of the 'exclude' rules are skipped, and the
+    'include' entries are added as extra combinations after the product
+    """
+
+    def __init__(self, include: List[dict] = None, exclude: List[dict] = None, **entries):
+        for key, values in entries.items():
+            if isinstance(values, dict):
+                raise MatrixError(
+                    f"Matrix parameter '{key}' is a range, which requires a 'random', "
+                    "'latin-hypercube', 'halving' or 'hyperband' strategy"
+                )
         self._params = entries
-        self._combinations = []
+        self._include = [dict(combination) for combination in include or []]
+        self._exclude = [dict(rule) for rule in exclude or []]
+
+        self._keys = list(self._params.keys())
+        self._values = [list(values) for values in self._params.values()]
+        # Value indices matched by each rule in every axis, None if not constrained.
+        # Rules on unknown parameters can't match any combination
+        self._rules = [
+            [
+                None if key not in rule else {
+                    index
+                    for index, value in enumerate(values)
+                    if Matrix._matches(value, rule[key])
+                }
+                for key, values in zip(self._keys, self._values)
+            ]
+            for rule in self._exclude
+            if all(key in self._params for key in rule)
+        ]
+        # Counts of combinations by axis and rules still matching, see _count_from
+        self._counts: Dict[Tuple[int, frozenset], int] = {}
+        self._length = None
+
+    @staticmethod
+    def parse(definition: dict) -> 'Matrix':
+        '''
+        Parse a 'matrix' block, whose 'strategy' selects how the combinations are chosen.
+        By default ('grid') they are the full product of the parameters
+        '''
+        definition = dict(definition or {})
+        strategy = definition.pop('strategy', None) or 'grid'
+        if isinstance(strategy, str):
+            strategy = {'type': strategy}
+        strategy = dict(strategy)
+        kind = strategy.pop('type', 'grid')
+
+        if kind == 'grid':
+            return Matrix(**definition)
+        if kind in SampledMatrix.METHODS:
+            return SampledMatrix(kind, **strategy, **definition)
+        if kind in AdaptiveMatrix.METHODS:
+            return AdaptiveMatrix(kind, **strategy, **definition)
+        raise MatrixError(
+            f"Unknown matrix strategy '{kind}', expected one of: "
+            f"{', '.join(('grid', *SampledMatrix.METHODS, *AdaptiveMatrix.METHODS))}"
+        )
+
+    @property
+    def empty(self) -> bool:
+        return not self._params and not self._include
+
+    @staticmethod
+    def _matches(value, rule_value) -> bool:
+        if isinstance(value, dict) and isinstance(rule_value, dict):
+            return all(
+                key in value and Matrix._matches(value[key], rule_value[key])
+                for key in rule_value
+            )
+        return value == rule_value
+
+    def _is_excluded(self, indices) -> bool:
+        return any(
+            all(
+                matches is None or index in matches
+                for index, matches in zip(indices, rule)
+            )
+            for rule in self._rules
+        )
+
+    def _count(self, prefix=()) -> int:
+        '''Count the combinations starting with the given value indices that are not excluded'''
+        rules = frozenset(
+            number for number, rule in enumerate(self._rules)
+            if all(rule[axis] is None or index in rule[axis] for axis, index in enumerate(prefix))
+        )
+        return self._count_from(len(prefix), rules)
+
+    def _count_from(self, axis: int, rules: frozenset) -> int:
+        '''
+        Count the combinations of the axes from the given one that none of the given rules exclude.
+        Values matched by the same rules lead to the same counts, so each group of them is counted once
+        '''
+        if not rules:
+            count = 1
+            for values in self._values[axis:]:
+                count *= len(values)
+            return count
+        if axis == len(self._values):
+            return 0
+
+        key = (axis, rules)
+        if key not in self._counts:
+            groups: Dict[frozenset, int] = {}
+            for index in range(len(self._values[axis])):
+                matching = frozenset(
+                    number for number in rules
+                    if self._rules[number][axis] is None or index in self._rules[number][axis]
+                )
+                groups[matching] = groups.get(matching, 0) + 1
+            self._counts[key] = sum(
+                size * self._count_from(axis + 1, matching) for matching, size in groups.items()
+            )
+        return self._counts[key]
+
+    def _instance(self, indices) -> 'MatrixInstance':
+        return MatrixInstance(**{
+            key: values[index]
+            for key, values, index in zip(self._keys, self._values, indices)
+        })
+
+    @property
+    def _has_product(self) -> bool:
+        '''Whether there is a product of parameters, as matrices with only 'include' entries have none'''
+        return bool(self._params) or not self._include
+
+    def _iter_indices(self, start=()) -> Iterator[tuple]:
+        '''Iterate the value indices of the product, starting from the given ones'''
+        indices = list(start) or [0] * len(self._values)
+        if not self._has_product or any(len(values) == 0 for values in self._values):
+            return
+        while True:
+            yield tuple(indices)
+            axis = len(indices) - 1
+            while axis >= 0:
+                indices[axis] += 1
+                if indices[axis] < len(self._values[axis]):
+                    break
+                indices[axis] = 0
+                axis -= 1
+            if axis < 0:
+                return
+
+    def _product_length(self) -> int:
+        if not self._has_product:
+            return 0
+        if not self._rules:
+            length = 1
+            for values in self._values:
+                length *= len(values)
+            return length
+        return self._count()
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self._product_length() + len(self._include)
+        return self._length
+
+    def _get_indices(self, index) -> tuple:
+        '''Get the value indices of the Nth product combination that is not excluded'''
+        if not self._rules:
+            indices = []
+            for values in reversed(self._values):
+                index, value_index = divmod(index, len(values))
+                indices.append(value_index)
+            return tuple(reversed(indices))
+
+        indices = ()
+        for values in self._values:
+            for value_index in range(len(values)):
+                count = self._count(indices + (value_index,))
+                if index < count:
+                    indices += (value_index,)
+                    break
+                index -= count
+        return indices
+
+    def __getitem__(self, index) -> 'MatrixInstance':
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f"Matrix index {index} out of range")
+
+        product_length = length - len(self._include)
+        if index >= product_length:
+            return MatrixInstance(**self._include[index - product_length])
+        return self._instance(self._get_indices(index))
+
+    def _iter_from(self, index) -> Iterator['MatrixInstance']:
+        product_length = len(self) - len(self._include)
+        if index < product_length:
+            for indices in self._iter_indices(self._get_indices(index)):
+                if not self._is_excluded(indices):
+                    yield self._instance(indices)
+            index = product_length
+
+        for combination in self._include[index - product_length:]:
+            yield MatrixInstance(**combination)
+
+    def __iter__(self) -> Iterator['MatrixInstance']:
+        if not self._rules:
+            for combination in itertools.product(*self._values) if self._has_product else ():
+                yield MatrixInstance(**dict(zip(self._keys, combination)))
+            for combination in self._include:
+                yield MatrixInstance(**combination)
+            return
+
+        yield from self._iter_from(0)
+
+    def shard(self, index: int, count: int) -> 'MatrixSlice':
+        '''Get the contiguous slice of combinations of a shard, out of the given count'''
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index+1}/{count}")
+        length = len(self)
+        return MatrixSlice(self, index * length // count, (index + 1) * length // count)
+
+class SampledMatrix(Matrix):
+    """
+    Fixed number of combinations sampled from the parameters, which can be lists of values or ranges.
+    Samples are drawn from a seeded generator, so every invocation gets the same combinations
+    """
+    METHODS = ('random', 'latin-hypercube')
+    # Draws per sample before giving up on excluded combinations
+    MAX_DRAWS = 100
+
+    def __init__(
+        self,
+        method: str = 'random',
+        samples: int = 10,
+        seed: int = 0,
+        include: List[dict] = None,
+        exclude: List[dict] = None,
+        **entries
+    ):
+        super().__init__(include, exclude)
+        if int(samples) < 1:
+            raise MatrixError("The number of samples must be positive")
+        self.method = method
+        self.samples = int(samples)
+        self.seed = seed
+        self._space: Dict[str, Union[Distribution, list]] = {
+            key: Distribution.parse(values) or list(values)
+            for key, values in entries.items()
+        }
+        self._combinations: Optional[List[dict]] = None
+
+    @property
+    def empty(self) -> bool:
+        return not self._space and not self._include
+
+    def _is_excluded_sample(self, sample: dict) -> bool:
+        return any(
+            all(key in sample and Matrix._matches(sample[key], rule[key]) for key in rule)
+            for rule in self._exclude
+        )
+
+    def _value(self, key: str, quantile: float):
+        axis = self._space[key]
+        if isinstance(axis, Distribution):
+            return axis.at(quantile)
+        return axis[min(int(quantile * len(axis)), len(axis) - 1)]
+
+    def _draw(self, rng: random.Random, count: int) -> List[dict]:
+        '''Draw random combinations, without repeating them if all the parameters are lists'''
+        if not all(isinstance(axis, list) for axis in self._space.values()):
+            samples = []
+            for _ in range(count * SampledMatrix.MAX_DRAWS):
+                if len(samples) == count:
+                    break
+                sample = {key: self._value(key, rng.random()) for key in self._space}
+                if not self._is_excluded_sample(sample):
+                    samples.append(sample)
+            return samples
+
+        grid = Matrix(exclude=self._exclude, **self._space)
+        indices = sorted(rng.sample(range(len(grid)), min(count, len(grid))))
+        return [Munch.toDict(grid[index]) for index in indices]
+
+    def _latin_hypercube(self, rng: random.Random, count: int) -> List[dict]:
+        '''Draw combinations whose values cover every quantile stratum of each parameter once'''
+        strata = {}
+        for key in self._space:
+            strata[key] = list(range(count))
+            rng.shuffle(strata[key])
+        samples = [
+            {key: self._value(key, (strata[key][index] + rng.random()) / count) for key in self._space}
+            for index in range(count)
+        ]
+        return [sample for sample in samples if not self._is_excluded_sample(sample)]
+
+    def _get_combinations(self) -> List[dict]:
+        if self._combinations is None:
+            rng = random.Random(self.seed)
+            if self.method == 'latin-hypercube':
+                samples = self._latin_hypercube(rng, self.samples)
+            else:
+                samples = self._draw(rng, self.samples)
+            self._combinations = samples + self._include
+        return self._combinations
+
+    def __len__(self):
+        return len(self._get_combinations())
+
+    def __getitem__(self, index) -> 'MatrixInstance':
+        return MatrixInstance(**self._get_combinations()[index])
+
+    def _iter_from(self, index) -> Iterator['MatrixInstance']:
+        for combination in self._get_combinations()[index:]:
+            yield MatrixInstance(**combination)
+
+    def __iter__(self) -> Iterator['MatrixInstance']:
+        return self._iter_from(0)
+
+class AdaptiveMatrix(SampledMatrix):
+    """
+    Successive halving of randomly sampled combinations. Every rung runs the remaining combinations
+    with 'eta' times the budget of the previous one, given as the 'resource' parameter,
+    and keeps the best 1/eta of them by the last value of a metric logged by their steps.
+    Hyperband repeats it in brackets, trading the number of combinations for their starting budget
+    """
+    METHODS = ('halving', 'hyperband')
+
+    def __init__(
+        self,
+        method: str = 'halving',
+        metric: str = None,
+        resource: str = None,
+        mode: str = 'max',
+        min_budget=1,
+        max_budget=None,
+        eta: int = 3,
+        samples: int = None,
+        seed: int = 0,
+        include: List[dict] = None,
+        exclude: List[dict] = None,
+        **entries
+    ):
+        if not metric or not resource:
+            raise MatrixError(f"The '{method}' strategy requires a 'metric' and a 'resource' parameter")
+        if mode not in ('max', 'min'):
+            raise MatrixError(f"Invalid mode '{mode}', expected 'max' or 'min'")
+        if include:
+            raise MatrixError(f"The '{method}' strategy doesn't support 'include'")
+        if int(eta) < 2:
+            raise MatrixError("The reduction factor 'eta' must be at least 2")
+
+        eta = int(eta)
+        if max_budget is None:
+            max_budget = min_budget * eta ** 3
+        if not 0 < min_budget <= max_budget:
+            raise MatrixError(
+                f"Invalid budgets, expected 0 < min_budget ({min_budget}) <= max_budget ({max_budget})"
+            )
+        super().__init__(method, samples or eta ** 3, seed, None, exclude, **entries)
+        self.metric = metric
+        self.resource = resource
+        self.mode = mode
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.eta = eta
+        # Best combination of the last rungs of the last search, and its metric.
+        # Rungs run with larger budgets are preferred, as their metrics are comparable
+        self.best: Optional[Tuple['MatrixInstance', float]] = None
+
+    def _budget(self, budget):
+        if isinstance(self.min_budget, int) and isinstance(self.max_budget, int):
+            return int(round(budget))
+        return budget
+
+    def brackets(self) -> List[Tuple[int, float]]:
+        '''Number of combinations and starting budget of every bracket'''
+        if self.method == 'halving':
+            return [(self.samples, self.min_budget)]
+        s_max = int(math.log(self.max_budget / self.min_budget) / math.log(self.eta) + 1e-9)
+        return [
+            (math.ceil((s_max + 1) / (s + 1) * self.eta ** s), self.max_budget / self.eta ** s)
+            for s in range(s_max, -1, -1)
+        ]
+
+    def rungs(self, count: int, budget) -> Iterator[Tuple[int, float]]:
+        '''Number of combinations and budget of every rung of a bracket'''
+        while True:
+            yield count, self._budget(budget)
+            if budget >= self.max_budget or count <= 1:
+                return
+            count = max(1, count // self.eta)
+            budget = min(budget * self.eta, self.max_budget)
+
+    def __len__(self):
+        '''Number of combinations run by a search'''
+        return sum(count for bracket in self.brackets() for count, _ in self.rungs(*bracket))
+
+    def __getitem__(self, index):
+        raise MatrixError("Combinations of adaptive strategies depend on the results of the previous ones")
+
+    def _iter_from(self, index):
+        raise MatrixError("Adaptive strategies can't be sharded")
+
+    def __iter__(self) -> Iterator['MatrixInstance']:
+        # Without results every combination ranks the same
+        return self.search(lambda instance: None)
+
+    def search(self, get_metric: Callable[['MatrixInstance'], Optional[float]]) -> Iterator['MatrixInstance']:
+        '''
+        Yield the combinations to run. The metrics of the combinations of a rung are requested
+        once all of them were yielded, so they must have been run by then
+        '''
+        rng = random.Random(self.seed)
+        sign = 1 if self.mode == 'max' else -1
+        self.best = None
+        for bracket_count, bracket_budget in self.brackets():
+            configurations = self._draw(rng, bracket_count)
+            last = None
+            for count, budget in self.rungs(len(configurations), bracket_budget):
+                configurations = configurations[:count]
+                instances = [
+                    MatrixInstance(**configuration, **{self.resource: budget})
+                    for configuration in configurations
+                ]
+                yield from instances
+
+                # Combinations without the metric, such as skipped ones, are ranked last
+                scores = [get_metric(instance) for instance in instances]
+                ranking = sorted(
+                    range(len(instances)),
+                    key=lambda index: (scores[index] is None, -sign * (scores[index] or 0))
+                )
+                configurations = [configurations[index] for index in ranking]
+
+                top = ranking[0]
+                last = (instances[top], scores[top], budget) if scores[top] is not None else None
+
+            # Rungs stop at the maximum budget, or earlier once a single combination is left
+            if last is not None and (
+                self.best is None or last[2] > self.best[0][self.resource]
+                or (last[2] == self.best[0][self.resource] and sign * last[1] > sign * self.best[1])
+            ):
+                self.best = last[:2]
+
+class MatrixSlice:
+    def __repr__(self):
+        return f"MatrixSlice({self._matrix!r}, {self._start}, {self._stop})"
+
+    def __init__(self, matrix: Matrix, start: int, stop: int):
+        self._matrix = matrix
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
 
-    def __iter__(self):
-        self._combinations = itertools.product(*self._params.values())
-        return self
+    def __getitem__(self, index) -> 'MatrixInstance':
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Matrix index {index} out of range")
+        return self._matrix[self._start + index]
 
-    def __next__(self):
-        return MatrixInstance(**dict(zip(self._params.keys(), next(self._combinations))))
+    def __iter__(self) -> Iterator['MatrixInstance']:
+        if self._start < self._stop:
+            yield from itertools.islice(
+                self._matrix._iter_from(self._start), len(self)
+            )
 
 class MatrixInstance(Munch):
     def __repr__(self):
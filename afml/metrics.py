@@ -0,0 +1,187 @@
+"""
+    Metrics logged by steps, sent to the afml process through an inherited pipe.
+    Steps buffer the metrics and write them in batches, each one a JSON header line
+    followed by the columns of every metric, in native byte order:
+
+        [[name, count], ...]
+        <count float64 values><count int64 steps>...
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from typing import Dict, Optional, Tuple
+
+
+# Step of the metrics logged without one
+NO_STEP = -(1 << 63)
+
+class MetricsWriter:
+    """
+    Buffer of the metrics logged by a step, flushed to the pipe of the afml process
+    """
+    BATCH_SIZE = 1024
+    FLUSH_INTERVAL = 1.0
+
+    _instance: Optional['MetricsWriter'] = None
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance() -> 'MetricsWriter':
+        if MetricsWriter._instance is None:
+            with MetricsWriter._instance_lock:
+                if MetricsWriter._instance is None:
+                    MetricsWriter._instance = MetricsWriter(MetricsWriter._get_fd())
+        return MetricsWriter._instance
+
+    @staticmethod
+    def close_instance():
+        with MetricsWriter._instance_lock:
+            if MetricsWriter._instance is not None:
+                MetricsWriter._instance.close()
+                MetricsWriter._instance = None
+
+    @staticmethod
+    def _get_fd() -> Optional[int]:
+        '''Descriptor given as '--afml-metrics fd:<number>', if the step was run by afml'''
+        argv = sys.argv[1:]
+        for index, arg in enumerate(argv):
+            if arg == '--afml-metrics' and index + 1 < len(argv):
+                location = argv[index + 1]
+            elif arg.startswith('--afml-metrics='):
+                location = arg.split('=', 1)[1]
+            else:
+                continue
+            if location.startswith('fd:') and location[3:].isdigit():
+                return int(location[3:])
+        return None
+
+    def __init__(self, fd: Optional[int]):
+        self.fd = fd
+        # name -> (values, steps)
+        self._columns: Dict[str, Tuple[array, array]] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def log(self, name: str, value, step: int = None):
+        with self._lock:
+            columns = self._columns.get(name)
+            if columns is None:
+                columns = self._columns[name] = (array('d'), array('q'))
+            columns[0].append(value)
+            columns[1].append(NO_STEP if step is None else step)
+            self._count += 1
+            if self._count < MetricsWriter.BATCH_SIZE and \
+                    time.monotonic() - self._last_flush < MetricsWriter.FLUSH_INTERVAL:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            columns, self._columns = self._columns, {}
+            self._count = 0
+            self._last_flush = time.monotonic()
+            if not columns or self.fd is None:
+                return
+
+            header = [[name, len(values)] for name, (values, _) in columns.items()]
+            data = memoryview(b''.join((
+                json.dumps(header, separators=(',', ':')).encode('utf-8'), b'\n',
+                *(column.tobytes() for pair in columns.values() for column in pair)
+            )))
+            try:
+                while data:
+                    data = data[os.write(self.fd, data):]
+            except OSError:
+                # The afml process is gone, later metrics are dropped
+                self.fd = None
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self.fd is not None:
+                try:
+                    os.close(self.fd)
+                except OSError:
+                    pass
+                self.fd = None
+
+class MetricsCollector:
+    """
+    Aggregation of the metrics received from a step, keeping the last value and statistics of each one
+    """
+    STREAM = 'metrics'
+
+    def __init__(self):
+        # name -> [last value, last step, count, min, max]
+        self.metrics: Dict[str, list] = {}
+        self._buffer = bytearray()
+        self._header = None
+        self._broken = False
+
+    def feed(self, data: bytes):
+        if self._broken:
+            return
+        buffer = self._buffer
+        buffer += data
+        position = 0
+        while True:
+            if self._header is None:
+                end = buffer.find(b'\n', position)
+                if end < 0:
+                    break
+                try:
+                    self._header = json.loads(buffer[position:end])
+                except ValueError:
+                    # Not a batch of metrics, the stream can't be read anymore
+                    self._broken = True
+                    buffer.clear()
+                    return
+                position = end + 1
+
+            size = 16 * sum(count for _, count in self._header)
+            if len(buffer) - position < size:
+                break
+            for name, count in self._header:
+                values, steps = array('d'), array('q')
+                values.frombytes(buffer[position:position + 8 * count])
+                position += 8 * count
+                steps.frombytes(buffer[position:position + 8 * count])
+                position += 8 * count
+                self._add(name, values, steps)
+            self._header = None
+        del buffer[:position]
+
+    def _add(self, name: str, values: array, steps: array):
+        if not values:
+            return
+        step = next((step for step in reversed(steps) if step != NO_STEP), None)
+        low, high = min(values), max(values)
+        metric = self.metrics.get(name)
+        if metric is None:
+            self.metrics[name] = [values[-1], step, len(values), low, high]
+            return
+        metric[0] = values[-1]
+        if step is not None:
+            metric[1] = step
+        metric[2] += len(values)
+        metric[3] = min(metric[3], low)
+        metric[4] = max(metric[4], high)
+
+    def __bool__(self):
+        return bool(self.metrics)
+
+    def last(self) -> Dict[str, Tuple[float, Optional[int]]]:
+        '''Last value of each metric, and the step it was logged at'''
+        return {name: (metric[0], metric[1]) for name, metric in self.metrics.items()}
+
+    def summary(self) -> Dict[str, dict]:
+        return {
+            name: {'last': last, 'step': step, 'count': count, 'min': low, 'max': high}
+            for name, (last, step, count, low, high) in self.metrics.items()
+        }
@@ -1,18 +1,28 @@
+import hashlib
 import importlib
 import importlib.util
+import os
+import sys
+import threading
 from pathlib import Path
+from types import ModuleType
+from typing import Dict, Tuple
 
 from .base import BaseObject
 from .utils.format import ParamsFormatter
 
 
 class Model(BaseObject):
+    # Modules loaded in this process, shared by all the models defined in the same file
+    _modules: Dict[Tuple[str, int], ModuleType] = {}
+    _modules_lock = threading.Lock()
+
     def __repr__(self):
         args = ', '.join(
             f'{k}={repr(v)}'
             for k, v in {
                 'name': super().name,
-                'source': f'{self.file}:{self.callable}',
+                'source': f'{self.file}:{self.callable_name}',
                 **self.params
             }.items()
         )
@@ -34,6 +44,14 @@ class Model(BaseObject):
             params=formatter.format(self.params)
         )
 
+    def to_definition(self) -> dict:
+        '''Definition of the model, as accepted by Model.parse'''
+        return {
+            'src': f'{self.file}:{self.callable_name}',
+            'name': super().name,
+            'params': dict(self.params),
+        }
+
     @staticmethod
     def parse(definition):
         if 'src' not in definition:
@@ -46,12 +64,33 @@ class Model(BaseObject):
             params=definition.get('params') or {}
         )
 
+    @staticmethod
+    def load_module(file) -> ModuleType:
+        '''Load a model file, reusing the module loaded before unless the file was modified'''
+        path = os.path.abspath(file)
+        key = (path, os.stat(path).st_mtime_ns)
+        with Model._modules_lock:
+            module = Model._modules.get(key)
+            if module is None:
+                # Registered with a name unique to the file, so built objects can be pickled
+                name = f"afml_model_{Path(path).stem}_{hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]}"
+                spec = importlib.util.spec_from_file_location(name, path)
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[name] = module
+                try:
+                    spec.loader.exec_module(module)
+                except BaseException:
+                    del sys.modules[name]
+                    raise
+                for loaded_key in [k for k in Model._modules if k[0] == path]:
+                    del Model._modules[loaded_key]
+                Model._modules[key] = module
+            return module
+
     @property
     def module(self):
         if not self._module:
-            spec = importlib.util.spec_from_file_location(self.name, self.file)
-            self._module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(self._module)
+            self._module = Model.load_module(self.file)
         return self._module
 
     @property
@@ -59,5 +98,10 @@ class Model(BaseObject):
         return getattr(self.module, self.callable_name)
 
     def build(self, **kwargs):
-        params = {**self._params, **kwargs}
-        return self.callable(**params)
+        '''Build the model with its params, overridden by the given ones'''
+        return self.callable(**{**self._params, **kwargs})
+
+    def build_cached(self, **kwargs):
+        '''Build the model as 'build', storing the built object in '.afml/models' so later builds load a copy'''
+        from .cache import ModelCache
+        return ModelCache.get_instance().build(self, {**self._params, **kwargs})
@@ -0,0 +1,225 @@
+"""
+    Packed datasets, whose files are concatenated into a few large shards.
+    The folder of a packed dataset contains the shards and an index of the files:
+
+        index.json
+        shard-00000.bin
+        shard-00001.bin
+        ...
+
+    Shards are memory-mapped, so reading a file returns a view of the shard without copying it.
+    NumPy '.npy' files can be packed as array sections, aligned to be read as arrays in place
+"""
+import io
+import json
+import mmap
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .loader import DataLoader
+from .utils.utils import Utils
+
+
+class PackedDatasetError(ValueError): ...
+
+class PackedDataset:
+    FORMAT = 'afml-pack'
+    VERSION = 1
+    INDEX_FILE = 'index.json'
+    ALIGNMENT = 64
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        index = PackedDataset._read_index(self.folder)
+        if index is None:
+            raise PackedDatasetError(f"'{folder}' is not a packed dataset")
+
+        self.shards: List[str] = index['shards']
+        # name -> [shard, offset, length] or [shard, offset, length, [dtype, shape, fortran_order, header_length]]
+        self.files: Dict[str, List] = index['files']
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read_index(folder: Path) -> Optional[dict]:
+        try:
+            with open(folder / PackedDataset.INDEX_FILE, 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(index, dict) or index.get('format') != PackedDataset.FORMAT:
+            return None
+        if index.get('version') != PackedDataset.VERSION:
+            raise PackedDatasetError(
+                f"Unsupported version {index.get('version')} of the packed dataset '{folder}'"
+            )
+        return index
+
+    @staticmethod
+    def is_packed(folder) -> bool:
+        return (Path(folder) / PackedDataset.INDEX_FILE).is_file() and \
+            PackedDataset._read_index(Path(folder)) is not None
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, name: str):
+        return name in self.files
+
+    def names(self) -> Iterator[str]:
+        return iter(self.files)
+
+    def _map(self, shard: int) -> mmap.mmap:
+        shard_map = self._maps.get(shard)
+        if shard_map is None:
+            with self._lock:
+                shard_map = self._maps.get(shard)
+                if shard_map is None:
+                    with open(self.folder / self.shards[shard], 'rb') as shard_file:
+                        shard_map = self._maps[shard] = mmap.mmap(
+                            shard_file.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+        return shard_map
+
+    def _entry(self, name: str) -> List:
+        try:
+            return self.files[name]
+        except KeyError:
+            raise FileNotFoundError(f"'{name}' not found in the packed dataset '{self.folder}'") from None
+
+    def read(self, name: str) -> memoryview:
+        '''Content of a packed file, as a read-only view of its shard'''
+        shard, offset, length, *_ = self._entry(name)
+        if length == 0:
+            return memoryview(b'')
+        return memoryview(self._map(shard))[offset:offset + length]
+
+    def array(self, name: str):
+        '''Array of a packed '.npy' file, sharing the memory of its shard when it was packed as an array'''
+        import numpy as np
+
+        shard, offset, length, *array = self._entry(name)
+        if not array:
+            return np.load(io.BytesIO(self.read(name)), allow_pickle=False)
+
+        dtype, shape, fortran_order, header_length = array[0]
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        data = np.frombuffer(
+            self._map(shard), dtype=dtype, count=count, offset=offset + header_length
+        ) if count else np.empty(0, dtype=dtype)
+        return data.reshape(shape, order='F' if fortran_order else 'C')
+
+    def close(self):
+        with self._lock:
+            for shard_map in self._maps.values():
+                try:
+                    shard_map.close()
+                except BufferError:
+                    # Views of the shard are still in use, it will be unmapped when released
+                    pass
+            self._maps = {}
+
+    @staticmethod
+    def _array_header(data: bytes) -> Optional[list]:
+        '''Description of a '.npy' file whose data can be read in place, or None'''
+        import numpy as np
+
+        try:
+            stream = io.BytesIO(data)
+            version = np.lib.format.read_magic(stream)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+            else:
+                return None
+        except (ValueError, OSError):
+            return None
+        if dtype.hasobject:
+            return None
+        return [np.lib.format.dtype_to_descr(dtype), list(shape), fortran_order, stream.tell()]
+
+    @staticmethod
+    def pack(
+        source,
+        output,
+        shard_size='256M',
+        arrays: bool = False,
+        workers: int = None
+    ) -> 'PackedDataset':
+        '''
+        Pack the files of a folder into shards of about 'shard_size' bytes.
+        With 'arrays', the '.npy' files are packed as arrays, which requires NumPy
+        '''
+        source, output = Path(source), Path(output)
+        if source.resolve() == output.resolve():
+            raise PackedDatasetError("The packed dataset can't replace its source folder")
+        if PackedDataset.is_packed(source):
+            raise PackedDatasetError(f"'{source}' is already packed")
+        if arrays:
+            # Fail before packing anything if NumPy isn't available
+            import numpy
+
+        shard_size = Utils.parse_size(shard_size)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        # The shards are written to a temporary folder, which replaces the output once complete
+        folder = output.parent / f'.{output.name}.tmp-{os.getpid()}'
+        shutil.rmtree(folder, ignore_errors=True)
+        folder.mkdir()
+
+        try:
+            names = [name for name, _ in DataLoader.walk(source)]
+            shards, files = [], {}
+            shard_file = None
+            position = 0
+
+            def load(name: str) -> Tuple[bytes, Optional[list]]:
+                data = DataLoader.read_file(source / name)
+                array = PackedDataset._array_header(data) if arrays and name.endswith('.npy') else None
+                return data, array
+
+            try:
+                for name, (data, array) in zip(names, DataLoader.prefetch(load, names, workers)):
+                    if shard_file is None or (position > 0 and position + len(data) > shard_size):
+                        if shard_file is not None:
+                            shard_file.close()
+                        shards.append(f'shard-{len(shards):05d}.bin')
+                        shard_file = open(folder / shards[-1], 'wb')
+                        position = 0
+
+                    # Records are aligned, and arrays have their data aligned instead of their header
+                    start = position + (array[3] if array else 0)
+                    padding = -start % PackedDataset.ALIGNMENT
+                    shard_file.write(b'\0' * padding)
+                    position += padding
+
+                    files[name] = [len(shards) - 1, position, len(data), *([array] if array else [])]
+                    shard_file.write(data)
+                    position += len(data)
+            finally:
+                if shard_file is not None:
+                    shard_file.close()
+
+            with open(folder / PackedDataset.INDEX_FILE, 'w', encoding='utf-8') as index_file:
+                json.dump({
+                    'format': PackedDataset.FORMAT,
+                    'version': PackedDataset.VERSION,
+                    'source': str(source.resolve()),
+                    'shards': shards,
+                    'files': files,
+                }, index_file, separators=(',', ':'))
+
+            if output.exists():
+                if not PackedDataset.is_packed(output) and any(output.iterdir()):
+                    raise PackedDatasetError(f"'{output}' exists and is not a packed dataset")
+                shutil.rmtree(output)
+            os.replace(folder, output)
+        except BaseException:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+
+        return PackedDataset(output)
@@ -0,0 +1,543 @@
+"""
+    Execution plan of a run: every step of every job matrix instance, formatted before anything runs,
+    so mistakes in any combination are found before the first step starts.
+    Plans can be saved as JSON and run later without formatting the project again:
+
+        {"format": "afml-plan", "version": 1, "time": {...}, "project": <sha256>, "jobs": [
+            {"id", "job", "project_matrix", "job_matrix", "needs", "params", "dataset", "model", "conditions",
+             "steps": [{"step", "executor", "kwargs", "conditions", "resources", "context"}, ...]},
+            ...
+        ]}
+"""
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from termcolor import cprint
+
+from .context import RunContext
+from .dataset import Dataset
+from .executor import Executor, get_executor
+from .matrix import MatrixInstance
+from .logs import StepLog
+from .model import Model
+from .resources import Resources
+from .session import Session
+from .utils.output import ThreadOutput
+from .utils.time import Time
+from .utils.utils import Utils
+
+
+class PlanError(ValueError): ...
+
+class StepUnit:
+    """
+    Step of a job matrix instance, with its executor arguments, context and conditions already formatted
+    """
+    RETRY_DELAY = 2.0
+    MAX_RETRY_DELAY = 120.0
+
+    def __init__(
+        self,
+        job,
+        step,
+        matrix: dict,
+        executor: Executor,
+        kwargs: dict,
+        ctx: RunContext,
+        conditions: dict = None,
+        resources: Optional[Resources] = None
+    ):
+        # Jobs and steps of loaded plans only keep their names
+        self.job = job
+        self.step = step
+        self.matrix = matrix
+        self.executor = executor
+        self.kwargs = kwargs
+        self.ctx = ctx
+        self.conditions = conditions or {}
+        self.resources = resources
+        # Whether the task running the step already holds its resources, see Scheduler
+        self.reserved = False
+        # Last value of the metrics of the last execution
+        self.metrics: Dict[str, float] = {}
+
+    def __repr__(self):
+        return f"StepUnit({self.job.display_name}, {self.step.display_name}, {self.matrix})"
+
+    @staticmethod
+    def get_retry_delay(attempt: int) -> float:
+        '''Seconds to wait before a retry, doubled on every attempt and randomized so retries don't align'''
+        return min(StepUnit.RETRY_DELAY * 2 ** (attempt - 1), StepUnit.MAX_RETRY_DELAY) * random.uniform(0.5, 1)
+
+    def to_definition(self) -> dict:
+        return {
+            'step': self.step.display_name,
+            'executor': self.executor.to_definition(),
+            'kwargs': self.kwargs,
+            'conditions': self.conditions,
+            'resources': self.resources.to_definition() if self.resources is not None else None,
+            'context': base64.b64encode(self.ctx.to_bytes()).decode('ascii'),
+        }
+
+    @staticmethod
+    def parse(definition: dict, job, matrix: dict) -> 'StepUnit':
+        executor = get_executor(definition['executor'])
+        if executor is None:
+            raise PlanError(f"Unknown executor {definition['executor']}")
+        return StepUnit(
+            job=job,
+            step=SimpleNamespace(display_name=definition['step']),
+            matrix=matrix,
+            executor=executor,
+            kwargs=definition.get('kwargs') or {},
+            ctx=RunContext.from_bytes(base64.b64decode(definition['context'])),
+            conditions=definition.get('conditions'),
+            resources=Resources.parse(definition.get('resources'))
+        )
+
+    def run(self, session: Session = None, job_record: int = None) -> bool:
+        '''Run the step, returning True if it failed'''
+        cprint(f"---- {self.step.display_name} [{self.executor}] ----", 'blue')
+        session = session or Session()
+        job, step = self.job, self.step
+
+        if session.journal is not None and session.journal.is_completed(job, step, self.matrix):
+            cprint("Completed by the resumed run, skipping step", 'cyan')
+            session.report_metrics(job, self.matrix, session.journal.get_metrics(job, step, self.matrix))
+            return False
+
+        if not all(Utils.check_condition(condition, expression)
+                   for condition, expression in self.conditions.items()):
+            cprint("Skipping step", 'yellow')
+            return False
+
+        key = None
+        if session.dedupe is not None:
+            key = self.get_work_key()
+            original = session.dedupe.claim(key, self)
+            if original is not None:
+                return self._reuse(session, job_record, original)
+
+        failed = True
+        try:
+            failed = self._execute(session, job_record)
+        finally:
+            if key is not None:
+                session.dedupe.finish(key, failed, self.metrics)
+        return failed
+
+    def get_work_key(self) -> str:
+        '''
+        Hash of the work done by the step: its executor and arguments, and the params, dataset and model
+        of its context. Matrix values only count through the params formatted with them
+        '''
+        return hashlib.sha256(json.dumps({
+            'job': self.job.display_name,
+            'step': self.step.display_name,
+            'executor': self.executor.to_definition(),
+            'kwargs': self.kwargs,
+            'params': [self.ctx.project_params, self.ctx.job_params, self.ctx.step_params],
+            'dataset': self.ctx.dataset.to_definition() if self.ctx.dataset is not None else None,
+            'model': self.ctx.model.to_definition() if self.ctx.model is not None else None,
+        }, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+    def _record(
+        self,
+        session: Session,
+        job_record: Optional[int],
+        started: float,
+        status: str,
+        exit_code: int = None,
+        usage: dict = None,
+        metrics: dict = None
+    ):
+        ctx = self.ctx
+        if session.history is not None:
+            session.history.add_step(
+                job_record, self.job, self.step, status, started,
+                ctx.params, ctx.matrix, ctx.dataset, ctx.model, exit_code, usage, metrics
+            )
+        if session.journal is not None:
+            session.journal.record(self.job, self.step, self.matrix, status, {
+                name: value for name, (value, _) in (metrics or {}).items()
+            })
+
+    def _reuse(self, session: Session, job_record: Optional[int], original: 'StepDeduplicator.Entry') -> bool:
+        '''Share the result of an identical step, once it finished'''
+        started = time.time()
+        original.done.wait()
+        source = original.unit
+        cprint(
+            f"Same work as {source.job.display_name}"
+            + (f" {source.matrix}" if source.matrix else '')
+            + ", reusing its result",
+            'cyan'
+        )
+        if original.failed:
+            cprint("ERROR: Step execution failed!", 'red')
+            return True
+        self.metrics = dict(original.metrics)
+        session.report_metrics(self.job, self.matrix, self.metrics)
+        self._record(session, job_record, started, 'deduplicated', metrics={
+            name: (value, None) for name, value in self.metrics.items()
+        })
+        return False
+
+    def _execute(self, session: Session, job_record: Optional[int]) -> bool:
+        job, step, ctx = self.job, self.step, self.ctx
+        started = time.time()
+
+        def add_record(status: str, exit_code: int = None, usage: dict = None, metrics: dict = None):
+            self._record(session, job_record, started, status, exit_code, usage, metrics)
+
+        cache_key = None
+        if session.cache is not None:
+            cache_key = session.cache.get_key(self.executor, ctx, self.kwargs)
+            result = session.cache.get_result(cache_key)
+            if result is not None:
+                cached_time = datetime.fromtimestamp(result['time'])
+                cprint(f"Cached result from {cached_time:%Y-%m-%d %H:%M:%S}, skipping step", 'cyan')
+                cprint(result['output'], 'yellow', end='')
+                add_record('cached')
+                return False
+
+        # Captured output is only printed once finished, so progress updates are not kept
+        show_progress = not ThreadOutput.capturing()
+        for attempt in range(session.retries + 1):
+            if attempt > 0:
+                delay = StepUnit.get_retry_delay(attempt)
+                cprint(f"Retrying in {delay:.1f}s, attempt {attempt + 1} of {session.retries + 1}", 'yellow')
+                time.sleep(delay)
+                started = time.time()
+
+            output = []
+            acquired = nullcontext()
+            if session.resources is not None and not self.reserved:
+                acquired = session.resources.acquire(
+                    self.resources, on_wait=lambda resources: cprint(f"Waiting for {resources}", 'yellow')
+                )
+            if session.logs is not None:
+                log = session.logs.open(job, step, self.matrix, attempt + 1, show_progress)
+            else:
+                log = StepLog(show_progress=show_progress)
+            with acquired, log:
+                if session.coordinator is not None:
+                    process = session.coordinator.start(self.executor, ctx, self.kwargs)
+                else:
+                    process = self.executor.start(ctx, self.kwargs)
+                for text in process:
+                    log.write(text)
+                    if cache_key is not None and not text.progress:
+                        output.append(text)
+            metrics = process.metrics
+            if metrics:
+                cprint("Metrics: " + ', '.join(
+                    f"{name}={value:g}" + (f" (step {metric_step})" if metric_step is not None else '')
+                    for name, (value, metric_step) in metrics.last().items()
+                ), 'cyan')
+                self.metrics = {name: value for name, (value, _) in metrics.last().items()}
+                session.report_metrics(job, self.matrix, self.metrics)
+            if session.recorder is not None:
+                session.recorder.record(
+                    job, step, self.matrix, process.exit_code, process.usage,
+                    metrics.summary() if metrics else None
+                )
+            add_record(
+                'success' if process.exit_code == 0 else 'failed', process.exit_code, process.usage,
+                metrics.last() if metrics else None
+            )
+            if process.exit_code == 0:
+                break
+            cprint("ERROR: Step execution failed!", 'red')
+            log.report()
+        else:
+            return True
+
+        if cache_key is not None:
+            session.cache.put_result(cache_key, ''.join(output))
+
+        return False
+
+class StepDeduplicator:
+    """
+    Steps started in a run by the work they do, so identical steps of other matrix instances
+    wait for the first one and reuse its result instead of running again
+    """
+
+    class Entry:
+        def __init__(self, unit: StepUnit):
+            self.unit = unit
+            self.done = threading.Event()
+            self.failed = False
+            self.metrics: Dict[str, float] = {}
+
+    def __init__(self):
+        self._entries: Dict[str, StepDeduplicator.Entry] = {}
+        self._lock = threading.Lock()
+        self.steps = 0
+        self.saved = 0
+
+    def claim(self, key: str, unit: StepUnit) -> Optional['StepDeduplicator.Entry']:
+        '''Entry of the identical step started before, or None if this is the first one'''
+        with self._lock:
+            self.steps += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.saved += 1
+                return entry
+            self._entries[key] = StepDeduplicator.Entry(unit)
+            return None
+
+    def finish(self, key: str, failed: bool, metrics: Dict[str, float] = None):
+        entry = self._entries[key]
+        entry.failed = failed
+        entry.metrics = metrics or {}
+        entry.done.set()
+
+    def report(self):
+        if self.steps:
+            cprint(
+                f"Deduplication: {self.saved} of {self.steps} step execution(s) reused the result "
+                f"of an identical step",
+                'cyan'
+            )
+
+class JobUnit:
+    """
+    Job matrix instance, with the steps to run for it
+    """
+
+    def __init__(
+        self,
+        id: int,
+        job,
+        project_matrix: MatrixInstance,
+        job_matrix: MatrixInstance,
+        params: dict = None,
+        dataset: Dataset = None,
+        model: Model = None,
+        conditions: dict = None,
+        steps: List[StepUnit] = None,
+        needs: List[int] = None
+    ):
+        self.id = id
+        self.job = job
+        self.project_matrix = project_matrix
+        self.job_matrix = job_matrix
+        self.matrix = project_matrix.merge(job_matrix)
+        # Formatted project and job params, as recorded in the history
+        self.params = params or {}
+        self.dataset = dataset
+        self.model = model
+        self.conditions = conditions or {}
+        self.steps = steps or []
+        # Units of the jobs needed by this one, within the same project matrix instance
+        self.needs = needs or []
+
+    def __repr__(self):
+        return f"JobUnit({self.id}, {self.job.display_name}, {self.matrix})"
+
+    @property
+    def resources(self) -> Optional[Resources]:
+        '''Resources needed to run the instance, whose steps run one at a time'''
+        return Resources.largest([step.resources for step in self.steps])
+
+    def to_definition(self) -> dict:
+        return {
+            'id': self.id,
+            'job': self.job.display_name,
+            'project_matrix': dict(self.project_matrix),
+            'job_matrix': dict(self.job_matrix),
+            'needs': self.needs,
+            'params': self.params,
+            'dataset': self.dataset.to_definition() if self.dataset is not None else None,
+            'model': self.model.to_definition() if self.model is not None else None,
+            'conditions': self.conditions,
+            'steps': [step.to_definition() for step in self.steps],
+        }
+
+    @staticmethod
+    def parse(definition: dict, job=None) -> 'JobUnit':
+        unit = JobUnit(
+            id=definition['id'],
+            job=job or SimpleNamespace(display_name=definition['job']),
+            project_matrix=MatrixInstance(**definition.get('project_matrix', {})),
+            job_matrix=MatrixInstance(**definition.get('job_matrix', {})),
+            params=definition.get('params'),
+            dataset=Dataset.parse(definition['dataset']) if definition.get('dataset') else None,
+            model=Model.parse(definition['model']) if definition.get('model') else None,
+            conditions=definition.get('conditions'),
+            needs=definition.get('needs')
+        )
+        unit.steps = [
+            StepUnit.parse(step, unit.job, unit.matrix)
+            for step in definition.get('steps', [])
+        ]
+        return unit
+
+    def run(self, session: Session = None) -> bool:
+        '''Run the steps of the instance in order, returning True if one of them failed'''
+        if len(self.job_matrix) > 0:
+            cprint(f" {str(self.job_matrix):-<100}", 'magenta', 'on_white')
+
+        if not all(Utils.check_condition(condition, expression)
+                   for condition, expression in self.conditions.items()):
+            cprint("Skipping job", 'yellow')
+            return False
+
+        record = None
+        if session is not None and session.history is not None:
+            record = session.history.add_job(self.job, self.matrix, self.params, self.dataset, self.model)
+
+        failed = False
+        try:
+            for step in self.steps:
+                failed = step.run(session, record)
+                if failed:
+                    return True
+                print()
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            if record is not None:
+                session.history.finish_job(record, 'failed' if failed else 'success')
+
+        return False
+
+class SearchUnit(JobUnit):
+    """
+    Job with an adaptive matrix, whose combinations are only planned while the job runs,
+    as they depend on the metrics of the previous ones
+    """
+
+    def __init__(self, id: int, job, project, project_matrix: MatrixInstance, needs: List[int] = None):
+        super().__init__(id, job, project_matrix, MatrixInstance(), needs=needs)
+        self.project = project
+
+    @property
+    def resources(self) -> Optional[Resources]:
+        # Steps are only planned while the job runs, so each one waits for its own resources
+        return None
+
+    def to_definition(self) -> dict:
+        raise PlanError(
+            f"{self.job.display_name} uses an adaptive matrix, whose combinations can't be planned in advance"
+        )
+
+    def run(self, session: Session = None) -> bool:
+        return self.job.run(self.project, self.project_matrix, session)
+
+class Plan:
+    FORMAT = 'afml-plan'
+    VERSION = 1
+
+    def __init__(self, jobs: List[JobUnit] = None, project: str = None, time: dict = None):
+        self.jobs = jobs or []
+        # Hash of the project file the plan was made from
+        self.project = project
+        # Time of the run the plan was formatted with
+        self.time = time or Time.get_params()
+
+    @property
+    def steps(self) -> int:
+        return sum(len(unit.steps) for unit in self.jobs)
+
+    def counts(self) -> Dict[str, List[int]]:
+        '''Number of matrix instances and steps of each job'''
+        counts: Dict[str, List[int]] = {}
+        for unit in self.jobs:
+            job_counts = counts.setdefault(unit.job.display_name, [0, 0])
+            if isinstance(unit, SearchUnit):
+                job_counts[0] += len(unit.job.matrix)
+                job_counts[1] += len(unit.job.matrix) * len(unit.job.steps)
+            else:
+                job_counts[0] += 1
+                job_counts[1] += len(unit.steps)
+        return counts
+
+    def count_duplicates(self) -> int:
+        '''Number of steps doing the same work as a previous one, which deduplicated runs reuse'''
+        keys = [step.get_work_key() for unit in self.jobs for step in unit.steps]
+        return len(keys) - len(set(keys))
+
+    def show(self, steps=False):
+        '''Print the number of instances and steps of each job, and optionally every step'''
+        if steps:
+            for unit in self.jobs:
+                if isinstance(unit, SearchUnit):
+                    cprint(f"[{unit.id}] {unit.job.display_name} {unit.project_matrix}: adaptive", 'green')
+                    continue
+                matrix = unit.matrix if len(unit.matrix) > 0 else ''
+                cprint(f"[{unit.id}] {unit.job.display_name} {matrix}".rstrip(), 'green')
+                for step in unit.steps:
+                    print(f"  {step.step.display_name} [{step.executor}] {dict(step.kwargs) or ''}".rstrip())
+            print()
+
+        counts = self.counts()
+        adaptive = {unit.job.display_name for unit in self.jobs if isinstance(unit, SearchUnit)}
+        Utils.print_table(['job', 'instances', 'steps'], [
+            [job, f"{instances}{'*' if job in adaptive else ''}", str(job_steps)]
+            for job, (instances, job_steps) in counts.items()
+        ])
+        print(
+            f"Total: {len(counts)} job(s), {sum(count[0] for count in counts.values())} instance(s), "
+            f"{sum(count[1] for count in counts.values())} step(s)"
+        )
+        if adaptive:
+            print("* Adaptive matrices, planned while running. Counts are the planned totals")
+
+    def to_definition(self) -> dict:
+        return {
+            'format': Plan.FORMAT,
+            'version': Plan.VERSION,
+            'time': self.time,
+            'project': self.project,
+            'jobs': [unit.to_definition() for unit in self.jobs],
+        }
+
+    @staticmethod
+    def parse(definition: dict) -> 'Plan':
+        if definition.get('format') != Plan.FORMAT or definition.get('version') != Plan.VERSION:
+            raise PlanError(f"Unsupported plan format: {definition.get('format')} {definition.get('version')}")
+
+        # Units of the same job share it, so they are grouped when run sequentially
+        jobs = {}
+        return Plan(
+            jobs=[
+                JobUnit.parse(unit, jobs.setdefault(unit['job'], SimpleNamespace(display_name=unit['job'])))
+                for unit in definition.get('jobs', [])
+            ],
+            project=definition.get('project'),
+            time=definition.get('time')
+        )
+
+    def save(self, file):
+        try:
+            content = json.dumps(self.to_definition(), separators=(',', ':'))
+        except TypeError as e:
+            raise PlanError(f"The plan can't be saved: {e}") from None
+        with open(file, 'w', encoding='utf-8') as plan_file:
+            plan_file.write(content)
+
+    @staticmethod
+    def load(file) -> 'Plan':
+        with open(file, 'r', encoding='utf-8') as plan_file:
+            try:
+                definition = json.load(plan_file)
+            except ValueError as e:
+                raise PlanError(f"Invalid plan file '{file}': {e}") from None
+        return Plan.parse(definition)
+
+    @staticmethod
+    def hash_project(project_file) -> str:
+        with open(project_file, 'rb') as content:
+            return hashlib.sha256(content.read()).hexdigest()
@@ -0,0 +1,303 @@
+import codecs
+import os
+import queue
+import re
+import selectors
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+from .metrics import MetricsCollector
+
+
+class Output(str):
+    """
+    Piece of text written by a process to one of its streams.
+    Progress updates are the pieces terminated by a carriage return
+    """
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+
+    def __new__(cls, text: str, stream: str = STDERR, progress: bool = False):
+        output = super().__new__(cls, text)
+        output.stream = stream
+        output.progress = progress
+        return output
+
+class OutputSplitter:
+    """
+    Split decoded output into lines and carriage return updates, buffering partial lines
+    """
+    MAX_PARTIAL_LINE = 1 << 16
+    _separators = re.compile(r'\r\n|\n|\r')
+
+    def __init__(self, stream: str):
+        self.stream = stream
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buffer = ''
+
+    def feed(self, data: bytes, final: bool = False) -> List[Output]:
+        self._buffer += self._decoder.decode(data, final)
+
+        outputs = []
+        start = 0
+        for separator in OutputSplitter._separators.finditer(self._buffer):
+            # A trailing '\r' may be the start of a '\r\n'
+            if separator.group() == '\r' and separator.end() == len(self._buffer) and not final:
+                break
+            if separator.group() == '\r':
+                if separator.start() > start:
+                    outputs.append(Output(
+                        self._buffer[start:separator.end()], self.stream, progress=True
+                    ))
+            else:
+                outputs.append(Output(self._buffer[start:separator.end()], self.stream))
+            start = separator.end()
+        self._buffer = self._buffer[start:]
+
+        if self._buffer and (final or len(self._buffer) >= OutputSplitter.MAX_PARTIAL_LINE):
+            outputs.append(Output(self._buffer, self.stream))
+            self._buffer = ''
+
+        return outputs
+
+class ResourceUsage:
+    """
+    Resources used by finished child processes, including the children they waited for
+    """
+
+    @staticmethod
+    def read_io(pid: int) -> dict:
+        '''I/O counters of a process, which are only available on Linux'''
+        try:
+            with open(f'/proc/{pid}/io', 'r', encoding='ascii') as io_file:
+                counters = dict(line.split(':', 1) for line in io_file if ':' in line)
+        except (OSError, ValueError):
+            return {}
+        try:
+            return {
+                'read_bytes': int(counters['read_bytes']),
+                'write_bytes': int(counters['write_bytes']),
+                'read_chars': int(counters['rchar']),
+                'write_chars': int(counters['wchar']),
+            }
+        except (KeyError, ValueError):
+            return {}
+
+    @staticmethod
+    def from_rusage(rusage) -> dict:
+        return {
+            'user': rusage.ru_utime,
+            'system': rusage.ru_stime,
+            # Reported in kilobytes, except in macOS
+            'max_rss': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        }
+
+    @staticmethod
+    def wait(pid: int = -1, block: bool = True) -> Optional[Tuple[int, int, dict]]:
+        '''
+        Reap a child process, or any child with pid -1, returning its pid, exit code and usage.
+        Returns None if no child finished and block is False
+        '''
+        io = {}
+        options = 0 if block else os.WNOHANG
+        if hasattr(os, 'waitid'):
+            # The I/O counters are read while the finished process is not reaped yet
+            info = os.waitid(
+                os.P_PID if pid > 0 else os.P_ALL, max(pid, 0),
+                os.WEXITED | os.WNOWAIT | options
+            )
+            if info is None:
+                return None
+            pid = info.si_pid
+            io = ResourceUsage.read_io(pid)
+            options = 0
+
+        pid, status, rusage = os.wait4(pid, options)
+        if pid == 0:
+            return None
+        return pid, os.waitstatus_to_exitcode(status), {**ResourceUsage.from_rusage(rusage), **io}
+
+class Process:
+    """
+    Running process whose output streams are read by the process supervisor.
+    Iterating it yields its output, and returns its exit code once it finishes
+    """
+
+    def __init__(self, popen: subprocess.Popen, streams: Dict[str, IO[bytes]]):
+        self.popen = popen
+        self.exit_code = None
+        # Wall time, CPU time, peak memory and I/O, known once the process finished
+        self.usage = {}
+        # Metrics logged by the process, if it was given a metrics stream
+        self.metrics = MetricsCollector()
+        self._start_time = time.perf_counter()
+        self._streams = {
+            stream: file for stream, file in streams.items() if file is not None
+        }
+        self._splitters = {
+            stream: OutputSplitter(stream) for stream in self._streams
+            if stream != MetricsCollector.STREAM
+        }
+        self._open_streams = len(self._streams)
+        self._queue = queue.Queue()
+        if self._open_streams == 0:
+            self._queue.put(None)
+        else:
+            ProcessSupervisor.get_instance().watch(self)
+
+    @staticmethod
+    def get_env() -> Dict[str, str]:
+        '''
+        Environment of the started processes. Their output goes to pipes, where Python would
+        buffer it in blocks, so Python processes are unbuffered unless configured otherwise
+        '''
+        return {'PYTHONUNBUFFERED': '1', **os.environ}
+
+    @staticmethod
+    def spawn(command: str, streams: Dict[str, IO[bytes]] = None, **kwargs) -> 'Process':
+        '''Start a shell command, capturing its stdout and stderr, and reading any other given streams'''
+        popen = subprocess.Popen(
+            command,
+            shell=True,
+            cwd=os.getcwd(),
+            env=Process.get_env(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **kwargs
+        )
+        return Process(popen, {
+            Output.STDOUT: popen.stdout,
+            Output.STDERR: popen.stderr,
+            **(streams or {}),
+        })
+
+    def _feed(self, stream: str, data: bytes):
+        if stream == MetricsCollector.STREAM:
+            self.metrics.feed(data)
+        else:
+            for output in self._splitters[stream].feed(data, final=not data):
+                self._queue.put(output)
+
+        if not data:
+            self._open_streams -= 1
+            if self._open_streams == 0:
+                self._queue.put(None)
+
+    def wait(self) -> int:
+        if self.popen.returncode is None and hasattr(os, 'wait4'):
+            try:
+                _, exit_code, self.usage = ResourceUsage.wait(self.popen.pid)
+                self.popen.returncode = exit_code
+            except ChildProcessError:
+                # Already reaped by the Popen object
+                pass
+        return self.popen.wait()
+
+    def kill(self):
+        if self.popen.poll() is None:
+            self.popen.kill()
+
+    def __iter__(self) -> Iterator[Output]:
+        try:
+            while True:
+                output = self._queue.get()
+                if output is None:
+                    break
+                yield output
+        finally:
+            if self.exit_code is None and self._open_streams > 0:
+                # The output is no longer consumed
+                self.kill()
+                self.wait()
+
+        self.exit_code = self.wait()
+        self.usage.setdefault('wall', time.perf_counter() - self._start_time)
+        return self.exit_code
+
+class ProcessSupervisor:
+    """
+    Single thread reading the output of all the running processes without blocking
+    """
+    READ_SIZE = 1 << 16
+
+    _instance: Optional['ProcessSupervisor'] = None
+    _instance_lock = threading.Lock()
+
+    @staticmethod
+    def get_instance() -> 'ProcessSupervisor':
+        with ProcessSupervisor._instance_lock:
+            if ProcessSupervisor._instance is None:
+                ProcessSupervisor._instance = ProcessSupervisor()
+            return ProcessSupervisor._instance
+
+    def __init__(self):
+        self._pending = queue.SimpleQueue()
+        # Pipes can't be selected on Windows, where each stream is read by a thread
+        self._selector = selectors.DefaultSelector() if os.name != 'nt' else None
+        if self._selector is not None:
+            self._wakeup_read, self._wakeup_write = os.pipe()
+            os.set_blocking(self._wakeup_read, False)
+            os.set_blocking(self._wakeup_write, False)
+            self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+            threading.Thread(target=self._run, name='afml-supervisor', daemon=True).start()
+
+    def watch(self, process: Process):
+        '''Read the output of a process until all its streams are closed'''
+        if self._selector is None:
+            for stream, file in process._streams.items():
+                threading.Thread(
+                    target=self._read_stream, args=(process, stream, file), daemon=True
+                ).start()
+            return
+
+        self._pending.put(process)
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            # The supervisor is already awake
+            pass
+
+    @staticmethod
+    def _read_stream(process: Process, stream: str, file: IO[bytes]):
+        while True:
+            data = file.read1(ProcessSupervisor.READ_SIZE)
+            process._feed(stream, data)
+            if not data:
+                file.close()
+                return
+
+    def _register_pending(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while not self._pending.empty():
+            process = self._pending.get()
+            for stream, file in process._streams.items():
+                os.set_blocking(file.fileno(), False)
+                self._selector.register(file, selectors.EVENT_READ, (process, stream))
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._register_pending()
+                    continue
+
+                process, stream = key.data
+                try:
+                    data = os.read(key.fd, ProcessSupervisor.READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+
+                if not data:
+                    self._selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                process._feed(stream, data)
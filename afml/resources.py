@@ -0,0 +1,217 @@
+"""
+    Resources declared by jobs and steps, and the pool that admits steps only when they fit the machine
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from .utils.utils import Utils
+
+
+class ResourceError(ValueError): ...
+
+class Resources:
+    """
+    CPUs and bytes of memory used by a step
+    """
+
+    def __init__(self, cpus: float = 0, memory: int = 0):
+        self.cpus = cpus
+        self.memory = memory
+
+    def __repr__(self):
+        return f"Resources(cpus={self.cpus:g}, memory={Utils.format_size(self.memory)})"
+
+    def __str__(self):
+        parts = []
+        if self.cpus:
+            parts.append(f"{self.cpus:g} cpus")
+        if self.memory:
+            parts.append(f"{Utils.format_size(self.memory)} memory")
+        return ', '.join(parts) or 'no resources'
+
+    def __bool__(self):
+        return bool(self.cpus or self.memory)
+
+    def to_definition(self) -> dict:
+        return {'cpus': self.cpus, 'memory': self.memory}
+
+    @staticmethod
+    def largest(resources: List[Optional['Resources']]) -> Optional['Resources']:
+        '''Largest cpus and memory of the given resources, enough to run them one at a time'''
+        resources = [item for item in resources if item]
+        if not resources:
+            return None
+        return Resources(max(item.cpus for item in resources), max(item.memory for item in resources))
+
+    @staticmethod
+    def parse(definition) -> Optional['Resources']:
+        '''Parse a definition such as {cpus: 4, memory: 8G}, or None if not defined'''
+        if definition is None:
+            return None
+        if not isinstance(definition, dict):
+            raise ResourceError(f"Resources must be a mapping of 'cpus' and 'memory', not '{definition}'")
+
+        unknown = set(definition) - {'cpus', 'memory'}
+        if unknown:
+            raise ResourceError(f"Unknown resources: {', '.join(sorted(map(str, unknown)))}")
+
+        try:
+            cpus = float(definition.get('cpus') or 0)
+            memory = Utils.parse_size(definition.get('memory') or 0)
+        except ValueError as e:
+            raise ResourceError(f"Invalid resources {definition}: {e}") from None
+        if cpus < 0 or memory < 0:
+            raise ResourceError(f"Invalid resources {definition}: values can't be negative")
+        return Resources(cpus, memory)
+
+class ResourcePool:
+    """
+    Capacity of the machine, shared by the steps running in parallel.
+    Waiting steps are admitted largest first, so small steps fill the room left by large ones,
+    and a step skipped too many times reserves the capacity it needs
+    """
+    STARVATION_LIMIT = 4
+
+    class Request:
+        def __init__(self, resources: Resources, weight: float, order: int):
+            self.resources = resources
+            self.weight = weight
+            self.order = order
+            self.skipped = 0
+            self.granted = False
+
+    def __init__(self, cpus: float = None, memory=None):
+        self.cpus = float(cpus) if cpus is not None else ResourcePool.detect_cpus()
+        self.memory = Utils.parse_size(memory) if memory is not None else ResourcePool.detect_memory()
+        if self.cpus <= 0 or self.memory <= 0:
+            raise ResourceError("The capacity of the resource pool must be positive")
+
+        self.used = Resources()
+        self._condition = threading.Condition()
+        self._waiting: List[ResourcePool.Request] = []
+        self._requests = 0
+
+    def __repr__(self):
+        return f"ResourcePool(cpus={self.cpus:g}, memory={Utils.format_size(self.memory)})"
+
+    @staticmethod
+    def _read_cgroup(file: str) -> Optional[str]:
+        try:
+            with open(os.path.join('/sys/fs/cgroup', file), 'r', encoding='utf-8') as cgroup_file:
+                return cgroup_file.read().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def detect_cpus() -> float:
+        '''CPUs this process can use, limited by its affinity and its cgroup quota'''
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = float(len(os.sched_getaffinity(0)))
+        else:
+            cpus = float(os.cpu_count() or 1)
+
+        quota = (ResourcePool._read_cgroup('cpu.max') or 'max').split()
+        if quota and quota[0] != 'max':
+            try:
+                cpus = min(cpus, int(quota[0]) / int(quota[1] if len(quota) > 1 else 100000))
+            except (ValueError, ZeroDivisionError):
+                pass
+        return cpus
+
+    @staticmethod
+    def detect_memory() -> int:
+        '''Physical memory, limited by the memory limit of the cgroup'''
+        try:
+            memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            memory = 0
+        if memory <= 0:
+            # Unknown (Windows), memory is only limited if given in the command line
+            memory = 1 << 62
+
+        limit = ResourcePool._read_cgroup('memory.max')
+        if limit and limit.isdigit():
+            memory = min(memory, int(limit))
+        return memory
+
+    def fit(self, resources: Resources) -> Resources:
+        '''Limit the resources to the capacity, so steps larger than the machine run alone'''
+        return Resources(min(resources.cpus, self.cpus), min(resources.memory, self.memory))
+
+    def _fits(self, resources: Resources) -> bool:
+        return (
+            self.used.cpus + resources.cpus <= self.cpus + 1e-9
+            and self.used.memory + resources.memory <= self.memory
+        )
+
+    def get_weight(self, resources: Resources) -> float:
+        '''Largest share of the capacity used by the resources'''
+        return max(resources.cpus / self.cpus, resources.memory / self.memory)
+
+    def _admit(self):
+        '''Grant the waiting requests that fit, starving ones first and then the largest'''
+        admitted = False
+        for request in sorted(self._waiting, key=lambda request: (
+            request.skipped < ResourcePool.STARVATION_LIMIT, -request.weight, request.order
+        )):
+            if self._fits(request.resources):
+                request.granted = True
+                self.used.cpus += request.resources.cpus
+                self.used.memory += request.resources.memory
+                self._waiting.remove(request)
+                admitted = True
+            elif request.skipped >= ResourcePool.STARVATION_LIMIT:
+                # Nothing else is admitted until the starving request fits
+                break
+
+        if admitted:
+            for request in self._waiting:
+                request.skipped += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def acquire(self, resources: Optional[Resources], on_wait: Callable[[Resources], None] = None):
+        '''Hold the resources while the context is active, waiting until they are available'''
+        if not resources:
+            yield resources
+            return
+
+        resources = self.fit(resources)
+        with self._condition:
+            request = ResourcePool.Request(resources, self.get_weight(resources), self._requests)
+            self._requests += 1
+            self._waiting.append(request)
+            self._admit()
+            if not request.granted and on_wait is not None:
+                on_wait(resources)
+            while not request.granted:
+                self._condition.wait()
+
+        try:
+            yield resources
+        finally:
+            self.release(resources)
+
+    def try_acquire(self, resources: Optional[Resources]) -> Optional[Resources]:
+        '''Take the resources if they are available now, returning the ones taken, or None if they are not'''
+        if not resources:
+            return Resources()
+
+        resources = self.fit(resources)
+        with self._condition:
+            # Requests waiting too long reserve the capacity they need
+            if not self._fits(resources) or any(
+                request.skipped >= ResourcePool.STARVATION_LIMIT for request in self._waiting
+            ):
+                return None
+            self.used.cpus += resources.cpus
+            self.used.memory += resources.memory
+        return resources
+
+    def release(self, resources: Resources):
+        with self._condition:
+            self.used.cpus -= resources.cpus
+            self.used.memory -= resources.memory
+            self._admit()
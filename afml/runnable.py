@@ -1,8 +1,9 @@
-from typing import Union
+from typing import Optional, Union
 
 from .base import BaseObject
 from .dataset import Dataset
 from .model import Model
+from .resources import Resources
 from .utils.format import ParamsFormatter
 from .utils.utils import Utils
 
@@ -13,12 +14,14 @@ class RunnableObject(BaseObject):
         params: dict = None,
         dataset: Union[Dataset, str, None] = None,
         model: Union[Model, str, None] = None,
-        conditions: dict = None
+        conditions: dict = None,
+        resources: dict = None
     ):
         super().__init__(name, params)
         self._dataset = dataset
         self._model = model
         self._conditions = conditions or {}
+        self._resources = resources
 
     def get_dataset(self, project, formatter=ParamsFormatter()):
         dataset_definition = formatter.format(self._dataset)
@@ -36,5 +39,12 @@ class RunnableObject(BaseObject):
             return Model.parse(model_definition)
         return None
 
+    def get_resources(self, formatter=ParamsFormatter()) -> Optional[Resources]:
+        return Resources.parse(formatter.format(self._resources))
+
+    def get_conditions(self, formatter=ParamsFormatter()) -> dict:
+        '''Conditions with their expressions formatted, to be checked later'''
+        return {condition: formatter.format(expression) for condition, expression in self._conditions.items()}
+
     def can_execute(self, formatter=ParamsFormatter()):
         return Utils.check_conditions(self._conditions, formatter)
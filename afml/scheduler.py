@@ -0,0 +1,163 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional
+
+from termcolor import cprint
+
+from .resources import ResourcePool, Resources
+from .utils.output import ThreadOutput
+
+
+class Task:
+    def __repr__(self):
+        return f"Task({self.name})"
+
+    def __init__(
+        self,
+        func: Callable[[], bool],
+        name: str = None,
+        needs: List['Task'] = None,
+        resources: Optional[Resources] = None
+    ):
+        self.func = func
+        self.name = name
+        self.needs = needs or []
+        # Resources held while the task runs, if the scheduler has a resource pool
+        self.resources = resources
+        self.done = False
+        self.failed = False
+        # Resources taken from the pool, and times other tasks started while this one waited for them
+        self.acquired: Optional[Resources] = None
+        self.waiting = False
+        self.skipped = 0
+
+    @property
+    def ready(self):
+        return all(task.done and not task.failed for task in self.needs)
+
+    def run(self, capture=False):
+        '''Run the task, returning its printed output if captured'''
+        if not capture:
+            self.failed = bool(self.func())
+            return None
+
+        with ThreadOutput.capture() as output:
+            try:
+                self.failed = bool(self.func())
+            except Exception as e:
+                cprint(f"ERROR: {e.__class__.__name__}: {e}", 'red')
+                self.failed = True
+        return output.getvalue()
+
+class Scheduler:
+    """
+    Run tasks on a bounded pool of workers, as soon as the tasks they need are done
+    and, with a resource pool, their resources are available.
+    Tasks waiting for resources don't hold a worker, which runs the tasks that fit instead
+    """
+    # Seconds between checks of the resources released by running tasks
+    RESOURCES_INTERVAL = 1.0
+
+    def __init__(self, workers: int = 1, resources: ResourcePool = None):
+        self.workers = max(1, workers or 1)
+        self.resources = resources
+
+    def run(self, tasks: List[Task]):
+        '''Run all the tasks, returning True if any of them failed'''
+        if self.workers == 1:
+            return self._run_sequential(tasks)
+        return self._run_parallel(tasks)
+
+    def _run_sequential(self, tasks):
+        pending = list(tasks)
+        while pending:
+            task = next((task for task in pending if task.ready), None)
+            if task is None:
+                break
+            pending.remove(task)
+            # A single task always fits, as the pool limits resources to its capacity
+            task.acquired = self._acquire(task)
+            try:
+                task.run()
+            finally:
+                self._release(task)
+            task.done = True
+            if task.failed:
+                return True
+        return False
+
+    def _run_parallel(self, tasks):
+        pending = list(tasks)
+        running = {}
+        failed = False
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            while pending or running:
+                waiting = []
+                if not failed:
+                    waiting = self._start_ready(pending, running, pool)
+
+                if not running:
+                    # Remaining tasks can never become ready
+                    break
+
+                # Steps holding their own resources can release them before their task finishes
+                finished, _ = wait(
+                    running, timeout=Scheduler.RESOURCES_INTERVAL if waiting else None,
+                    return_when=FIRST_COMPLETED
+                )
+                for future in finished:
+                    task = running.pop(future)
+                    self._release(task)
+                    task.done = True
+                    print(future.result(), end='', flush=True)
+                    if task.failed and not failed:
+                        failed = True
+                        if running:
+                            cprint(
+                                f"Waiting for {len(running)} running task(s) to finish",
+                                'red'
+                            )
+
+        return failed
+
+    def _acquire(self, task: Task) -> Optional[Resources]:
+        if self.resources is None:
+            return Resources()
+        return self.resources.try_acquire(task.resources)
+
+    def _release(self, task: Task):
+        if self.resources is not None and task.acquired:
+            self.resources.release(task.acquired)
+        task.acquired = None
+
+    def _start_ready(self, pending: List[Task], running: dict, pool: ThreadPoolExecutor) -> List[Task]:
+        '''
+        Start the ready tasks while there are free workers, returning the ones waiting for resources.
+        The largest tasks go first so smaller ones fill the room left, and tasks skipped too many times
+        reserve the resources they need
+        '''
+        ready = [task for task in pending if task.ready]
+        if self.resources is not None:
+            ready.sort(key=lambda task: (
+                task.skipped < ResourcePool.STARVATION_LIMIT,
+                -self.resources.get_weight(self.resources.fit(task.resources)) if task.resources else 0
+            ))
+
+        waiting = []
+        for task in ready:
+            if len(running) >= self.workers:
+                break
+            task.acquired = self._acquire(task)
+            if task.acquired is None:
+                if not task.waiting:
+                    cprint(f"{task.name} is waiting for {task.resources}", 'yellow')
+                    task.waiting = True
+                waiting.append(task)
+                if task.skipped >= ResourcePool.STARVATION_LIMIT:
+                    break
+                continue
+            for skipped in waiting:
+                skipped.skipped += 1
+            pending.remove(task)
+            running[pool.submit(task.run, True)] = task
+        return waiting
@@ -0,0 +1,67 @@
+import json
+import threading
+from typing import Dict, Tuple
+
+from .cache import StepCache
+from .history import History
+from .journal import RunJournal
+from .logs import RunLogs
+from .resources import ResourcePool
+from .stats import RunRecorder
+
+
+class Session:
+    """
+    Services shared by all the steps executed in a run
+    """
+
+    def __init__(
+        self,
+        cache: StepCache = None,
+        shard: Tuple[int, int] = None,
+        recorder: RunRecorder = None,
+        history: History = None,
+        resources: ResourcePool = None,
+        coordinator: 'Coordinator' = None,
+        journal: RunJournal = None,
+        retries: int = 0,
+        logs: RunLogs = None,
+        dedupe: 'StepDeduplicator' = None
+    ):
+        self.cache = cache
+        # Index and count of the shard of job matrices to run
+        self.shard = shard
+        # Records the resources used by each executed step
+        self.recorder = recorder
+        # Database of the executed jobs and steps, with their params and results
+        self.history = history
+        # Capacity of the machine, shared by the steps that declare their resources
+        self.resources = resources
+        # Hands out the steps to worker agents, instead of running them locally
+        self.coordinator = coordinator
+        # Records the completed steps, which are skipped when resuming the run
+        self.journal = journal
+        # Number of times a failed step is retried
+        self.retries = retries
+        # Log files of the output of every step
+        self.logs = logs
+        # Shares the result of a step with the identical steps of other matrix instances
+        self.dedupe = dedupe
+        # Last value of the metrics reported by the steps of every job matrix instance
+        self._metrics: Dict[str, dict] = {}
+        self._metrics_lock = threading.Lock()
+
+    @staticmethod
+    def _matrix_key(job, matrix: dict) -> str:
+        return json.dumps([job.display_name, dict(matrix) if matrix else {}], sort_keys=True, default=str)
+
+    def report_metrics(self, job, matrix: dict, metrics: Dict[str, float]):
+        '''Record metrics of a step, later steps of the same job matrix instance replace them'''
+        if not metrics:
+            return
+        with self._metrics_lock:
+            self._metrics.setdefault(Session._matrix_key(job, matrix), {}).update(metrics)
+
+    def get_metrics(self, job, matrix: dict) -> Dict[str, float]:
+        with self._metrics_lock:
+            return dict(self._metrics.get(Session._matrix_key(job, matrix), {}))
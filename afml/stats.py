@@ -0,0 +1,147 @@
+"""
+    Resources used by the executed steps, recorded as JSON lines in '.afml/runs/<run time>.jsonl'
+"""
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from termcolor import cprint
+
+from .utils.time import Time
+from .utils.utils import Utils
+
+
+class RunRecorder:
+    """
+    Append a record of every executed step to the file of the current run
+    """
+    FOLDER = '.afml/runs'
+
+    def __init__(self, folder=FOLDER):
+        self.folder = Path(folder)
+        self.run = Time.get_params()['time']
+        self.file = self.folder / f'{self.run}.jsonl'
+        self._lock = threading.Lock()
+
+    def record(self, job, step, matrix: dict, exit_code: int, usage: dict, metrics: dict = None):
+        record = {
+            'run': self.run,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'job': job.display_name,
+            'step': step.display_name,
+            'matrix': dict(matrix) if matrix else None,
+            'exit_code': exit_code,
+            **usage,
+        }
+        if metrics:
+            record['metrics'] = metrics
+        line = json.dumps(record, default=repr, separators=(',', ':')) + '\n'
+        with self._lock:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            with open(self.file, 'a', encoding='utf-8') as records_file:
+                records_file.write(line)
+
+class RunStats:
+    """
+    Summaries of the recorded step executions
+    """
+
+    def __init__(self, folder=RunRecorder.FOLDER):
+        self.folder = Path(folder)
+
+    def runs(self) -> List[str]:
+        return sorted(file.stem for file in self.folder.glob('*.jsonl'))
+
+    def records(self, runs: List[str] = None) -> Iterator[dict]:
+        for run in runs if runs is not None else self.runs():
+            try:
+                with open(self.folder / f'{run}.jsonl', 'r', encoding='utf-8') as records_file:
+                    for line in records_file:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            # Lines of an interrupted run may be incomplete
+                            continue
+            except FileNotFoundError:
+                continue
+
+    @staticmethod
+    def _format_seconds(seconds) -> str:
+        return f'{seconds:.2f}s' if seconds is not None else '-'
+
+    @staticmethod
+    def _format_bytes(size) -> str:
+        return Utils.format_size(size) if size is not None else '-'
+
+    def summary(self, records: List[dict]):
+        '''Print the usage of each step, aggregating all its executions'''
+        groups: Dict[tuple, List[dict]] = {}
+        for record in records:
+            groups.setdefault((record['job'], record['step']), []).append(record)
+
+        rows = []
+        for (job, step), group in groups.items():
+            walls = [record.get('wall', 0) for record in group]
+            cpus = [record.get('user', 0) + record.get('system', 0) for record in group]
+            rss = [record['max_rss'] for record in group if 'max_rss' in record]
+            reads = [record['read_bytes'] for record in group if 'read_bytes' in record]
+            writes = [record['write_bytes'] for record in group if 'write_bytes' in record]
+            rows.append([
+                job, step,
+                str(len(group)),
+                str(sum(record['exit_code'] != 0 for record in group)),
+                RunStats._format_seconds(sum(walls) / len(walls)),
+                RunStats._format_seconds(max(walls)),
+                RunStats._format_seconds(sum(cpus) / len(cpus)),
+                RunStats._format_bytes(max(rss) if rss else None),
+                RunStats._format_bytes(sum(reads) if reads else None),
+                RunStats._format_bytes(sum(writes) if writes else None),
+            ])
+
+        Utils.print_table(
+            ['job', 'step', 'runs', 'failed', 'wall', 'max wall', 'cpu', 'max rss', 'read', 'written'],
+            rows
+        )
+
+    def slowest(self, records: List[dict], top: int = 10):
+        '''Print the slowest executions, with their matrix instances'''
+        records = sorted(records, key=lambda record: record.get('wall', 0), reverse=True)[:top]
+        Utils.print_table(['job', 'step', 'matrix', 'wall', 'cpu', 'max rss'], [
+            [
+                record['job'], record['step'],
+                json.dumps(record['matrix']) if record.get('matrix') else '-',
+                RunStats._format_seconds(record.get('wall')),
+                RunStats._format_seconds(record.get('user', 0) + record.get('system', 0)),
+                RunStats._format_bytes(record.get('max_rss')),
+            ]
+            for record in records
+        ])
+
+    def show(self, run: str = None, all_runs: bool = False, job_names: List[str] = None, top: int = 10):
+        runs = self.runs()
+        if not runs:
+            cprint("No runs were recorded", 'yellow')
+            return
+
+        if not all_runs:
+            run = run or runs[-1]
+            if run not in runs:
+                raise LookupError(f"Run '{run}' not found, the recorded runs are: {', '.join(runs)}")
+            runs = [run]
+
+        records = [
+            record for record in self.records(runs)
+            if not job_names or record['job'] in job_names
+        ]
+        cprint(f"Runs: {runs[0]}" + (f" to {runs[-1]} ({len(runs)})" if len(runs) > 1 else ''), 'blue')
+        if not records:
+            cprint("No steps were recorded", 'yellow')
+            return
+
+        self.summary(records)
+        if top > 0:
+            print()
+            cprint("Slowest executions", 'blue')
+            self.slowest(records, top)
@@ -1,4 +1,4 @@
-
+from functools import lru_cache
 from string import Formatter
 from munch import Munch
 
@@ -6,28 +6,47 @@ from .time import Time
 
 class ParamsFormatter:
     @staticmethod
-    def format_param(__param__, **key_dict):
+    @lru_cache(maxsize=4096)
+    def _compile(template: str):
+        '''Compile a template into a function that formats it with a dictionary of variables'''
+        formatable_vars = list(Formatter().parse(template))
+
+        # Detect single variable parameter expressions, such as '{variable}'
+        # This is useful if the variable is a number/list/dict, because it avoids returning it as a string
+        # i.e.:
+        #   params:
+        #     number: 64
+        #     input_size: '{number}'
+        # Now params.input_size == 5, instead of params.input_size == '5'
+        if len(formatable_vars) == 1 and formatable_vars[0][0] == '' and formatable_vars[0][1] is not None and formatable_vars[0][2] == '':
+            code = compile(formatable_vars[0][1], '<string>', 'eval')
+            # Evaluated against a copy, as eval adds '__builtins__' to its globals
+            return lambda variables: eval(code, dict(variables))
+
+        # Strings without variables are returned as they would be formatted
+        if all(field_name is None for _, field_name, _, _ in formatable_vars):
+            formatted = ''.join(literal for literal, _, _, _ in formatable_vars)
+            return lambda variables: formatted
+
+        # Otherwise, format as usual. Positional fields need the arguments to be expanded
+        if any(
+            field_name is not None and (field_name == '' or field_name[0].isdigit())
+            for _, field_name, _, _ in formatable_vars
+        ):
+            return lambda variables: template.format(**variables)
+        return template.format_map
+
+    @staticmethod
+    def _format_param(__param__, variables: dict):
         if not isinstance(__param__, str):
             if isinstance(__param__, list):
-                return [ParamsFormatter.format_param(item, **key_dict) for item in __param__]
+                return [ParamsFormatter._format_param(item, variables) for item in __param__]
             if isinstance(__param__, dict):
-                return ParamsFormatter.format_params(__param__, **key_dict)
+                return ParamsFormatter._format_params(__param__, variables)
             return __param__
 
         try:
-            # Detect single variable parameter expressions, such as '{variable}'
-            # This is useful if the variable is a number/list/dict, because it avoids returning it as a string
-            # i.e.:
-            #   params:
-            #     number: 64
-            #     input_size: '{number}'
-            # Now params.input_size == 5, instead of params.input_size == '5'
-            formatable_vars = list(Formatter().parse(__param__))
-            if len(formatable_vars) == 1 and formatable_vars[0][0] == '' and formatable_vars[0][1] is not None and formatable_vars[0][2] == '':
-                return eval(formatable_vars[0][1], {**Time.get_params(), **key_dict})
-
-            # Otherwise, format as usual
-            return __param__.format(**{**Time.get_params(), **key_dict})
+            return ParamsFormatter._compile(__param__)(variables)
 
         except ValueError as e:
             raise ValueError(f"An error ocurred when trying to format '{__param__}': {e.args[0]}")
@@ -37,30 +56,53 @@ class ParamsFormatter:
             raise AttributeError(f"{e.args[0]}, parsing '{__param__}'")
 
     @staticmethod
-    def format_params(__params__, **key_dict):
+    def _format_params(__params__, variables: dict):
         if not __params__ or len(__params__) == 0:
             return {}
 
+        # Each parameter can be used by the following ones
+        variables = dict(variables)
         formatted_params = Munch()
         for key in __params__:
-            formatted_params[key] = ParamsFormatter.format_param(__params__[key], **{**key_dict, **formatted_params})
+            formatted_params[key] = variables[key] = ParamsFormatter._format_param(__params__[key], variables)
 
         return formatted_params
 
+    @staticmethod
+    def format_param(__param__, **key_dict):
+        return ParamsFormatter._format_param(__param__, {**Time.get_params(), **key_dict})
+
+    @staticmethod
+    def format_params(__params__, **key_dict):
+        return ParamsFormatter._format_params(__params__, {**Time.get_params(), **key_dict})
+
     def __init__(self, **params):
         self._params = params
+        self._variables = None
+
+    @property
+    def variables(self) -> dict:
+        '''Dictionary of variables available for formatting, built once per context'''
+        if self._variables is None:
+            self._variables = {**Time.get_params(), **self._params}
+        return self._variables
 
     def update(self, params):
         '''Format the new parameters and add them to the formatting dictionary'''
-        self._params.update(**ParamsFormatter.format_params(params, **self._params))
+        formatted_params = ParamsFormatter._format_params(params, self.variables)
+        self._params.update(**formatted_params)
+        self._variables.update(formatted_params)
 
     def format(self, params : 'str | dict'):
         '''Format a string with the current context definition'''
         if isinstance(params, str):
-            return ParamsFormatter.format_param(params, **self._params)
+            return ParamsFormatter._format_param(params, self.variables)
         if isinstance(params, dict):
-            return ParamsFormatter.format_params(params, **self._params)
+            return ParamsFormatter._format_params(params, self.variables)
         return params
 
     def copy(self):
-        return ParamsFormatter(**self._params)
+        formatter = ParamsFormatter(**self._params)
+        if self._variables is not None:
+            formatter._variables = dict(self._variables)
+        return formatter
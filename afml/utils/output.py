@@ -0,0 +1,57 @@
+import io
+import sys
+import threading
+from contextlib import contextmanager
+
+
+class ThreadOutput:
+    '''Redirect everything printed by a thread into its own buffer'''
+
+    class _Stream:
+        def __init__(self, stream):
+            self._stream = stream
+            self._local = threading.local()
+
+        def write(self, text):
+            buffer = getattr(self._local, 'buffer', None)
+            if buffer is not None:
+                return buffer.write(text)
+            return self._stream.write(text)
+
+        def flush(self):
+            if getattr(self._local, 'buffer', None) is None:
+                self._stream.flush()
+
+        def __getattr__(self, name):
+            return getattr(self._stream, name)
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _install() -> '_Stream':
+        with ThreadOutput._lock:
+            if not isinstance(sys.stdout, ThreadOutput._Stream):
+                sys.stdout = ThreadOutput._Stream(sys.stdout)
+            return sys.stdout
+
+    @staticmethod
+    def capturing() -> bool:
+        '''Check if the output of the current thread is being captured'''
+        stream = sys.stdout
+        return (
+            isinstance(stream, ThreadOutput._Stream)
+            and getattr(stream._local, 'buffer', None) is not None
+        )
+
+    @staticmethod
+    @contextmanager
+    def capture():
+        '''Capture the output of the current thread, yielding the buffer'''
+        stream = ThreadOutput._install()
+        buffer = io.StringIO()
+        previous = getattr(stream._local, 'buffer', None)
+        stream._local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            stream._local.buffer = previous
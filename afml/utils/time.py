@@ -1,9 +1,11 @@
 import os
 import json
+import threading
 from datetime import datetime
 
 class Time:
     _instance = None
+    _lock = threading.Lock()
 
     def __init__(self):
         self.last_time = self.run_time = datetime.now()
@@ -21,20 +23,33 @@ class Time:
                 'last_time': self.run_time.isoformat()
             }, f)
 
-    @property
-    def params(self):
-        return {
+        self._params = {
             'time': self.run_time.strftime("%Y-%m-%d-%H-%M-%S"),
             'last_time': self.last_time.strftime("%Y-%m-%d-%H-%M-%S")
         }
 
+    @property
+    def params(self):
+        return dict(self._params)
+
+    @staticmethod
+    def resume(params: dict):
+        '''Use the times of a previous run, which is being resumed'''
+        with Time._lock:
+            instance = Time.__new__(Time)
+            instance.run_time = datetime.strptime(params['time'], "%Y-%m-%d-%H-%M-%S")
+            instance.last_time = datetime.strptime(params['last_time'], "%Y-%m-%d-%H-%M-%S")
+            instance._params = dict(params)
+            Time._instance = instance
+
     @staticmethod
     def get_params():
         return Time.get_instance().params
 
     @staticmethod
     def get_instance():
-        if Time._instance is None:
-            Time._instance = Time()
+        with Time._lock:
+            if Time._instance is None:
+                Time._instance = Time()
 
         return Time._instance
@@ -4,6 +4,36 @@ from termcolor import cprint
 from .format import ParamsFormatter
 
 class Utils:
+    SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+    @staticmethod
+    def parse_size(size) -> int:
+        '''Parse sizes such as 512, '256M' or '8G' into bytes'''
+        if isinstance(size, (int, float)):
+            return int(size)
+
+        text = str(size).strip().upper().removesuffix('B').removesuffix('I')
+        unit = text[-1:] if text[-1:] in Utils.SIZE_UNITS else ''
+        try:
+            return int(float(text[:len(text)-len(unit)]) * Utils.SIZE_UNITS[unit])
+        except ValueError:
+            raise ValueError(f"Invalid size '{size}'") from None
+
+    @staticmethod
+    def format_size(size: int) -> str:
+        '''Format a number of bytes with the largest unit that keeps it above 1, such as 1.5G'''
+        for unit, unit_size in reversed(Utils.SIZE_UNITS.items()):
+            if abs(size) >= unit_size or not unit:
+                return f'{size / unit_size:.1f}{unit}' if unit else f'{int(size)}B'
+
+    @staticmethod
+    def print_table(header: list, rows: list):
+        '''Print rows of strings aligned in columns, below a highlighted header'''
+        widths = [max(len(row[column]) for row in (header, *rows)) for column in range(len(header))]
+        cprint('  '.join(cell.ljust(width) for cell, width in zip(header, widths)).rstrip(), 'green')
+        for row in rows:
+            print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
     @staticmethod
     def check_condition(condition, expression):
         if condition == 'file':
@@ -14,5 +14,14 @@ if run_ctx.model is not None:
     model = run_ctx.model.build(input_size=42)
     model.summary()
 
+    print('> Building model once, later builds load it from .afml/models')
+    model = run_ctx.model.build_cached()
+    model.summary()
+
     print('> Model method returned', run_ctx.model.module.model_method())
 logging.debug(f'Params: {run_ctx.params}')
+
+# Metrics are buffered and sent to afml, which records them with the step
+for epoch in range(3):
+    run_ctx.log_metric('loss', 1 / (epoch + 1), step=epoch)
+run_ctx.log_metrics({'accuracy': 0.9})
@@ -14,7 +14,7 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'afml=afml.afml:main'
+            'afml=afml.cli:main'
         ]
     }
 )